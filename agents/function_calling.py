@@ -0,0 +1,147 @@
+import json
+from dataclasses import dataclass
+from typing import List, Dict, Any, Tuple, Union, Optional
+
+from langchain.agents import BaseSingleActionAgent, AgentExecutor
+from langchain.base_language import BaseLanguageModel
+from langchain.callbacks.manager import Callbacks
+from langchain.prompts import ChatPromptTemplate
+from langchain.schema import AgentAction, AgentFinish, AIMessage, BaseMessage, FunctionMessage, \
+    OutputParserException
+from langchain.tools import BaseTool
+from yid_langchain_extensions.output_parser.thoughts_json_parser import Thought
+
+FUNCTION_CALLING_INSTRUCTION = \
+    "Act by calling functions. Always reply to the user by calling {final_answer} function, never with plain text."
+
+
+@dataclass
+class FunctionCallAction(AgentAction):
+    message: AIMessage
+
+
+def thought_to_property(thought: Thought) -> Dict[str, str]:
+    return {"type": "boolean" if thought.type == "bool" else "string", "description": thought.description}
+
+
+def tool_to_function(tool: BaseTool) -> Dict[str, Any]:
+    """Tools take a single string, except ones having their own function_parameters json schema."""
+    parameters = getattr(tool, "function_parameters", None) or {
+        "type": "object",
+        "properties": {"input": {"type": "string", "description": "The input to the action"}},
+        "required": ["input"],
+    }
+    return {"name": tool.name, "description": tool.description, "parameters": parameters}
+
+
+def final_answer_to_function(final_answer_tool: BaseTool, after_thoughts: List[Thought]) -> Dict[str, Any]:
+    """Final answer with after-thoughts as its arguments, thoughts described as optional are not required."""
+    properties = {"answer": {"type": "string", "description": "Your response to the human"}}
+    properties.update({thought.name: thought_to_property(thought) for thought in after_thoughts})
+    required = ["answer"] + [thought.name for thought in after_thoughts
+                             if not thought.description.startswith("(Optional)")]
+    return {
+        "name": final_answer_tool.name,
+        "description": final_answer_tool.description,
+        "parameters": {"type": "object", "properties": properties, "required": required},
+    }
+
+
+def _format_type(schema: Dict[str, Any]) -> str:
+    if schema.get("type") == "array":
+        return f"{_format_type(schema.get('items', {}))}[]"
+    return {"integer": "number"}.get(schema.get("type"), schema.get("type", "any"))
+
+
+def format_functions(functions: List[Dict[str, Any]]) -> str:
+    """Functions the way the model sees them in its prompt, to count their tokens."""
+    lines = ["namespace functions {", ""]
+    for function in functions:
+        lines.extend([f"// {function['description']}", f"type {function['name']} = (_: {{"])
+        parameters = function["parameters"]
+        for name, schema in parameters["properties"].items():
+            if "description" in schema:
+                lines.append(f"// {schema['description']}")
+            optional = "" if name in parameters.get("required", []) else "?"
+            lines.append(f"{name}{optional}: {_format_type(schema)},")
+        lines.extend(["}) => any;", ""])
+    lines.append("} // namespace functions")
+    return "\n".join(lines)
+
+
+class FunctionCallingAgent(BaseSingleActionAgent):
+    """Agent using the function calling interface of the model instead of json in the message text.
+
+    Tools and final answer are functions, after-thoughts are arguments of the final answer function and are
+    returned together with the output, like ActionParser does. Invalid arguments are sent back to the model,
+    so only that step is regenerated.
+    """
+    llm: BaseLanguageModel
+    prompt: ChatPromptTemplate
+    functions: List[Dict[str, Any]]
+    final_answer_name: str = "final_answer"
+
+    @classmethod
+    def from_llm_and_tools(
+            cls, llm: BaseLanguageModel, prompt: ChatPromptTemplate, final_answer_tool: BaseTool,
+            tools: List[BaseTool], after_thoughts: Optional[List[Thought]] = None) -> "FunctionCallingAgent":
+        functions = [final_answer_to_function(final_answer_tool, after_thoughts or [])]
+        functions.extend(tool_to_function(tool) for tool in tools)
+        return cls(llm=llm, prompt=prompt, functions=functions, final_answer_name=final_answer_tool.name)
+
+    @property
+    def input_keys(self) -> List[str]:
+        return ["input"]
+
+    @staticmethod
+    def _construct_scratchpad(intermediate_steps: List[Tuple[AgentAction, str]]) -> List[BaseMessage]:
+        messages = []
+        for action, observation in intermediate_steps:
+            if isinstance(action, FunctionCallAction):
+                messages.append(action.message)
+            else:
+                # parsing error
+                messages.append(AIMessage(content=action.log))
+            messages.append(FunctionMessage(name=action.tool, content=str(observation)))
+        return messages
+
+    def _get_messages(self, intermediate_steps: List[Tuple[AgentAction, str]], **kwargs: Any) -> List[BaseMessage]:
+        return self.prompt.format_messages(**kwargs, agent_scratchpad=self._construct_scratchpad(intermediate_steps))
+
+    def _parse(self, message: BaseMessage) -> Union[FunctionCallAction, AgentFinish]:
+        function_call = message.additional_kwargs.get("function_call")
+        if not function_call:
+            return AgentFinish({"output": message.content, "raw_output": message.content}, message.content)
+        name = function_call["name"]
+        try:
+            # like ActionParser, new lines inside of strings are tolerated
+            arguments = json.loads(function_call["arguments"], strict=False)
+        except json.JSONDecodeError as e:
+            raise OutputParserException(
+                f"Could not parse arguments of {name}: {e}",
+                observation=f"Arguments of {name} are not valid json: {e}. Call the function again with valid json.",
+                llm_output=f"{name}({function_call['arguments']})",
+                send_to_llm=True)
+        if name == self.final_answer_name:
+            answer = arguments.pop("answer", "")
+            return AgentFinish({"output": answer, "raw_output": answer, **arguments}, answer)
+        if set(arguments) == {"input"}:
+            tool_input = arguments["input"]
+        else:
+            tool_input = json.dumps(arguments)
+        return FunctionCallAction(tool=name, tool_input=tool_input, log=f"{name}({tool_input})", message=message)
+
+    def plan(self, intermediate_steps: List[Tuple[AgentAction, str]], callbacks: Callbacks = None,
+             **kwargs: Any) -> Union[AgentAction, AgentFinish]:
+        message = self.llm.predict_messages(
+            self._get_messages(intermediate_steps, **kwargs), functions=self.functions, callbacks=callbacks)
+        return self._parse(message)
+
+    async def aplan(self, intermediate_steps: List[Tuple[AgentAction, str]], callbacks: Callbacks = None,
+                    **kwargs: Any) -> Union[AgentAction, AgentFinish]:
+        message = await self.llm.apredict_messages(
+            self._get_messages(intermediate_steps, **kwargs), functions=self.functions, callbacks=callbacks)
+        return self._parse(message)
+
+    def get_executor(self, tools: List[BaseTool], **kwargs: Any) -> AgentExecutor:
+        return AgentExecutor(agent=self, tools=tools, handle_parsing_errors=True, **kwargs)
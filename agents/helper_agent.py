@@ -1,59 +1,106 @@
+import asyncio
+import functools
+import io
 import os.path
 import shutil
+import tarfile
+import time
 from collections import defaultdict
 from datetime import datetime
 from multiprocessing import Lock
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Set, Tuple, Callable
 
-from langchain import PromptTemplate, FAISS
+import numpy as np
+from langchain import PromptTemplate
 from langchain.agents import AgentExecutor
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
 from langchain.memory.chat_memory import BaseChatMemory
 from langchain.prompts import MessagesPlaceholder, \
     HumanMessagePromptTemplate, ChatPromptTemplate
 from langchain.schema import SystemMessage, AIMessage
+from langchain.tools import BaseTool
 from yid_langchain_extensions.agent.simple_agent import SimpleAgent
 from yid_langchain_extensions.output_parser.action_parser import ActionParser
 from yid_langchain_extensions.output_parser.utils import get_dict_without_extra_fields, \
     format_dict_to_json_md
 from yid_langchain_extensions.tools.utils import format_tools, format_tool_names, FinalAnswerTool
 
+from agents.function_calling import FunctionCallingAgent, FUNCTION_CALLING_INSTRUCTION
+from agents.load_controller import LoadController, LoadLevel
+from agents.long_term_memory import LongTermMemory, LongTermMemoryIndexPolicy
+from agents.ltm_ingestion import LongTermMemoryIngestionQueue
+from agents.openai_scheduler import ScheduledChatOpenAI, ScheduledOpenAIEmbeddings, Priority
 from agents.stm_savable import SavableWindowMemory
+from agents.tracing import get_tracer, traced
 from agents.utils import format_now, get_self_criticism_thought, get_thought_thought, get_important_info_thought, \
     get_conversation_summary_thought, get_end_detection_thought
 from agents.web_researcher import WebResearcherAgent
 
+# the prefix prompt tells about web_search, so the model is told it is disabled under load
+WEB_SEARCH_DISABLED_INSTRUCTION = "web_search tool is not available now, answer without it."
+
 
 class HelperAgent:
-    def __init__(self, save_path: str, prompts: Dict[str, str], web_researcher_agent: WebResearcherAgent):
+    def __init__(self, save_path: str, prompts: Dict[str, str], web_researcher_agent: WebResearcherAgent,
+                 smart_llm: Optional[BaseChatModel] = None, fast_llm: Optional[BaseChatModel] = None,
+                 long_term_memory_embeddings: Optional[Embeddings] = None,
+                 long_term_memory_policy: Optional[LongTermMemoryIndexPolicy] = None,
+                 long_term_memory_batch_size: int = 16, long_term_memory_max_delay: float = 1.0,
+                 use_function_calling: bool = False, load_controller: Optional[LoadController] = None,
+                 degraded_llm: Optional[BaseChatModel] = None):
         self.prompts = prompts
         self.save_path = save_path
         if not os.path.isdir(save_path):
             os.makedirs(save_path)
 
-        self.smart_llm = ChatOpenAI(model_name="gpt-4-0613", temperature=0)
-        self.fast_llm = ChatOpenAI(model_name="gpt-3.5-turbo-0613", temperature=0)
+        self.smart_llm = smart_llm or ScheduledChatOpenAI(model_name="gpt-4-0613", temperature=0)
+        # fast_llm is called only by background memory consolidation (short-term memory just keeps it),
+        # nobody waits for it
+        self.fast_llm = fast_llm or ScheduledChatOpenAI(
+            model_name="gpt-3.5-turbo-0613", temperature=0, priority=Priority.BACKGROUND)
+        # fast model answering instead of smart_llm under load, users wait for it
+        self.degraded_llm = degraded_llm or ScheduledChatOpenAI(model_name="gpt-3.5-turbo-0613", temperature=0)
+        self.load_controller = load_controller or LoadController()
 
+        self.web_researcher_agent = web_researcher_agent
         final_answer_tool = FinalAnswerTool()
         web_search_tool = web_researcher_agent.as_tool()
 
         self.tools = [final_answer_tool, web_search_tool]
-        self.output_parser = ActionParser.from_extra_thoughts(pre_thoughts=[
-            get_thought_thought(), get_self_criticism_thought()
-        ], after_thoughts=[
+        get_tracer().attach(self.smart_llm, self.fast_llm, self.degraded_llm, *self.tools)
+        self.after_thoughts = [
             get_end_detection_thought(),
             get_conversation_summary_thought(),
             get_important_info_thought(self.prompts["important_memory_description"]),
-        ])
-        self.format_message = PromptTemplate.from_template(
-            self.output_parser.get_format_instructions(), template_format="jinja2").format(
-            tool_names=format_tool_names(self.tools)
-        )
-        self.long_term_memory_embeddings = OpenAIEmbeddings()
+        ]
+        self.output_parser = ActionParser.from_extra_thoughts(pre_thoughts=[
+            get_thought_thought(), get_self_criticism_thought()
+        ], after_thoughts=self.after_thoughts)
+        # tools and after-thoughts go through the function calling interface instead of the json in the text
+        self.use_function_calling = use_function_calling
+        self.format_message = self._get_format_message(self.tools)
+        # web search is disabled under load
+        self.final_answer_format_message = self._get_format_message(self.tools[:1])
+        self.long_term_memory_embeddings = long_term_memory_embeddings or ScheduledOpenAIEmbeddings()
+        self.long_term_memory_policy = long_term_memory_policy or LongTermMemoryIndexPolicy()
+        self.long_term_memory_queue = LongTermMemoryIngestionQueue(
+            self.long_term_memory_embeddings, self._add_to_long_term_memory,
+            batch_size=long_term_memory_batch_size, max_delay=long_term_memory_max_delay)
+        # users who sent messages since their memory was consolidated last time
+        self.active_users: Set[int] = set()
         self._memory_locks = defaultdict(Lock)
         self._locks_lock = Lock()
         self.k_last_messages = 8
+        # memory loaded by aprepare before the request is known, with the time it was loaded
+        self._prepared_contexts: Dict[int, Tuple[float, asyncio.Task]] = {}
+        self.prepared_context_ttl = 60.0
+
+    def _get_format_message(self, tools: List[BaseTool]) -> str:
+        return PromptTemplate.from_template(
+            self.output_parser.get_format_instructions(), template_format="jinja2").format(
+            tool_names=format_tool_names(tools)
+        )
 
     def _get_memory_lock(self, user_id: int) -> Lock:
         with self._locks_lock:
@@ -68,6 +115,7 @@ class HelperAgent:
     def _get_user_ltm_path(self, user_id: int) -> str:
         return os.path.join(self._get_user_dir(user_id=user_id), "ltm")
 
+    @traced("io")
     def _load_short_term_memory(self, user_id: int) -> SavableWindowMemory:
         def add_date(full_input: Dict[str, Any]) -> Dict[str, Any]:
             updated_input = f"{format_now()}\n{full_input['input']}"
@@ -96,6 +144,7 @@ class HelperAgent:
     def _check_conversation_summary(self, user_id: int) -> bool:
         return os.path.exists(self._get_conversation_summary_path(user_id=user_id))
 
+    @traced("io")
     def _load_conversation_summary(self, user_id: int) -> str:
         with self._get_memory_lock(user_id=user_id):
             if os.path.exists(conversation_summary_path := self._get_conversation_summary_path(user_id=user_id)):
@@ -104,6 +153,7 @@ class HelperAgent:
             else:
                 return "No conversation summary yet."
 
+    @traced("io")
     def _update_conversation_summary(self, user_id: int, new_summary: str):
         with self._get_memory_lock(user_id=user_id):
             with open(self._get_conversation_summary_path(user_id=user_id), "w") as f:
@@ -112,6 +162,7 @@ class HelperAgent:
     def _get_memory_about_user_path(self, user_id: int) -> str:
         return os.path.join(self._get_user_dir(user_id=user_id), "memory_about_user.txt")
 
+    @traced("io")
     def _load_memory_about_user(self, user_id: int) -> str:
         with self._get_memory_lock(user_id=user_id):
             if os.path.exists(memory_about_user_path := self._get_memory_about_user_path(user_id=user_id)):
@@ -120,59 +171,139 @@ class HelperAgent:
             else:
                 return "Nothing is known about this user yet."
 
+    @traced("io")
     def _update_memory_about_user(self, user_id: int, new_memory: str):
         with self._get_memory_lock(user_id=user_id):
             with open(self._get_memory_about_user_path(user_id=user_id), "w") as f:
                 f.write(new_memory)
 
-    def _load_long_term_memory(self, user_id: int) -> Optional[FAISS]:
-        with self._get_memory_lock(user_id=user_id):
-            ltm_path = self._get_user_ltm_path(user_id=user_id)
-            if os.path.exists(ltm_path):
-                return FAISS.load_local(ltm_path, self.long_term_memory_embeddings)
-            return None
-
-    def _create_long_term_memory(self, first_memory: str) -> FAISS:
-        return FAISS.from_texts([first_memory], self.long_term_memory_embeddings,
-                                metadatas=[{"date": datetime.now().isoformat()}])
+    def _read_long_term_memory(self, user_id: int) -> Optional[LongTermMemory]:
+        # caller holds the memory lock of the user
+        ltm_path = self._get_user_ltm_path(user_id=user_id)
+        if LongTermMemory.exists(ltm_path):
+            return LongTermMemory.load(ltm_path, self.long_term_memory_embeddings, self.long_term_memory_policy)
+        return None
 
-    def _add_to_long_term_memory(self, user_id: int, new_long_term_memory: str):
-        long_term_memory = self._load_long_term_memory(user_id=user_id)
+    @traced("io")
+    def _load_long_term_memory(self, user_id: int) -> Optional[LongTermMemory]:
+        with self._get_memory_lock(user_id=user_id):
+            return self._read_long_term_memory(user_id=user_id)
+
+    def _add_to_long_term_memory(
+            self, user_id: int, vectors: np.ndarray, memories: List[str], metadatas: List[Dict[str, Any]],
+            is_discarded: Optional[Callable[[], bool]] = None) -> bool:
+        # called by long_term_memory_queue from a worker thread with already embedded memories.
+        # Memory is loaded under the lock, so it can not be replaced by consolidation between load and save,
+        # and memories can not be discarded by forget between the check and the save
         with self._get_memory_lock(user_id=user_id):
+            if is_discarded is not None and is_discarded():
+                return False
+            long_term_memory = self._read_long_term_memory(user_id=user_id)
             if long_term_memory:
-                long_term_memory.add_texts([new_long_term_memory], metadatas=[{"date": datetime.now().isoformat()}])
+                long_term_memory.add_vectors(vectors, memories, metadatas)
             else:
-                long_term_memory = self._create_long_term_memory(first_memory=new_long_term_memory)
-            long_term_memory.save_local(self._get_user_ltm_path(user_id=user_id))
+                long_term_memory = LongTermMemory.from_vectors(
+                    self._get_user_ltm_path(user_id=user_id), vectors, memories, self.long_term_memory_embeddings,
+                    self.long_term_memory_policy, metadatas)
+            long_term_memory.save()
+            return True
+
+    def _discard_prepared_context(self, user_id: int):
+        if (prepared := self._prepared_contexts.pop(user_id, None)) is not None:
+            prepared[1].cancel()
 
     def forget(self, user_id: int):
+        self._discard_prepared_context(user_id)
         short_term_memory = self._load_short_term_memory(user_id=user_id)
         with self._get_memory_lock(user_id=user_id):
+            # under the lock, so a commit of queued memories either sees the discard or is removed below
+            self.long_term_memory_queue.discard_user(user_id)
             short_term_memory.clear()
             ltm_path = self._get_user_ltm_path(user_id=user_id)
             if os.path.exists(ltm_path):
                 shutil.rmtree(ltm_path)
             if os.path.exists(conversation_summary_path := self._get_conversation_summary_path(user_id=user_id)):
                 os.remove(conversation_summary_path)
-            if os.path.exists(memory_about_user_path := self._get_memory_about_user_path(user_id=user_id)):
-                os.remove(memory_about_user_path)
+            memory_about_user_path = self._get_memory_about_user_path(user_id=user_id)
+            # with the backup left by memory consolidation
+            for path in [memory_about_user_path, memory_about_user_path + ".bak"]:
+                if os.path.exists(path):
+                    os.remove(path)
         print(f"Memory about user {user_id} removed")
 
+    async def aforget(self, user_id: int):
+        self.forget(user_id)
+
+    def get_user_ids(self) -> List[int]:
+        return sorted(int(name) for name in os.listdir(self.save_path) if name.lstrip("-").isdigit())
+
+    def _pack_user(self, user_id: int) -> bytes:
+        archive = io.BytesIO()
+        with self._get_memory_lock(user_id=user_id):
+            with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+                # unfinished memory consolidation is not handed off
+                tar.add(self._get_user_dir(user_id=user_id), arcname=".",
+                        filter=lambda info: None if info.name.endswith(".consolidated") else info)
+        return archive.getvalue()
+
+    async def export_user(self, user_id: int) -> bytes:
+        """Archive with all saved state of the user, to hand the user off to another process."""
+        await self.long_term_memory_queue.wait_for_user(user_id)
+        return await asyncio.to_thread(self._pack_user, user_id)
+
+    def _unpack_user(self, user_id: int, data: bytes):
+        user_dir = os.path.join(self.save_path, str(user_id))
+        tmp_dir = f"{user_dir}.importing"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+            tar.extractall(tmp_dir, filter="data")
+        with self._get_memory_lock(user_id=user_id):
+            if os.path.exists(user_dir):
+                shutil.rmtree(user_dir)
+            os.replace(tmp_dir, user_dir)
+
+    async def import_user(self, user_id: int, data: bytes):
+        """Replaces state of the user with the archive made by export_user."""
+        self.long_term_memory_queue.discard_user(user_id)
+        self._discard_prepared_context(user_id)
+        await asyncio.to_thread(self._unpack_user, user_id, data)
+
+    def remove_user(self, user_id: int):
+        """Removes all state of the user from this process, after the user was handed off to another one."""
+        self.long_term_memory_queue.discard_user(user_id)
+        self._discard_prepared_context(user_id)
+        self.active_users.discard(user_id)
+        with self._get_memory_lock(user_id=user_id):
+            user_dir = os.path.join(self.save_path, str(user_id))
+            if os.path.exists(user_dir):
+                shutil.rmtree(user_dir)
+
+    @traced("ltm")
     def _get_relevant_ltm(
-            self, user_id: int, short_term_memory: BaseChatMemory, long_term_memory: Optional[FAISS]) -> Optional[str]:
+            self, user_id: int, short_term_memory: BaseChatMemory,
+            long_term_memory: Optional[LongTermMemory]) -> Optional[str]:
         if long_term_memory is None:
             return None
         with self._get_memory_lock(user_id=user_id):
             short_term_memory.return_messages = False
             short_term_context = short_term_memory.load_memory_variables({})["chat_history"]
             short_term_memory.return_messages = True
-            relevant_document = long_term_memory.similarity_search(short_term_context, k=1)[0]
+            relevant_documents = long_term_memory.similarity_search(short_term_context, k=1)
+            # memory may be empty, e.g. when consolidation removed every document
+            if not relevant_documents:
+                return None
+            relevant_document = relevant_documents[0]
             date = datetime.fromisoformat(relevant_document.metadata["date"]).strftime('%Y-%m-%d')
             thought = "Thought (user does not see it):\n" \
                       f"Hm, that reminds me another conversation I had {date} with user:\n" \
                       f"{relevant_document.page_content}"
             return thought
 
+    def _load_relevant_ltm(self, user_id: int, short_term_memory: BaseChatMemory) -> Optional[str]:
+        long_term_memory = self._load_long_term_memory(user_id=user_id)
+        return self._get_relevant_ltm(user_id, short_term_memory, long_term_memory)
+
     def _format_conversation_summary(self, conversation_summary: str) -> str:
         result = \
             "CURRENT_CONVERSATION SUMMARY:\n" \
@@ -189,8 +320,8 @@ class HelperAgent:
         return result
 
     def _initialise_agent(
-            self, user_id: int, short_term_memory: BaseChatMemory, conversation_summary: str,
-            memory_about_user: str, long_term_memory: Optional[FAISS]) -> AgentExecutor:
+            self, short_term_memory: BaseChatMemory, conversation_summary: str,
+            memory_about_user: str, relevant_ltm: Optional[str], level: LoadLevel = LoadLevel.FULL) -> AgentExecutor:
         system_message = PromptTemplate.from_template(self.prompts["prefix"], template_format="jinja2").format(
             date=format_now()
         )
@@ -201,36 +332,88 @@ class HelperAgent:
             MessagesPlaceholder(variable_name="chat_history"),
             HumanMessagePromptTemplate.from_template("{{input}}", "jinja2"),
         ]
-        if (relevant_ltm := self._get_relevant_ltm(user_id, short_term_memory, long_term_memory)) is not None:
+        if relevant_ltm is not None:
             messages.append(AIMessage(content=relevant_ltm))
+        tools = self.tools if level < LoadLevel.NO_WEB_SEARCH else self.tools[:1]
+        if len(tools) < len(self.tools):
+            messages.append(SystemMessage(content=WEB_SEARCH_DISABLED_INSTRUCTION))
+        llm = self.smart_llm if level < LoadLevel.FAST_LLM else self.degraded_llm
+        if self.use_function_calling:
+            messages.extend([
+                MessagesPlaceholder(variable_name="agent_scratchpad"),
+                SystemMessage(content=FUNCTION_CALLING_INSTRUCTION.format(final_answer=self.tools[0].name)),
+            ])
+            agent_executor = FunctionCallingAgent.from_llm_and_tools(
+                llm, ChatPromptTemplate.from_messages(messages=messages), tools[0], tools[1:], self.after_thoughts
+            ).get_executor(tools=tools[1:], memory=short_term_memory, verbose=True)
+            get_tracer().attach(agent_executor)
+            return agent_executor
         messages.extend([
             MessagesPlaceholder(variable_name="agent_scratchpad"),
-            SystemMessage(content=format_tools(self.tools)),
-            SystemMessage(content=self.format_message),
+            SystemMessage(content=format_tools(tools)),
+            SystemMessage(content=self.format_message if len(tools) > 1 else self.final_answer_format_message),
         ])
         prompt = ChatPromptTemplate.from_messages(messages=messages)
         agent_executor = SimpleAgent.from_llm_and_prompt(
-            llm=self.smart_llm,
+            llm=llm,
             prompt=prompt,
             output_parser=self.output_parser,
             stop_sequences=self.output_parser.stop_sequences,
-        ).get_executor(tools=self.tools, memory=short_term_memory, verbose=True)
+        ).get_executor(tools=tools, memory=short_term_memory, verbose=True)
+        get_tracer().attach(agent_executor)
         return agent_executor
 
+    async def _aload_context(self, user_id: int) -> Tuple[SavableWindowMemory, str, str, Optional[str]]:
+        # summary of the previous topic may still be in the ingestion queue, short-term memory and conversation
+        # summary are cleared when it is committed
+        await self.long_term_memory_queue.wait_for_user(user_id)
+        short_term_memory = self._load_short_term_memory(user_id=user_id)
+        conversation_summary = self._load_conversation_summary(user_id=user_id)
+        memory_about_user = self._load_memory_about_user(user_id=user_id)
+        if self.load_controller.level >= LoadLevel.NO_LTM:
+            return short_term_memory, conversation_summary, memory_about_user, None
+        # relevant memory is searched by the chat history, so it does not depend on the request,
+        # the query is embedded in a thread not to block other users while OpenAI is rate limited
+        relevant_ltm = await asyncio.to_thread(self._load_relevant_ltm, user_id, short_term_memory)
+        return short_term_memory, conversation_summary, memory_about_user, relevant_ltm
+
+    async def aprepare(self, user_id: int):
+        """Starts loading memory of the user before the request is known, e.g. while a voice message is
+        transcribed. The next arun of the user uses it."""
+        self._discard_prepared_context(user_id)
+        task = asyncio.create_task(self._aload_context(user_id))
+        # the task is not awaited if the request does not come, its error is reported by the request otherwise
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._prepared_contexts[user_id] = (time.monotonic(), task)
+
+    async def _aget_context(self, user_id: int) -> Tuple[SavableWindowMemory, str, str, Optional[str]]:
+        if (prepared := self._prepared_contexts.pop(user_id, None)) is not None:
+            prepared_at, task = prepared
+            # memory may have been changed since then, if the request did not come soon
+            if time.monotonic() - prepared_at < self.prepared_context_ttl:
+                return await task
+            task.cancel()
+        return await self._aload_context(user_id)
+
     async def arun(self, user_id: int, request: str) -> str:
+        # requests coming from TelegramBot are already traced by it
+        with get_tracer().trace(f"user {user_id}"), self.load_controller.track() as level:
+            return await self._arun(user_id, request, level)
+
+    async def _arun(self, user_id: int, request: str, level: LoadLevel) -> str:
         try:
-            short_term_memory = self._load_short_term_memory(user_id=user_id)
-            conversation_summary = self._load_conversation_summary(user_id=user_id)
-            memory_about_user = self._load_memory_about_user(user_id=user_id)
-            long_term_memory = self._load_long_term_memory(user_id=user_id)
+            short_term_memory, conversation_summary, memory_about_user, relevant_ltm = \
+                await self._aget_context(user_id)
             agent = self._initialise_agent(
-                user_id, short_term_memory, conversation_summary, memory_about_user, long_term_memory)
+                short_term_memory, conversation_summary, memory_about_user, relevant_ltm, level)
             answer = await agent.acall(inputs={"input": request}, return_only_outputs=True)
             if "new_topic_started" in answer and answer["new_topic_started"] and \
                     self._check_conversation_summary(user_id):
-                self._add_to_long_term_memory(user_id, conversation_summary)
-                self._clear_short_term_memory(short_term_memory)
-                self._clear_conversation_summary(user_id)
+                # summary of the previous topic is cleared only when it is saved to long-term memory,
+                # the next turn of the user waits for that
+                await self.long_term_memory_queue.put(
+                    user_id, conversation_summary, {"date": datetime.now().isoformat()},
+                    on_commit=functools.partial(self._start_new_topic, user_id, short_term_memory))
             elif "updated_conversation_summary" in answer:
                 self._update_conversation_summary(user_id=user_id, new_summary=answer["updated_conversation_summary"])
             if "updated_important_info" in answer:
@@ -239,6 +422,10 @@ class HelperAgent:
         except Exception as e:
             return f"Error in telegram bot: {e}. Report it to developer."
 
+    def _start_new_topic(self, user_id: int, short_term_memory: BaseChatMemory):
+        self._clear_short_term_memory(short_term_memory)
+        self._clear_conversation_summary(user_id)
+
     def _clear_conversation_summary(self, user_id: int):
         with self._get_memory_lock(user_id=user_id):
             conversation_summary_path = self._get_conversation_summary_path(user_id=user_id)
@@ -253,4 +440,4 @@ class HelperAgent:
         memory.save_context({"input": last_request}, {"raw_output": last_answer})
 
     async def after_message(self, user_id: int):
-        pass
+        self.active_users.add(user_id)
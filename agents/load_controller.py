@@ -0,0 +1,149 @@
+import contextlib
+import threading
+import time
+from collections import deque, Counter
+from enum import IntEnum
+from typing import Optional, Callable, Dict, Any, Iterator, Deque, Tuple
+
+from pydantic import BaseModel
+
+from agents.openai_scheduler import get_openai_scheduler
+
+
+class LoadLevel(IntEnum):
+    # every level also keeps degradations of the lower ones
+    FULL = 0
+    NO_LTM = 1
+    NO_WEB_SEARCH = 2
+    FAST_LLM = 3
+    TEXT_ONLY = 4
+
+
+class LoadControlPolicy(BaseModel):
+    # pressure is the largest of in-flight runs, queue depth and recent latency relative to these limits
+    max_in_flight: int = 20
+    max_queue_depth: int = 10
+    # seconds, mean latency of runs finished during the latency window, of runs started at the current level
+    target_latency: float = 30
+    latency_window: float = 60
+    # level goes one step up when pressure is at least 1, at most once per step_interval seconds,
+    # and right away up to the integer part of pressure
+    step_interval: float = 5
+    # and one step down when pressure stays below recover_pressure for recover_interval seconds
+    recover_pressure: float = 0.5
+    recover_interval: float = 30
+    max_level: LoadLevel = LoadLevel.TEXT_ONLY
+
+
+def get_interactive_queue_depth() -> int:
+    """Interactive requests of all models waiting in the OpenAIScheduler."""
+    return sum(model["queue_depth"].get("interactive", 0) for model in get_openai_scheduler().metrics().values())
+
+
+class LoadController:
+    """Degrades requests step by step when the agent is saturated, see LoadLevel, never without a policy.
+
+    The level is updated on start and end of every run, time without runs counts as calm for recovery.
+    """
+
+    def __init__(self, policy: Optional[LoadControlPolicy] = None,
+                 queue_depth: Callable[[], int] = get_interactive_queue_depth):
+        self.policy = policy
+        self.queue_depth = queue_depth
+        self.in_flight = 0
+        self.level_changes = 0
+        self.runs_at_level: Counter = Counter()
+        self._level = LoadLevel.FULL
+        # end time and latency of recent runs
+        self._latencies: Deque[Tuple[float, float]] = deque()
+        self._changed_at = float("-inf")
+        # since when pressure is below recover_pressure
+        self._calm_since: Optional[float] = None
+        # since when nothing runs
+        self._idle_since: Optional[float] = None
+        self._pressure = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def level(self) -> LoadLevel:
+        return self._level
+
+    def _recent_latency(self, now: float) -> float:
+        while self._latencies and self._latencies[0][0] < now - self.policy.latency_window:
+            self._latencies.popleft()
+        # runs started before the level changed do not show how the current level copes
+        latencies = [latency for end, latency in self._latencies if end - latency >= self._changed_at]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def update(self, now: Optional[float] = None) -> LoadLevel:
+        if self.policy is None:
+            return self._level
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._pressure = max(self.in_flight / self.policy.max_in_flight,
+                                 self.queue_depth() / self.policy.max_queue_depth,
+                                 self._recent_latency(now) / self.policy.target_latency)
+            level = self._level
+            if self._pressure >= 1:
+                self._calm_since = None
+                if now - self._changed_at >= self.policy.step_interval:
+                    level += 1
+                # a spike is not waited out: pressure n means at least level n
+                level = min(max(level, int(self._pressure)), self.policy.max_level)
+            elif self._pressure < self.policy.recover_pressure:
+                if self._calm_since is None:
+                    self._calm_since = now if self._idle_since is None else self._idle_since
+                # one step per recover_interval, several if the level was not updated for long
+                steps = int((now - max(self._calm_since, self._changed_at)) // self.policy.recover_interval)
+                if steps > 0:
+                    level = max(level - steps, LoadLevel.FULL)
+                    self._calm_since = now
+            else:
+                self._calm_since = None
+            if level != self._level:
+                print(f"Load pressure {self._pressure:.2f}, level {self._level.name} -> {LoadLevel(level).name}")
+                self._level = LoadLevel(level)
+                self._changed_at = now
+                self.level_changes += 1
+            return self._level
+
+    def start_run(self, now: Optional[float] = None) -> LoadLevel:
+        with self._lock:
+            self.in_flight += 1
+        level = self.update(now)
+        with self._lock:
+            self._idle_since = None
+        self.runs_at_level[level.name.lower()] += 1
+        return level
+
+    def end_run(self, latency: float, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.in_flight -= 1
+            self._latencies.append((now, latency))
+            if self.in_flight == 0:
+                self._idle_since = now
+        self.update(now)
+
+    @contextlib.contextmanager
+    def track(self) -> Iterator[LoadLevel]:
+        """Counts the run as in flight and its latency, yields the level the run is served at."""
+        start = time.monotonic()
+        level = self.start_run()
+        try:
+            yield level
+        finally:
+            self.end_run(time.monotonic() - start)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "level": int(self._level),
+                "level_name": self._level.name.lower(),
+                "pressure": self._pressure,
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth(),
+                "recent_latency": self._recent_latency(time.monotonic()) if self.policy is not None else 0.0,
+                "level_changes": self.level_changes,
+                "runs_at_level": dict(self.runs_at_level),
+            }
@@ -0,0 +1,366 @@
+import json
+import math
+import mmap
+import os
+from typing import List, Dict, Any, Optional, Callable, Union, Iterator, Iterable
+
+import faiss
+import numpy as np
+from langchain import FAISS
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from pydantic import BaseModel
+
+INDEX_TYPES = ["flat", "hnsw", "ivfpq"]
+
+
+class LongTermMemoryIndexPolicy(BaseModel):
+    """Chooses FAISS index type by number of memories: exact search is the fastest for small users,
+    graph search for medium ones and compressed inverted lists for heavy users."""
+    hnsw_min_entries: int = 2000
+    ivfpq_min_entries: int = 20000
+    hnsw_m: int = 32
+    hnsw_ef_construction: int = 80
+    hnsw_ef_search: int = 64
+    ivf_nprobe: int = 16
+    ivf_max_training_entries: int = 65536
+    # PQ distances are approximate, so IVF-PQ candidates are re-ranked by exact distances on raw vectors
+    ivf_rerank_factor: int = 32
+    pq_subquantizers: int = 64
+    # rebuild IVF index when memories grew that much since training, so lists stay balanced
+    ivf_rebuild_growth: float = 2.0
+    forced_index_type: Optional[str] = None
+
+    def choose_index_type(self, n_entries: int) -> str:
+        if self.forced_index_type is not None:
+            return self.forced_index_type
+        if n_entries >= self.ivfpq_min_entries:
+            return "ivfpq"
+        if n_entries >= self.hnsw_min_entries:
+            return "hnsw"
+        return "flat"
+
+    def _get_pq_subquantizers(self, dim: int) -> int:
+        # 4-bit fast-scan codes are packed in pairs
+        return max(m for m in range(2, min(self.pq_subquantizers, dim) + 1, 2) if dim % m == 0)
+
+    def get_factory_string(self, index_type: str, n_entries: int, dim: int) -> str:
+        if index_type == "flat":
+            return "Flat"
+        if index_type == "hnsw":
+            return f"HNSW{self.hnsw_m}"
+        if index_type == "ivfpq":
+            n_lists = max(1, min(int(math.sqrt(n_entries)), n_entries // 39))
+            # 4-bit fast-scan PQ trains in seconds, 8-bit PQ training takes minutes on a single core
+            return f"IVF{n_lists},PQ{self._get_pq_subquantizers(dim)}x4fs"
+        raise ValueError(f"Unknown index type {index_type}, expected one of {INDEX_TYPES}")
+
+    def build_index(self, index_type: str, vectors: np.ndarray) -> faiss.Index:
+        n_entries, dim = vectors.shape
+        index = faiss.index_factory(dim, self.get_factory_string(index_type, n_entries, dim))
+        if index_type == "hnsw":
+            index.hnsw.efConstruction = self.hnsw_ef_construction
+        if not index.is_trained:
+            training_vectors = vectors
+            if n_entries > self.ivf_max_training_entries:
+                sample = np.random.default_rng(0).choice(n_entries, self.ivf_max_training_entries, replace=False)
+                training_vectors = vectors[np.sort(sample)]
+            index.train(training_vectors)
+        index.add(vectors)
+        self.set_search_parameters(index_type, index)
+        return index
+
+    def set_search_parameters(self, index_type: str, index: faiss.Index):
+        if index_type == "hnsw":
+            faiss.ParameterSpace().set_index_parameter(index, "efSearch", self.hnsw_ef_search)
+        elif index_type == "ivfpq":
+            faiss.ParameterSpace().set_index_parameter(index, "nprobe", self.ivf_nprobe)
+
+    def needs_rebuild(self, index_type: str, built_for: int, n_entries: int) -> bool:
+        if self.choose_index_type(n_entries) != index_type:
+            return True
+        return index_type == "ivfpq" and n_entries >= built_for * self.ivf_rebuild_growth
+
+
+def _atomic_write(path: str, write: Callable[[str], None]):
+    # other processes may have the old file memory-mapped, so it is replaced instead of being rewritten in place
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _save_array(path: str, array: np.ndarray):
+    def write(tmp_path: str):
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+    _atomic_write(path, write)
+
+
+class MappedDocstore:
+    """Documents as concatenated JSON records (docstore.bin) with their start offsets (docstore_offsets.npy).
+
+    Both files are memory-mapped, so opening does not depend on the number of documents,
+    and only the records that are actually read are paged in.
+    """
+    data_file_name = "docstore.bin"
+    offsets_file_name = "docstore_offsets.npy"
+
+    def __init__(self, folder_path: str, use_mmap: bool = True, open_existing: bool = True,
+                 count: Optional[int] = None):
+        self.folder_path = folder_path
+        self.use_mmap = use_mmap
+        self._offsets: Optional[np.ndarray] = None
+        self._data: Union[bytes, mmap.mmap] = b""
+        self._new_documents: List[Document] = []
+        if open_existing:
+            self._open(count)
+
+    @classmethod
+    def exists(cls, folder_path: str) -> bool:
+        return os.path.exists(os.path.join(folder_path, cls.offsets_file_name))
+
+    def _open(self, count: Optional[int] = None):
+        # records are only appended, so the first `count` of a newer version are the same
+        if not self.exists(self.folder_path):
+            return
+        self._offsets = np.load(
+            os.path.join(self.folder_path, self.offsets_file_name), mmap_mode="r" if self.use_mmap else None)
+        if count is not None:
+            self._offsets = self._offsets[:count + 1]
+        with open(os.path.join(self.folder_path, self.data_file_name), "rb") as f:
+            if self.use_mmap and self._offsets[-1] > 0:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._data = f.read()
+
+    @property
+    def _saved_count(self) -> int:
+        return 0 if self._offsets is None else len(self._offsets) - 1
+
+    def __len__(self) -> int:
+        return self._saved_count + len(self._new_documents)
+
+    def __getitem__(self, i: int) -> Document:
+        if i >= self._saved_count:
+            return self._new_documents[i - self._saved_count]
+        return Document(**json.loads(self._data[self._offsets[i]:self._offsets[i + 1]]))
+
+    def __iter__(self) -> Iterator[Document]:
+        return (self[i] for i in range(len(self)))
+
+    def extend(self, documents: Iterable[Document]):
+        self._new_documents.extend(documents)
+
+    def save(self):
+        if not self._new_documents:
+            return
+        records = [json.dumps(document.dict()).encode() for document in self._new_documents]
+        data_path = os.path.join(self.folder_path, self.data_file_name)
+        if self._offsets is None:
+            start = 0
+            _atomic_write(data_path, lambda tmp_path: open(tmp_path, "wb").close())
+        else:
+            # old records stay in place, so processes that mapped the previous version still read valid data
+            start = os.path.getsize(data_path)
+        with open(data_path, "ab") as f:
+            f.write(b"".join(records))
+        new_offsets = start + np.cumsum([0] + [len(record) for record in records], dtype=np.int64)
+        offsets = new_offsets if self._offsets is None else np.concatenate([self._offsets, new_offsets[1:]])
+        _save_array(os.path.join(self.folder_path, self.offsets_file_name), offsets)
+        self._new_documents = []
+        self._open()
+
+    def size_in_ram(self) -> int:
+        new_documents_size = sum(len(json.dumps(document.dict())) for document in self._new_documents)
+        if self.use_mmap or self._offsets is None:
+            return new_documents_size
+        return len(self._data) + self._offsets.nbytes + new_documents_size
+
+
+class LongTermMemory:
+    """Per-user store of conversation summaries.
+
+    Folder layout:
+    - index.faiss - FAISS index of the type chosen by LongTermMemoryIndexPolicy, absent for flat search
+    - vectors.npy - raw embeddings, searched directly by flat search, used to rebuild the index when its type
+      changes and to re-rank IVF-PQ results
+    - docstore.bin, docstore_offsets.npy - summaries with metadata in index order, see MappedDocstore
+    - meta.json - index type, number of memories it was built for and number of saved memories, written last:
+      files of a save cut off halfway, or of a save running in another process, are read only up to that number
+
+    By default vectors, docstore and IVF inverted lists are memory-mapped: load time does not depend on the number
+    of memories, and worker processes serving the same user share the pages through the OS cache.
+    """
+    index_file_name = "index.faiss"
+    vectors_file_name = "vectors.npy"
+    meta_file_name = "meta.json"
+
+    def __init__(self, folder_path: str, embeddings: Embeddings, policy: LongTermMemoryIndexPolicy,
+                 index: Optional[faiss.Index], docstore: MappedDocstore, index_type: str, built_for: int,
+                 use_mmap: bool = True):
+        self.folder_path = folder_path
+        self.embeddings = embeddings
+        self.policy = policy
+        self.index = index
+        self.docstore = docstore
+        self.index_type = index_type
+        self.built_for = built_for
+        self.use_mmap = use_mmap
+        self._saved_vectors: Optional[np.ndarray] = None
+        self._new_vectors: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return len(self.docstore)
+
+    @staticmethod
+    def _to_array(vectors: List[List[float]]) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32)
+
+    @staticmethod
+    def _to_documents(texts: List[str], metadatas: Optional[List[Dict[str, Any]]]) -> List[Document]:
+        metadatas = metadatas or [{} for _ in texts]
+        return [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
+
+    def _build_index(self, vectors: np.ndarray) -> Optional[faiss.Index]:
+        return None if self.index_type == "flat" else self.policy.build_index(self.index_type, vectors)
+
+    @classmethod
+    def from_texts(cls, folder_path: str, texts: List[str], embeddings: Embeddings,
+                   policy: LongTermMemoryIndexPolicy, metadatas: Optional[List[Dict[str, Any]]] = None
+                   ) -> "LongTermMemory":
+        vectors = cls._to_array(embeddings.embed_documents(texts))
+        return cls.from_vectors(folder_path, vectors, texts, embeddings, policy, metadatas)
+
+    @classmethod
+    def from_vectors(cls, folder_path: str, vectors: np.ndarray, texts: List[str], embeddings: Embeddings,
+                     policy: LongTermMemoryIndexPolicy, metadatas: Optional[List[Dict[str, Any]]] = None
+                     ) -> "LongTermMemory":
+        docstore = MappedDocstore(folder_path, open_existing=False)
+        docstore.extend(cls._to_documents(texts, metadatas))
+        memory = cls(folder_path, embeddings, policy, None, docstore, policy.choose_index_type(len(texts)), len(texts))
+        memory.index = memory._build_index(vectors)
+        memory._new_vectors.append(vectors)
+        return memory
+
+    @classmethod
+    def exists(cls, folder_path: str) -> bool:
+        return os.path.exists(os.path.join(folder_path, cls.meta_file_name)) or \
+            os.path.exists(os.path.join(folder_path, "index.pkl"))
+
+    @classmethod
+    def load(cls, folder_path: str, embeddings: Embeddings, policy: LongTermMemoryIndexPolicy,
+             use_mmap: bool = True) -> "LongTermMemory":
+        if not os.path.exists(os.path.join(folder_path, cls.meta_file_name)):
+            return cls._load_legacy(folder_path, embeddings, policy)
+        with open(os.path.join(folder_path, cls.meta_file_name), "r") as f:
+            meta = json.load(f)
+        count = meta.get("count")
+        index = None
+        if meta["index_type"] != "flat":
+            index = faiss.read_index(
+                os.path.join(folder_path, cls.index_file_name), faiss.IO_FLAG_MMAP if use_mmap else 0)
+            policy.set_search_parameters(meta["index_type"], index)
+        memory = cls(folder_path, embeddings, policy, index,
+                     MappedDocstore(folder_path, use_mmap=use_mmap, count=count),
+                     meta["index_type"], meta["built_for"], use_mmap=use_mmap)
+        # vectors are opened with the docstore and the index, so all of them are of the same version of the folder,
+        # even if consolidation or import replaces it before the first search
+        if memory._get_saved_vectors() is not None and count is not None:
+            memory._saved_vectors = memory._saved_vectors[:count]
+        return memory
+
+    @classmethod
+    def _load_legacy(cls, folder_path: str, embeddings: Embeddings, policy: LongTermMemoryIndexPolicy
+                     ) -> "LongTermMemory":
+        # memories saved with langchain FAISS.save_local: flat index plus pickled docstore
+        legacy = FAISS.load_local(folder_path, embeddings)
+        vectors = legacy.index.reconstruct_n(0, legacy.index.ntotal)
+        documents = [legacy.docstore.search(legacy.index_to_docstore_id[i]) for i in range(legacy.index.ntotal)]
+        memory = cls.from_vectors(
+            folder_path, vectors, [document.page_content for document in documents], embeddings, policy,
+            [document.metadata for document in documents]
+        )
+        # legacy files are removed only when the new format is saved, so a failed save loses nothing
+        memory.save()
+        os.remove(os.path.join(folder_path, "index.pkl"))
+        return memory
+
+    def _get_saved_vectors(self) -> Optional[np.ndarray]:
+        saved_vectors_path = os.path.join(self.folder_path, self.vectors_file_name)
+        if self._saved_vectors is None and os.path.exists(saved_vectors_path):
+            self._saved_vectors = np.load(saved_vectors_path, mmap_mode="r" if self.use_mmap else None)
+        return self._saved_vectors
+
+    def _load_vectors(self) -> np.ndarray:
+        saved_vectors = self._get_saved_vectors()
+        if not self._new_vectors:
+            return saved_vectors
+        return np.concatenate(([] if saved_vectors is None else [saved_vectors]) + self._new_vectors)
+
+    def add_texts(self, texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None):
+        self.add_vectors(self._to_array(self.embeddings.embed_documents(texts)), texts, metadatas)
+
+    def add_vectors(self, vectors: np.ndarray, texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None):
+        self.docstore.extend(self._to_documents(texts, metadatas))
+        self._new_vectors.append(vectors)
+        if self.policy.needs_rebuild(self.index_type, self.built_for, len(self)):
+            self.index_type = self.policy.choose_index_type(len(self))
+            self.index = self._build_index(self._load_vectors())
+            self.built_for = len(self)
+        elif self.index is not None:
+            self.index.add(vectors)
+
+    @staticmethod
+    def _nearest(vectors: np.ndarray, query_vector: np.ndarray, k: int) -> np.ndarray:
+        # squared L2 distance without materialising (vectors - query), which would copy the whole mapped file
+        distances = np.einsum("ij,ij->i", vectors, vectors) - 2 * (vectors @ query_vector)
+        nearest = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+        return nearest[np.argsort(distances[nearest])]
+
+    def _rerank(self, query_vector: np.ndarray, candidates: np.ndarray, k: int) -> List[int]:
+        # memory mapping reads from disk only the rows of the candidates
+        candidates = np.sort(candidates[(candidates >= 0) & (candidates < len(self))])
+        return candidates[self._nearest(self._load_vectors()[candidates], query_vector, k)].tolist()
+
+    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+        k = min(k, len(self))
+        if k == 0:
+            return []
+        query_vector = self._to_array([self.embeddings.embed_query(query)])
+        if self.index_type == "flat":
+            indices = self._nearest(self._load_vectors(), query_vector[0], k).tolist()
+        elif self.index_type == "ivfpq":
+            _, candidates = self.index.search(query_vector, min(k * self.policy.ivf_rerank_factor, len(self)))
+            indices = self._rerank(query_vector[0], candidates[0], k)
+        else:
+            _, candidates = self.index.search(query_vector, k)
+            # the index may be saved by a newer version than meta.json, with memories this one does not have
+            indices = [i for i in candidates[0] if 0 <= i < len(self)]
+        return [self.docstore[i] for i in indices]
+
+    def size_in_ram(self) -> int:
+        """Bytes held in process memory, not counting pages mapped from the OS cache."""
+        index_size = 0 if self.index is None else faiss.serialize_index(self.index).nbytes
+        vectors_size = sum(vectors.nbytes for vectors in self._new_vectors)
+        if not self.use_mmap and self._saved_vectors is not None:
+            vectors_size += self._saved_vectors.nbytes
+        return index_size + vectors_size + self.docstore.size_in_ram()
+
+    def save(self):
+        os.makedirs(self.folder_path, exist_ok=True)
+        if self._new_vectors:
+            _save_array(os.path.join(self.folder_path, self.vectors_file_name), self._load_vectors())
+            self._saved_vectors = None
+            self._new_vectors = []
+        index_path = os.path.join(self.folder_path, self.index_file_name)
+        if self.index is not None:
+            _atomic_write(index_path, lambda tmp_path: faiss.write_index(self.index, tmp_path))
+        elif os.path.exists(index_path):
+            os.remove(index_path)
+        self.docstore.save()
+        meta = {"index_type": self.index_type, "built_for": self.built_for, "count": len(self)}
+
+        def write_meta(tmp_path: str):
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f)
+        _atomic_write(os.path.join(self.folder_path, self.meta_file_name), write_meta)
@@ -0,0 +1,183 @@
+import asyncio
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Any, List, Optional, Set
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+# commit(user_id, vectors, texts, metadatas, is_discarded) adds embedded memories to the user's long-term memory.
+# It checks is_discarded() under the lock of the user memory, and returns False if memories were discarded
+CommitFunction = Callable[[int, np.ndarray, List[str], List[Dict[str, Any]], Callable[[], bool]], bool]
+
+
+@dataclass
+class _PendingMemory:
+    item_id: int
+    user_id: int
+    text: str
+    metadata: Dict[str, Any]
+    done: asyncio.Future = field(repr=False)
+    on_commit: Optional[Callable[[], None]] = field(default=None, repr=False)
+    attempts: int = 0
+
+
+class LongTermMemoryIngestionQueue:
+    """Collects new long-term memories of all users and embeds them with batched embed_documents calls.
+
+    A batch is sent when it reaches `batch_size` memories, when the oldest memory waited `max_delay` seconds
+    or right away while somebody waits for memories to be committed.
+    Embedding and committing run in worker threads, so they never block the event loop.
+    Reads are consistent for the owning user: `wait_for_user` returns when all memories put by that user
+    are committed. Failed memories are retried `max_attempts` times with exponential backoff.
+    """
+
+    def __init__(self, embeddings: Embeddings, commit: CommitFunction, batch_size: int = 16, max_delay: float = 1.0,
+                 max_attempts: int = 4, retry_delay: float = 1.0):
+        self.embeddings = embeddings
+        self.commit = commit
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.embedding_calls = 0
+        self.embedded_texts = 0
+        self.committed_memories = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # set while somebody waits in wait_for_user or flush
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._waiters = 0
+        self._pending: Dict[int, Set[asyncio.Future]] = defaultdict(set)
+        # memories of a user with item_id below the watermark are dropped instead of committed
+        self._discard_watermarks: Dict[int, int] = {}
+        self._next_item_id = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(futures) for futures in self._pending.values())
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            self._queue = asyncio.Queue()
+            self._flush_requested = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, user_id: int, text: str, metadata: Dict[str, Any],
+                  on_commit: Optional[Callable[[], None]] = None):
+        """on_commit is called from a worker thread when the memory is committed, not if it failed or was discarded."""
+        self._ensure_started()
+        done = asyncio.get_running_loop().create_future()
+        self._pending[user_id].add(done)
+        done.add_done_callback(lambda future: self._pending[user_id].discard(future))
+        await self._queue.put(_PendingMemory(self._next_item_id, user_id, text, metadata, done, on_commit))
+        self._next_item_id += 1
+
+    async def _wait(self, futures: List[asyncio.Future]):
+        # the next turn of a user waits for its memories, so they are not kept for max_delay
+        self._waiters += 1
+        self._flush_requested.set()
+        try:
+            await asyncio.gather(*futures, return_exceptions=True)
+        finally:
+            self._waiters -= 1
+            if self._waiters == 0:
+                self._flush_requested.clear()
+
+    async def wait_for_user(self, user_id: int):
+        if self._pending.get(user_id):
+            await self._wait(list(self._pending[user_id]))
+
+    async def flush(self):
+        if futures := [future for futures in self._pending.values() for future in futures]:
+            await self._wait(futures)
+
+    def discard_user(self, user_id: int):
+        """Memories of the user that are not committed yet will be dropped (used when user asks to forget)."""
+        self._discard_watermarks[user_id] = self._next_item_id
+
+    def _is_discarded(self, memory: _PendingMemory) -> bool:
+        return memory.item_id < self._discard_watermarks.get(memory.user_id, 0)
+
+    async def close(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _collect_batch(self) -> List[_PendingMemory]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while len(batch) < self.batch_size and not self._flush_requested.is_set():
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            get = asyncio.ensure_future(self._queue.get())
+            flush_requested = asyncio.ensure_future(self._flush_requested.wait())
+            done, _ = await asyncio.wait([get, flush_requested], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            flush_requested.cancel()
+            if get not in done:
+                get.cancel()
+                break
+            batch.append(get.result())
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    def _embed_and_commit(self, batch: List[_PendingMemory]) -> Dict[int, Exception]:
+        """Errors of memories that were not committed by item_id, raises if the batch was not embedded."""
+        vectors = np.asarray(self.embeddings.embed_documents([memory.text for memory in batch]), dtype=np.float32)
+        self.embedding_calls += 1
+        self.embedded_texts += len(batch)
+        batch_indices_by_user = defaultdict(list)
+        for i, memory in enumerate(batch):
+            batch_indices_by_user[memory.user_id].append(i)
+        errors, committed = {}, []
+        for user_id, indices in batch_indices_by_user.items():
+            # user may ask to forget while the batch is embedded or right before the commit, so it is checked by
+            # the commit under the lock of the user memory, which forget holds too
+            def is_discarded(indices=indices) -> bool:
+                return any(self._is_discarded(batch[i]) for i in indices)
+
+            try:
+                if self.commit(user_id, vectors[indices], [batch[i].text for i in indices],
+                               [batch[i].metadata for i in indices], is_discarded):
+                    self.committed_memories += len(indices)
+                    committed.extend(batch[i] for i in indices)
+            except Exception as e:
+                errors.update({batch[i].item_id: e for i in indices})
+        for memory in committed:
+            if memory.on_commit is not None:
+                try:
+                    memory.on_commit()
+                except Exception as e:
+                    print(f"Callback of a committed memory of user {memory.user_id} failed: {e}")
+        return errors
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            kept_batch = [memory for memory in batch if not self._is_discarded(memory)]
+            for memory in kept_batch:
+                memory.attempts += 1
+            try:
+                errors = await asyncio.to_thread(self._embed_and_commit, kept_batch) if kept_batch else {}
+            except Exception as e:
+                errors = {memory.item_id: e for memory in kept_batch}
+            for memory in batch:
+                if (error := errors.get(memory.item_id)) is not None:
+                    if memory.attempts < self.max_attempts:
+                        delay = self.retry_delay * 2 ** (memory.attempts - 1)
+                        print(f"Failed to add a memory to long-term memory of user {memory.user_id}: {error}, "
+                              f"retry in {delay:g}s")
+                        # it stays pending, so the next turn of the user still waits for it
+                        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, memory)
+                        continue
+                    print(f"Failed to add a memory to long-term memory of user {memory.user_id} "
+                          f"after {memory.attempts} attempts: {error}")
+                if not memory.done.done():
+                    memory.done.set_result(None)
@@ -0,0 +1,311 @@
+import asyncio
+import os
+import shutil
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple, Iterable
+
+import numpy as np
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import SystemMessage, HumanMessage, Document
+from pydantic import BaseModel
+
+from agents.helper_agent import HelperAgent
+from agents.long_term_memory import LongTermMemory
+from agents.openai_scheduler import estimate_tokens
+from agents.utils import format_now
+
+
+class MemoryConsolidationPolicy(BaseModel):
+    # summaries that similar are the same topic told twice, the most recent one is kept
+    duplicate_similarity: float = 0.95
+    # summaries that similar are related topics, they are merged into one summary by LLM
+    merge_similarity: float = 0.85
+    max_group_size: int = 8
+    min_memories: int = 2
+    # rows of the similarity matrix computed at once, bounds RAM of the pairwise comparison
+    similarity_block_size: int = 1024
+
+
+class ConsolidationBudget(BaseModel):
+    """Limits of one consolidation run over all users, so it does not compete with replies to users."""
+    max_llm_calls: int = 50
+    max_llm_tokens: int = 100000
+    max_embedded_texts: int = 200
+    max_io_bytes: int = 1024 ** 3
+    # throttles reading and writing of memory files, None for no throttling
+    io_bytes_per_second: Optional[float] = 50 * 1024 ** 2
+
+
+@dataclass
+class ConsolidationReport:
+    user_id: int
+    memories_before: int = 0
+    memories_after: int = 0
+    duplicates_removed: int = 0
+    memories_merged: int = 0
+    ltm_bytes_before: int = 0
+    ltm_bytes_after: int = 0
+    important_info_tokens_before: int = 0
+    important_info_tokens_after: int = 0
+    llm_calls: int = 0
+    skipped: Optional[str] = None
+
+    @property
+    def prompt_tokens_saved_per_turn(self) -> int:
+        # important info is a part of every HelperAgent prompt
+        return self.important_info_tokens_before - self.important_info_tokens_after
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**asdict(self), "prompt_tokens_saved_per_turn": self.prompt_tokens_saved_per_turn}
+
+    def format(self) -> str:
+        result = f"User {self.user_id}: memories {self.memories_before} -> {self.memories_after} " \
+                 f"({self.duplicates_removed} duplicates removed, {self.memories_merged} merged), " \
+                 f"long-term memory {self.ltm_bytes_before / 1024:.1f}KB -> {self.ltm_bytes_after / 1024:.1f}KB, " \
+                 f"important info {self.important_info_tokens_before} -> {self.important_info_tokens_after} tokens, " \
+                 f"{self.prompt_tokens_saved_per_turn} prompt tokens saved per turn"
+        if self.skipped:
+            result += f", skipped: {self.skipped}"
+        return result
+
+
+# position of the newest source memory (to keep chronological order), vector or None if it has to be embedded,
+# text and metadata
+_ConsolidatedMemory = Tuple[int, Optional[np.ndarray], str, Dict[str, Any]]
+
+
+def _get_folder_size(folder_path: str) -> int:
+    if not os.path.isdir(folder_path):
+        return 0
+    return sum(os.path.getsize(os.path.join(folder_path, name)) for name in os.listdir(folder_path))
+
+
+def _same_document(first: Document, second: Document) -> bool:
+    return first.page_content == second.page_content and first.metadata == second.metadata
+
+
+class MemoryConsolidator:
+    """Bounds per-user memory of HelperAgent: collapses near-duplicate long-term memories, merges related ones
+    with LLM, removes expired facts from important info and rebuilds long-term memory index from scratch.
+
+    Consolidation reads a snapshot of user memory without holding the user lock and only swaps the result in
+    under the lock, so it can run in background of the bot. If the user asked to forget or important info
+    was updated meanwhile, the result is dropped; memories added meanwhile are carried over.
+    """
+
+    def __init__(self, agent: HelperAgent, prompts: Dict[str, str], llm: Optional[BaseChatModel] = None,
+                 policy: Optional[MemoryConsolidationPolicy] = None, budget: Optional[ConsolidationBudget] = None):
+        self.agent = agent
+        self.prompts = prompts
+        self.llm = llm or agent.fast_llm
+        self.policy = policy or MemoryConsolidationPolicy()
+        self.budget = budget or ConsolidationBudget()
+        self._reset_budget()
+
+    def _reset_budget(self):
+        self.llm_calls = 0
+        self.llm_tokens = 0
+        self.embedded_texts = 0
+        self.io_bytes = 0
+
+    def _can_call_llm(self, prompt: str) -> bool:
+        return self.llm_calls < self.budget.max_llm_calls and \
+            self.llm_tokens + 2 * estimate_tokens(prompt) <= self.budget.max_llm_tokens
+
+    def _call_llm(self, instructions: str, prompt: str, report: ConsolidationReport) -> str:
+        answer = self.llm.predict_messages([SystemMessage(content=instructions), HumanMessage(content=prompt)])
+        self.llm_calls += 1
+        self.llm_tokens += estimate_tokens(prompt) + estimate_tokens(answer.content)
+        report.llm_calls += 1
+        return answer.content.strip()
+
+    def _spend_io(self, n_bytes: int):
+        self.io_bytes += n_bytes
+        if self.budget.io_bytes_per_second:
+            time.sleep(n_bytes / self.budget.io_bytes_per_second)
+
+    def find_groups(self, vectors: np.ndarray) -> List[List[int]]:
+        """Greedy clustering in chronological order: every not yet grouped memory takes its most similar
+        not grouped memories above merge_similarity. Pairwise comparison is quadratic, computed by blocks."""
+        norms = np.linalg.norm(vectors, axis=1)
+        normalized = vectors / np.where(norms > 0, norms, 1)[:, None]
+        grouped = np.zeros(len(vectors), dtype=bool)
+        groups = []
+        for start in range(0, len(vectors), self.policy.similarity_block_size):
+            similarities = normalized[start:start + self.policy.similarity_block_size] @ normalized.T
+            for row, i in enumerate(range(start, start + len(similarities))):
+                if grouped[i]:
+                    continue
+                grouped[i] = True
+                candidates = np.flatnonzero((similarities[row] >= self.policy.merge_similarity) & ~grouped)
+                candidates = candidates[np.argsort(-similarities[row, candidates], kind="stable")]
+                group = [i] + candidates[:self.policy.max_group_size - 1].tolist()
+                grouped[group] = True
+                groups.append(sorted(group))
+        return groups
+
+    def _consolidate_group(
+            self, group: List[int], vectors: np.ndarray, documents: List[Document], report: ConsolidationReport
+    ) -> List[_ConsolidatedMemory]:
+        group_vectors = vectors[group] / np.maximum(np.linalg.norm(vectors[group], axis=1, keepdims=True), 1e-12)
+        similarities = group_vectors @ group_vectors[0]
+        # the most recent of duplicates is kept, it has the latest date
+        duplicates = [j for j, similarity in zip(group, similarities) if similarity >= self.policy.duplicate_similarity]
+        kept = sorted([j for j in group if j not in duplicates] + duplicates[-1:])
+        report.duplicates_removed += len(duplicates) - 1
+        if len(kept) > 1:
+            prompt = "\n\n".join(
+                f"{documents[j].metadata.get('date', 'unknown date')[:10]}:\n{documents[j].page_content}" for j in kept)
+            # without API budget related memories are kept as they are
+            if self._can_call_llm(prompt) and self.embedded_texts < self.budget.max_embedded_texts:
+                merged = self._call_llm(self.prompts["merge_summaries"], prompt, report)
+                self.embedded_texts += 1
+                report.memories_merged += len(kept)
+                metadata = dict(documents[kept[-1]].metadata)
+                metadata["merged_from"] = sum(documents[j].metadata.get("merged_from", 1) for j in kept)
+                return [(kept[-1], None, merged, metadata)]
+        return [(j, vectors[j], documents[j].page_content, documents[j].metadata) for j in kept]
+
+    def _consolidate_memories(self, memory: LongTermMemory, report: ConsolidationReport
+                              ) -> Tuple[np.ndarray, List[str], List[Dict[str, Any]]]:
+        vectors = np.asarray(memory._load_vectors())
+        documents = list(memory.docstore)
+        consolidated = []
+        for group in self.find_groups(vectors):
+            consolidated.extend(self._consolidate_group(group, vectors, documents, report))
+        consolidated.sort(key=lambda memory_entry: memory_entry[0])
+        to_embed = [i for i, (_, vector, _, _) in enumerate(consolidated) if vector is None]
+        new_vectors = np.zeros((len(consolidated), vectors.shape[1]), dtype=np.float32)
+        for i, (_, vector, _, _) in enumerate(consolidated):
+            if vector is not None:
+                new_vectors[i] = vector
+        if to_embed:
+            new_vectors[to_embed] = self.agent.long_term_memory_embeddings.embed_documents(
+                [consolidated[i][2] for i in to_embed])
+        return new_vectors, [entry[2] for entry in consolidated], [entry[3] for entry in consolidated]
+
+    def _swap_long_term_memory(self, user_id: int, snapshot_size: int, snapshot_last: Document,
+                               vectors: np.ndarray, texts: List[str], metadatas: List[Dict[str, Any]]
+                               ) -> Optional[int]:
+        """Returns number of memories after the swap or None if memory of the user was forgotten meanwhile."""
+        ltm_path = self.agent._get_user_ltm_path(user_id=user_id)
+        new_path, old_path = f"{ltm_path}.consolidated", f"{ltm_path}.old"
+        for path in [new_path, old_path]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        # index is built outside of the lock, it may take a while for big memories
+        new_memory = LongTermMemory.from_vectors(
+            new_path, vectors, texts, self.agent.long_term_memory_embeddings, self.agent.long_term_memory_policy,
+            metadatas)
+        new_memory.save()
+        with self.agent._get_memory_lock(user_id=user_id):
+            current = self.agent._read_long_term_memory(user_id=user_id)
+            if current is None or len(current) < snapshot_size or \
+                    not _same_document(current.docstore[snapshot_size - 1], snapshot_last):
+                # user asked to forget during consolidation
+                shutil.rmtree(new_path)
+                return None
+            if len(current) > snapshot_size:
+                added = range(snapshot_size, len(current))
+                new_memory.add_vectors(
+                    np.asarray(current._load_vectors()[snapshot_size:]),
+                    [current.docstore[i].page_content for i in added], [current.docstore[i].metadata for i in added])
+                new_memory.save()
+            # processes that have the old files mapped keep reading them until they reload memory
+            os.replace(ltm_path, old_path)
+            os.replace(new_path, ltm_path)
+        shutil.rmtree(old_path)
+        return len(new_memory)
+
+    def consolidate_long_term_memory(self, user_id: int, report: ConsolidationReport):
+        ltm_path = self.agent._get_user_ltm_path(user_id=user_id)
+        report.ltm_bytes_before = report.ltm_bytes_after = _get_folder_size(ltm_path)
+        memory = self.agent._load_long_term_memory(user_id=user_id)
+        if memory is None:
+            return
+        report.memories_before = report.memories_after = len(memory)
+        if len(memory) < self.policy.min_memories:
+            return
+        # files are read once and written once
+        if self.io_bytes + 2 * report.ltm_bytes_before > self.budget.max_io_bytes:
+            report.skipped = "out of I/O budget"
+            return
+        snapshot_size, snapshot_last = len(memory), memory.docstore[len(memory) - 1]
+        self._spend_io(report.ltm_bytes_before)
+        vectors, texts, metadatas = self._consolidate_memories(memory, report)
+        if len(texts) == snapshot_size:
+            return
+        memories_after = self._swap_long_term_memory(user_id, snapshot_size, snapshot_last, vectors, texts, metadatas)
+        if memories_after is None:
+            report.skipped = "memory changed during consolidation"
+            return
+        report.memories_after = memories_after
+        report.ltm_bytes_after = _get_folder_size(ltm_path)
+        self._spend_io(report.ltm_bytes_after)
+
+    def consolidate_important_info(self, user_id: int, report: ConsolidationReport):
+        if not os.path.exists(self.agent._get_memory_about_user_path(user_id=user_id)):
+            return
+        important_info = self.agent._load_memory_about_user(user_id=user_id)
+        report.important_info_tokens_before = report.important_info_tokens_after = estimate_tokens(important_info)
+        prompt = f"Today is {format_now()}\n\n{important_info}"
+        if not self._can_call_llm(prompt):
+            report.skipped = "out of API budget"
+            return
+        trimmed = self._call_llm(self.prompts["trim_important_info"], prompt, report)
+        # LLM must only remove facts, an empty or longer answer means it did something else
+        if not trimmed or len(trimmed) >= len(important_info):
+            return
+        # and it must not rewrite or cut the kept ones, e.g. answer with a summary
+        original_lines = {line.strip() for line in important_info.splitlines()}
+        if any(line.strip() not in original_lines for line in trimmed.splitlines()):
+            report.skipped = "LLM rewrote important info"
+            return
+        with self.agent._get_memory_lock(user_id=user_id):
+            memory_about_user_path = self.agent._get_memory_about_user_path(user_id=user_id)
+            with open(memory_about_user_path, "r+") as f:
+                if f.read() != important_info:
+                    report.skipped = "important info changed during consolidation"
+                    return
+                # the previous version is kept to restore removed facts by hand
+                with open(memory_about_user_path + ".bak", "w") as backup:
+                    backup.write(important_info)
+                f.seek(0)
+                f.write(trimmed)
+                f.truncate()
+        report.important_info_tokens_after = estimate_tokens(trimmed)
+
+    def consolidate_user(self, user_id: int) -> ConsolidationReport:
+        report = ConsolidationReport(user_id=user_id)
+        self.consolidate_long_term_memory(user_id, report)
+        self.consolidate_important_info(user_id, report)
+        return report
+
+    def run(self, user_ids: Optional[Iterable[int]] = None) -> List[ConsolidationReport]:
+        """One consolidation run under the budget, over given users or all users with saved memory."""
+        self._reset_budget()
+        reports = []
+        for user_id in (self.agent.get_user_ids() if user_ids is None else user_ids):
+            try:
+                reports.append(self.consolidate_user(user_id))
+            except Exception as e:
+                reports.append(ConsolidationReport(user_id=user_id, skipped=f"error: {e}"))
+        return reports
+
+    async def arun_periodically(self, interval: float):
+        """Background mode: every `interval` seconds consolidates memory of users who wrote since the last run."""
+        while True:
+            await asyncio.sleep(interval)
+            user_ids = sorted(self.agent.active_users)
+            self.agent.active_users.clear()
+            started = datetime.now()
+            reports = await asyncio.to_thread(self.run, user_ids)
+            for report in reports:
+                if report.skipped and report.skipped.startswith("out of"):
+                    # will be retried with the next budget
+                    self.agent.active_users.add(report.user_id)
+                print(report.format())
+            print(f"Memory of {len(reports)} users consolidated in {datetime.now() - started}, "
+                  f"{self.llm_calls} LLM calls, {self.io_bytes / 1024 ** 2:.1f}MB read and written")
@@ -0,0 +1,354 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Dict, Optional, Callable, Awaitable, TypeVar, Any, List, Tuple
+
+import openai
+from langchain.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings import OpenAIEmbeddings
+from langchain.schema import BaseMessage, ChatResult
+from pydantic import BaseModel
+
+from agents.function_calling import format_functions
+
+T = TypeVar("T")
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError, openai.error.Timeout, openai.error.APIError, openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+)
+
+
+class Priority(IntEnum):
+    # lower value is served first
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class ModelLimits(BaseModel):
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    # API enforces limits over shorter periods too, so a burst may use only this part of the minute limit
+    burst_seconds: float = 60.0
+
+
+# limits of the account tier the bot runs on, can be overridden with the `openai_limits` config field
+DEFAULT_MODEL_LIMITS = {
+    "gpt-4-0613": ModelLimits(requests_per_minute=200, tokens_per_minute=40000),
+    "gpt-3.5-turbo-0613": ModelLimits(requests_per_minute=3500, tokens_per_minute=90000),
+    "text-embedding-ada-002": ModelLimits(requests_per_minute=3000, tokens_per_minute=1000000),
+    "whisper-1": ModelLimits(requests_per_minute=50),
+}
+
+
+class TokenBucket:
+    """Bucket refilled continuously with `per_minute` units per minute and holding `burst_seconds` of refill.
+    Level may go below zero when actual usage of a request turned out to be bigger than estimated,
+    then next requests wait longer."""
+
+    def __init__(self, per_minute: Optional[float], burst_seconds: float = 60.0):
+        self.rate = per_minute / 60 if per_minute is not None else None
+        self.capacity = max(1.0, self.rate * burst_seconds) if self.rate is not None else None
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_available(self, amount: float, now: float) -> float:
+        if self.capacity is None:
+            return 0.0
+        self._refill(now)
+        # request bigger than the whole bucket is let through when the bucket is full
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def consume(self, amount: float, now: float):
+        if self.capacity is not None:
+            self._refill(now)
+            self.level -= amount
+
+
+@dataclass
+class _Waiter:
+    tokens: float
+    priority: Priority
+    grant: Callable[[], None] = field(repr=False)
+    enqueued: float = field(default_factory=time.monotonic)
+    granted: bool = False
+    cancelled: bool = False
+
+
+class _ModelState:
+    def __init__(self, limits: ModelLimits):
+        self.requests = TokenBucket(limits.requests_per_minute, limits.burst_seconds)
+        self.tokens = TokenBucket(limits.tokens_per_minute, limits.burst_seconds)
+        self.waiters: List[Tuple[int, int, _Waiter]] = []
+        self.paused_until = 0.0
+        self.queue_depth = {priority: 0 for priority in Priority}
+        self.max_queue_depth = 0
+        self.granted = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+
+class OpenAIScheduler:
+    """Process-wide admission control for OpenAI API calls.
+
+    Every model has token buckets for requests and tokens per minute. Calls wait in a priority queue until both
+    buckets have capacity, interactive calls are always admitted before background ones.
+    On 429 the whole model is paused for a jittered exponential backoff (or Retry-After), so waiting calls
+    do not turn into a retry storm. Safe to use from the event loop and from worker threads.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, ModelLimits]] = None, default_limits: Optional[ModelLimits] = None,
+                 max_retries: int = 6, backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.limits = {**DEFAULT_MODEL_LIMITS, **(limits or {})}
+        self.default_limits = default_limits or ModelLimits()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._models: Dict[str, _ModelState] = {}
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    def set_limits(self, limits: Dict[str, ModelLimits]):
+        with self._lock:
+            self.limits.update(limits)
+            for model in limits:
+                self._models.pop(model, None)
+
+    def _get_state(self, model: str) -> _ModelState:
+        if model not in self._models:
+            self._models[model] = _ModelState(self.limits.get(model, self.default_limits))
+        return self._models[model]
+
+    def _enqueue(self, model: str, waiter: _Waiter):
+        with self._lock:
+            state = self._get_state(model)
+            heapq.heappush(state.waiters, (waiter.priority, next(self._sequence), waiter))
+            state.queue_depth[waiter.priority] += 1
+            state.max_queue_depth = max(state.max_queue_depth, len(state.waiters))
+
+    def _dispatch(self, model: str) -> float:
+        """Grants waiters from the head of the queue while limits allow, returns time until the next grant."""
+        with self._lock:
+            state = self._get_state(model)
+            while state.waiters:
+                waiter = state.waiters[0][2]
+                if waiter.cancelled:
+                    heapq.heappop(state.waiters)
+                    continue
+                now = time.monotonic()
+                delay = max(state.paused_until - now,
+                            state.requests.time_until_available(1, now),
+                            state.tokens.time_until_available(waiter.tokens, now))
+                if delay > 0:
+                    return delay
+                heapq.heappop(state.waiters)
+                state.requests.consume(1, now)
+                state.tokens.consume(waiter.tokens, now)
+                state.queue_depth[waiter.priority] -= 1
+                state.granted += 1
+                state.wait_time += now - waiter.enqueued
+                state.max_wait_time = max(state.max_wait_time, now - waiter.enqueued)
+                waiter.granted = True
+                waiter.grant()
+            return 0.0
+
+    def _cancel(self, model: str, waiter: _Waiter):
+        with self._lock:
+            if not waiter.granted and not waiter.cancelled:
+                waiter.cancelled = True
+                self._get_state(model).queue_depth[waiter.priority] -= 1
+
+    async def acquire(self, model: str, tokens: float, priority: Priority = Priority.INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            # may be called from a worker thread that dispatched the queue
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = _Waiter(tokens, priority, grant)
+        self._enqueue(model, waiter)
+        try:
+            while not waiter.granted:
+                delay = self._dispatch(model)
+                if not waiter.granted:
+                    await asyncio.wait([granted], timeout=max(delay, 0.001))
+        finally:
+            self._cancel(model, waiter)
+
+    def acquire_sync(self, model: str, tokens: float, priority: Priority = Priority.INTERACTIVE):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            # waiting for the rate limit here would stop replies to every user
+            raise RuntimeError("Blocking OpenAI call on the event loop thread, use the async call or asyncio.to_thread")
+        event = threading.Event()
+        waiter = _Waiter(tokens, priority, event.set)
+        self._enqueue(model, waiter)
+        try:
+            while not waiter.granted:
+                delay = self._dispatch(model)
+                if not waiter.granted:
+                    event.wait(max(delay, 0.001))
+        finally:
+            self._cancel(model, waiter)
+
+    def reconcile(self, model: str, estimated_tokens: float, used_tokens: float):
+        """Corrects the token bucket after the response reported actual usage."""
+        with self._lock:
+            self._get_state(model).tokens.consume(used_tokens - estimated_tokens, time.monotonic())
+        self._dispatch(model)
+
+    def _on_error(self, model: str, error: Exception, attempt: int) -> float:
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        # equal jitter: callers that failed together do not come back together
+        delay = backoff / 2 + random.uniform(0, backoff / 2)
+        with self._lock:
+            state = self._get_state(model)
+            state.retries += 1
+            if isinstance(error, openai.error.RateLimitError):
+                state.rate_limited += 1
+                retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+                if retry_after is not None:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+                state.paused_until = max(state.paused_until, time.monotonic() + delay)
+        print(f"OpenAI {model} call failed ({type(error).__name__}), retry {attempt + 1} in {delay:.1f}s")
+        return delay
+
+    async def arun(self, model: str, tokens: float, priority: Priority, call: Callable[[], Awaitable[T]],
+                   get_used_tokens: Optional[Callable[[T], Optional[float]]] = None) -> T:
+        for attempt in itertools.count():
+            await self.acquire(model, tokens, priority)
+            try:
+                result = await call()
+            except RETRYABLE_ERRORS as e:
+                if attempt + 1 >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._on_error(model, e, attempt))
+                continue
+            if get_used_tokens is not None and (used_tokens := get_used_tokens(result)) is not None:
+                self.reconcile(model, tokens, used_tokens)
+            return result
+
+    def run_sync(self, model: str, tokens: float, priority: Priority, call: Callable[[], T],
+                 get_used_tokens: Optional[Callable[[T], Optional[float]]] = None) -> T:
+        for attempt in itertools.count():
+            self.acquire_sync(model, tokens, priority)
+            try:
+                result = call()
+            except RETRYABLE_ERRORS as e:
+                if attempt + 1 >= self.max_retries:
+                    raise
+                time.sleep(self._on_error(model, e, attempt))
+                continue
+            if get_used_tokens is not None and (used_tokens := get_used_tokens(result)) is not None:
+                self.reconcile(model, tokens, used_tokens)
+            return result
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                model: {
+                    "queue_depth": {priority.name.lower(): depth for priority, depth in state.queue_depth.items()},
+                    "max_queue_depth": state.max_queue_depth,
+                    "granted": state.granted,
+                    "rate_limited": state.rate_limited,
+                    "retries": state.retries,
+                    "mean_wait_time": state.wait_time / state.granted if state.granted else 0.0,
+                    "max_wait_time": state.max_wait_time,
+                }
+                for model, state in self._models.items()
+            }
+
+
+_scheduler = OpenAIScheduler()
+
+
+def get_openai_scheduler() -> OpenAIScheduler:
+    return _scheduler
+
+
+def estimate_tokens(text: str) -> int:
+    # tiktoken needs network on the first use, ~4 characters per token is enough for rate limiting
+    return len(text) // 4 + 1
+
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    """ChatOpenAI that goes through the OpenAIScheduler. Retries are done by the scheduler, not by tenacity."""
+    priority: Priority = Priority.INTERACTIVE
+    scheduler: Optional[OpenAIScheduler] = None
+    max_retries: int = 1
+    expected_completion_tokens: int = 256
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_scheduler(self) -> OpenAIScheduler:
+        return self.scheduler or get_openai_scheduler()
+
+    def _estimate_tokens(self, messages: List[BaseMessage], functions: Optional[List[Dict[str, Any]]] = None) -> int:
+        prompt_tokens = sum(estimate_tokens(message.content) for message in messages)
+        if functions:
+            # function definitions are a part of the prompt
+            prompt_tokens += estimate_tokens(format_functions(functions))
+        return prompt_tokens + (self.max_tokens or self.expected_completion_tokens)
+
+    @staticmethod
+    def _get_used_tokens(result: ChatResult) -> Optional[float]:
+        return (result.llm_output or {}).get("token_usage", {}).get("total_tokens")
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        return self._get_scheduler().run_sync(
+            self.model_name, self._estimate_tokens(messages, kwargs.get("functions")), self.priority,
+            lambda: super(ScheduledChatOpenAI, self)._generate(messages, stop, run_manager, **kwargs),
+            self._get_used_tokens)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        return await self._get_scheduler().arun(
+            self.model_name, self._estimate_tokens(messages, kwargs.get("functions")), self.priority,
+            lambda: super(ScheduledChatOpenAI, self)._agenerate(messages, stop, run_manager, **kwargs),
+            self._get_used_tokens)
+
+
+class ScheduledOpenAIEmbeddings(OpenAIEmbeddings):
+    """OpenAIEmbeddings that goes through the OpenAIScheduler.
+    Documents are embedded in background, queries are on the path of a reply."""
+    scheduler: Optional[OpenAIScheduler] = None
+    max_retries: int = 1
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_scheduler(self) -> OpenAIScheduler:
+        return self.scheduler or get_openai_scheduler()
+
+    def embed_documents(self, texts: List[str], chunk_size: Optional[int] = 0) -> List[List[float]]:
+        return self._get_scheduler().run_sync(
+            self.model, sum(estimate_tokens(text) for text in texts), Priority.BACKGROUND,
+            lambda: super(ScheduledOpenAIEmbeddings, self).embed_documents(texts, chunk_size))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._get_scheduler().run_sync(
+            self.model, estimate_tokens(text), Priority.INTERACTIVE,
+            lambda: super(ScheduledOpenAIEmbeddings, self).embed_query(text))
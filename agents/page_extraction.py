@@ -0,0 +1,137 @@
+import codecs
+import math
+import re
+from collections import Counter
+from typing import Iterable, List, Optional, Callable
+
+import html2text
+import numpy as np
+import requests
+
+from agents.openai_scheduler import estimate_tokens
+
+# characters per token of estimate_tokens
+CHARS_PER_TOKEN = 4
+USER_AGENT = "Mozilla/5.0 (compatible; tg_lila_bot)"
+
+
+def extract_page_text(content: Iterable[bytes], max_bytes: int, max_tokens: int, encoding: Optional[str] = "utf-8",
+                      is_html: bool = True, should_stop: Optional[Callable[[], bool]] = None) -> str:
+    """Converts page content to text while it is downloaded and stops reading it
+    as soon as max_bytes are read, max_tokens of text are extracted or should_stop() is true."""
+    pieces = []
+    text_length = 0
+    max_length = max_tokens * CHARS_PER_TOKEN
+
+    def collect(piece: str):
+        nonlocal text_length
+        pieces.append(piece)
+        text_length += len(piece)
+
+    parser = None
+    if is_html:
+        parser = html2text.HTML2Text(out=collect)
+        parser.body_width = 0
+        parser.ignore_links = True
+        parser.ignore_images = True
+    decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    read_bytes = 0
+    for chunk in content:
+        chunk = chunk[:max_bytes - read_bytes]
+        read_bytes += len(chunk)
+        text = decoder.decode(chunk, final=read_bytes >= max_bytes)
+        if parser is not None:
+            parser.feed(text)
+        else:
+            collect(text)
+        if read_bytes >= max_bytes or text_length >= max_length or (should_stop is not None and should_stop()):
+            break
+    if parser is not None:
+        parser.feed("")
+        parser.finish()
+    return "".join(pieces)[:max_length].strip()
+
+
+def fetch_page_text(url: str, max_bytes: int, max_tokens: int, timeout: float = 20,
+                    should_stop: Optional[Callable[[], bool]] = None) -> str:
+    with requests.get(url, stream=True, timeout=timeout, headers={"User-Agent": USER_AGENT}) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "text/html")
+        if not content_type.startswith("text/") and "html" not in content_type:
+            raise ValueError(f"{url} is not a text page, it is {content_type}")
+        return extract_page_text(
+            response.iter_content(chunk_size=16 * 1024), max_bytes, max_tokens,
+            encoding=response.encoding or response.apparent_encoding,
+            is_html="html" in content_type, should_stop=should_stop)
+
+
+def split_into_chunks(text: str, chunk_tokens: int) -> List[str]:
+    """Groups consecutive paragraphs into chunks of at most chunk_tokens, longer paragraphs are split by words."""
+    max_length = chunk_tokens * CHARS_PER_TOKEN
+    chunks, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(current) + len(paragraph) + 2 <= max_length:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+            continue
+        if current:
+            chunks.append(current)
+        current = ""
+        for word in paragraph.split():
+            if current and len(current) + len(word) + 1 > max_length:
+                chunks.append(current)
+                current = ""
+            current = f"{current} {word}" if current else word
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25:
+    """Okapi BM25 ranking of a small collection of texts, like chunks of one page."""
+
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(tokenize(text)) for text in texts]
+        self.lengths = np.array([sum(frequencies.values()) for frequencies in self.term_frequencies], dtype=float)
+        self.average_length = max(self.lengths.mean(), 1.0) if len(texts) else 1.0
+        document_frequencies = Counter(term for frequencies in self.term_frequencies for term in frequencies)
+        self.idf = {
+            term: math.log(1 + (len(texts) - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    def get_scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.term_frequencies))
+        normalized_lengths = self.k1 * (1 - self.b + self.b * self.lengths / self.average_length)
+        for term in set(tokenize(query)):
+            if term not in self.idf:
+                continue
+            frequencies = np.array([frequencies[term] for frequencies in self.term_frequencies], dtype=float)
+            scores += self.idf[term] * frequencies * (self.k1 + 1) / (frequencies + normalized_lengths)
+        return scores
+
+
+def select_relevant_chunks(chunks: List[str], question: str, top_k: int) -> List[str]:
+    """Top-k chunks by BM25 score in the page order. Without any match the page beginning is returned."""
+    if len(chunks) <= top_k:
+        return chunks
+    scores = BM25(chunks).get_scores(question)
+    if not scores.any():
+        return chunks[:top_k]
+    # stable sort keeps earlier chunks first among equal scores
+    best = np.argsort(-scores, kind="stable")[:top_k]
+    return [chunks[i] for i in sorted(best)]
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max_tokens * CHARS_PER_TOKEN]
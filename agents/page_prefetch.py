@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Dict
+
+# fetch(url, should_stop) -> page text, should stop reading the page as soon as should_stop() is true
+PageFetcher = Callable[[str, Callable[[], bool]], str]
+
+
+@dataclass
+class _Prefetch:
+    future: Future
+    created_at: float
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    used: bool = False
+
+
+class PagePrefetcher:
+    """Speculatively downloads pages of search results, expecting questions to them.
+
+    Pages are fetched by at most max_concurrency threads, so it works both for sync and async tools.
+    At most max_pages prefetches are kept (every page text is capped by the fetcher), the oldest are dropped.
+    A prefetch that was not read during ttl seconds is dropped, and its download is stopped if still running.
+    """
+
+    def __init__(self, fetch: PageFetcher, max_concurrency: int = 4, max_pages: int = 16, ttl: float = 120):
+        self.fetch = fetch
+        self.max_pages = max_pages
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="page_prefetch")
+        self._prefetches: Dict[str, _Prefetch] = OrderedDict()
+        self._lock = threading.Lock()
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0
+        self.unused = 0
+
+    def _fetch(self, url: str, cancelled: threading.Event) -> str:
+        if cancelled.is_set():
+            return ""
+        return self.fetch(url, cancelled.is_set)
+
+    def _drop(self, url: str):
+        # caller holds the lock
+        prefetch = self._prefetches.pop(url)
+        if prefetch.used:
+            return
+        self.unused += 1
+        if not prefetch.future.done():
+            prefetch.cancelled.set()
+            prefetch.future.cancel()
+            self.cancelled += 1
+
+    def _drop_expired(self, now: float):
+        # caller holds the lock
+        for url in [url for url, prefetch in self._prefetches.items() if now - prefetch.created_at > self.ttl]:
+            self._drop(url)
+
+    def prefetch(self, urls: List[str]):
+        now = time.monotonic()
+        with self._lock:
+            self._drop_expired(now)
+            for url in urls:
+                if url in self._prefetches:
+                    continue
+                cancelled = threading.Event()
+                future = self._executor.submit(self._fetch, url, cancelled)
+                self._prefetches[url] = _Prefetch(future=future, created_at=now, cancelled=cancelled)
+                self.started += 1
+            while len(self._prefetches) > self.max_pages:
+                self._drop(next(iter(self._prefetches)))
+
+    def get(self, url: str, timeout: Optional[float] = None) -> Optional[str]:
+        """Text of the prefetched page, waiting for the download if it is running.
+        None if the page was not prefetched or its download failed, then the caller fetches it itself."""
+        with self._lock:
+            self._drop_expired(time.monotonic())
+            prefetch = self._prefetches.get(url)
+            if prefetch is None:
+                self.misses += 1
+                return None
+            prefetch.used = True
+        try:
+            text = prefetch.future.result(timeout)
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return text
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "started": self.started,
+            "hits": self.hits,
+            "misses": self.misses,
+            "unused": self.unused,
+            "cancelled": self.cancelled,
+            "cached": len(self._prefetches),
+        }
+
+    def close(self):
+        with self._lock:
+            for url in list(self._prefetches):
+                self._drop(url)
+        self._executor.shutdown(wait=False)
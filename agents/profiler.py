@@ -0,0 +1,104 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Optional, List, Tuple
+
+FunctionKey = Tuple[str, str, int]
+
+
+def _get_function(frame: FrameType) -> FunctionKey:
+    code = frame.f_code
+    return code.co_name, code.co_filename, code.co_firstlineno
+
+
+def _format_function(function: FunctionKey) -> str:
+    name, file_name, line = function
+    return f"{name} ({os.path.basename(file_name)}:{line})"
+
+
+class SamplingProfiler:
+    """Samples stacks of all threads of the process with sys._current_frames, so it can be turned on in
+    production for a while: the cost is one stack walk per thread every interval, nothing when it is stopped.
+
+    Only the running coroutine of the event loop thread is seen, time the loop waits for IO is in `select`.
+    """
+
+    def __init__(self, interval: float = 0.005, max_stack_depth: int = 64):
+        self.interval = interval
+        self.max_stack_depth = max_stack_depth
+        self.samples = 0
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+        self._self_counts: Counter = Counter()
+        self._total_counts: Counter = Counter()
+        self._stack_counts: Counter = Counter()
+        self._threads = set()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.samples = 0
+        self._self_counts.clear()
+        self._total_counts.clear()
+        self._stack_counts.clear()
+        self._threads.clear()
+        self._stop.clear()
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._sample_loop, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.stopped_at = time.monotonic()
+        return self.summary()
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():  # noqa
+            if thread_id == own_id:
+                continue
+            stack: List[FunctionKey] = []
+            while frame is not None and len(stack) < self.max_stack_depth:
+                stack.append(_get_function(frame))
+                frame = frame.f_back
+            if not stack:
+                continue
+            self._threads.add(thread_id)
+            self._self_counts[stack[0]] += 1
+            # recursive functions are counted once per sample
+            self._total_counts.update(set(stack))
+            self._stack_counts[tuple(stack[:8])] += 1
+        self.samples += 1
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def summary(self, top: int = 10) -> str:
+        duration = (self.stopped_at if not self.running else time.monotonic()) - self.started_at
+        thread_samples = sum(self._self_counts.values()) or 1
+        # shares are of samples of all threads
+        lines = [f"Profile of {duration:.1f}s: {self.samples} samples of {len(self._threads)} threads"]
+        lines.append("Top functions by own time:")
+        lines.extend(f"{100 * count / thread_samples:5.1f}% {_format_function(function)}"
+                     for function, count in self._self_counts.most_common(top))
+        lines.append("Top functions by total time:")
+        lines.extend(f"{100 * count / thread_samples:5.1f}% {_format_function(function)}"
+                     for function, count in self._total_counts.most_common(top))
+        lines.append("Top stacks, innermost 8 frames:")
+        for stack, count in self._stack_counts.most_common(3):
+            lines.append(f"{100 * count / thread_samples:5.1f}% " + " <- ".join(
+                _format_function(function) for function in stack))
+        return "\n".join(lines)
@@ -1,12 +1,17 @@
 import asyncio
 import json
-from typing import Any, Tuple, List
+from typing import Any, Tuple, List, Optional, Callable, Dict, ClassVar
 
 from langchain.base_language import BaseLanguageModel
+from langchain.schema import BaseMessage, SystemMessage, HumanMessage
 from langchain.tools import DuckDuckGoSearchResults, BaseTool
-from llama_index import download_loader, GPTListIndex, Document, LLMPredictor, ServiceContext
+from llama_index import GPTListIndex, Document, LLMPredictor, ServiceContext
 from llama_index.response_synthesizers import TreeSummarize
 
+from agents.page_extraction import fetch_page_text, split_into_chunks, select_relevant_chunks, truncate_to_tokens
+from agents.page_prefetch import PagePrefetcher
+from agents.tracing import span
+
 
 class WebSearchTool(DuckDuckGoSearchResults):
     name: str = "web_search"
@@ -15,14 +20,26 @@ class WebSearchTool(DuckDuckGoSearchResults):
         "Input should be a search query (like you would google it). " \
         "If relevant, include location and date to get more accurate results. " \
         "You will get a list of urls and a short snippet of the page. "
+    # if set, pages of prefetch_results top results are downloaded in background, expecting questions to them
+    prefetcher: Optional[PagePrefetcher] = None
+    prefetch_results: int = 2
+
+    def _search(self, query: str) -> List[Dict[str, str]]:
+        return self.api_wrapper.results(query, self.num_results)
+
+    def _run(self, query: str, *args: Any, **kwargs: Any) -> str:
+        results = self._search(query)
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch([result["link"] for result in results[:self.prefetch_results] if "link" in result])
+        return str(results)
 
     async def _arun(self, *args: Any, **kwargs: Any) -> Any:
-        return self._run(*args, **kwargs)
+        # the search client is blocking
+        return await asyncio.to_thread(self._run, *args, **kwargs)
 
 
 class AskPagesTool(BaseTool):
     llm: BaseLanguageModel
-    _page_loader = download_loader("SimpleWebPageReader")(html_to_text=True)  # noqa
     name: str = "ask_urls"
     description: str = \
         "You can ask a question about a URL. " \
@@ -31,6 +48,31 @@ class AskPagesTool(BaseTool):
         "urls is a list of urls to ask corresponding question from questions list" \
         'Example: {"urls": ["https://en.wikipedia.org/wiki/Cat", "https://en.wikipedia.org/wiki/Dog"], ' \
         '"questions": ["How many cats in the world?", "How many dogs in the world?"]}'
+    # arguments of the tool in function calling mode of agents
+    function_parameters: ClassVar[Dict[str, Any]] = {
+        "type": "object",
+        "properties": {
+            "urls": {"type": "array", "items": {"type": "string"}, "description": "Urls to ask"},
+            "questions": {"type": "array", "items": {"type": "string"},
+                          "description": "Question to every url, or one question to all of them"},
+        },
+        "required": ["urls", "questions"],
+    }
+    # page download stops after max_page_bytes or max_page_tokens of extracted text
+    max_page_bytes: int = 2 * 1024 * 1024
+    max_page_tokens: int = 30000
+    request_timeout: float = 20
+    # only top_k_chunks most relevant to the question by BM25 are sent to llm in a single call
+    chunk_tokens: int = 256
+    top_k_chunks: int = 8
+    # the old way: the whole page is summarized by TreeSummarize, with many llm calls for long pages
+    use_tree_summarize: bool = False
+    # pages prefetched after web search are read from it
+    prefetcher: Optional[PagePrefetcher] = None
+    answer_instruction: str = \
+        "Answer the question using only the following fragments of the web page {url}. " \
+        "Fragments are separated by '...'. " \
+        "If the fragments do not contain the answer, say that the page does not have it."
 
     def _get_page_index(self, page: Document) -> GPTListIndex:
         llm_predictor_chatgpt = LLMPredictor(self.llm)
@@ -42,8 +84,29 @@ class AskPagesTool(BaseTool):
         )
         return doc_summary_index
 
+    def fetch_page(self, url: str, should_stop: Optional[Callable[[], bool]] = None) -> str:
+        return fetch_page_text(url, self.max_page_bytes, self.max_page_tokens, self.request_timeout, should_stop)
+
+    def _load_page(self, url: str) -> Document:
+        with span("load page", "io", url=url):
+            text = self.prefetcher.get(url) if self.prefetcher is not None else None
+            if text is None:
+                text = self.fetch_page(url)
+        return Document(text=text, extra_info={"url": url})
+
+    def _select_page_fragments(self, text: str, question: str) -> List[str]:
+        chunks = split_into_chunks(truncate_to_tokens(text, self.max_page_tokens), self.chunk_tokens)
+        return select_relevant_chunks(chunks, question, self.top_k_chunks)
+
+    def _get_messages(self, url: str, page: Document, question: str) -> List[BaseMessage]:
+        fragments = self._select_page_fragments(page.text, question)
+        return [
+            SystemMessage(content=self.answer_instruction.format(url=url)),
+            HumanMessage(content="\n...\n".join(fragments) + f"\n\nQuestion: {question}")
+        ]
+
     def _get_url_index(self, url: str) -> GPTListIndex:
-        page = self._page_loader.load_data(urls=[url])[0]
+        page = self._load_page(url)
         return self._get_page_index(page)
 
     @staticmethod
@@ -64,6 +127,18 @@ class AskPagesTool(BaseTool):
         return list(zip(urls, questions))
 
     def _run_single(self, url: str, question: str) -> str:
+        if self.use_tree_summarize:
+            return self._run_single_tree_summarize(url, question)
+        page = self._load_page(url)
+        return self.llm.predict_messages(self._get_messages(url, page, question)).content
+
+    async def _arun_single(self, url: str, question: str) -> str:
+        if self.use_tree_summarize:
+            return await self._arun_single_tree_summarize(url, question)
+        page = await asyncio.to_thread(self._load_page, url)
+        return (await self.llm.apredict_messages(self._get_messages(url, page, question))).content
+
+    def _run_single_tree_summarize(self, url: str, question: str) -> str:
         page_index = self._get_url_index(url)
         llm_predictor_chatgpt = LLMPredictor(self.llm)
         service_context = ServiceContext.from_defaults(llm_predictor=llm_predictor_chatgpt, chunk_size=1024)
@@ -72,8 +147,8 @@ class AskPagesTool(BaseTool):
         response = query_engine.query(question)
         return response.response
 
-    async def _arun_single(self, url: str, question: str) -> str:
-        page_index = self._get_url_index(url)
+    async def _arun_single_tree_summarize(self, url: str, question: str) -> str:
+        page_index = await asyncio.to_thread(self._get_url_index, url)
         llm_predictor_chatgpt = LLMPredictor(self.llm)
         service_context = ServiceContext.from_defaults(llm_predictor=llm_predictor_chatgpt, chunk_size=1024)
         query_engine = page_index.as_query_engine(
@@ -0,0 +1,305 @@
+import asyncio
+import contextlib
+import functools
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple, Iterator, Callable, TypeVar
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import AgentFinish, LLMResult
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+
+class TracingPolicy(BaseModel):
+    # requests slower than this many seconds have their trace written
+    threshold: float = 60
+    # relative to SAVE_PATH
+    trace_dir: str = "traces"
+
+
+@dataclass
+class Span:
+    id: int
+    parent_id: Optional[int]
+    name: str
+    category: str
+    start: float
+    end: float = 0.0
+    args: Dict[str, Any] = field(default_factory=dict)
+
+
+def assign_tracks(spans: List[Span]) -> List[int]:
+    """Tracks for spans, such that a span is drawn inside of its ancestor only, as Chrome trace viewers need
+    nested spans on one track. Concurrent spans, like pages loaded in parallel, get separate tracks.
+
+    Agent steps are not parents of llm and tool calls of the step, so spans of the same executor may be drawn
+    inside of them.
+    """
+    parents = {span.id: span.parent_id for span in spans}
+
+    def is_ancestor(ancestor_id: Optional[int], span_id: Optional[int]) -> bool:
+        while span_id is not None:
+            if span_id == ancestor_id:
+                return True
+            span_id = parents.get(span_id)
+        return False
+
+    tracks = [0] * len(spans)
+    # open spans of every track as (end, id of the span allowed to contain other spans)
+    stacks: List[List[Tuple[float, Optional[int]]]] = []
+    for i in sorted(range(len(spans)), key=lambda i: (spans[i].start, -spans[i].end)):
+        span = spans[i]
+        for track, stack in enumerate(stacks):
+            while stack and stack[-1][0] <= span.start:
+                stack.pop()
+            if not stack or (span.end <= stack[-1][0] and is_ancestor(stack[-1][1], span.parent_id)):
+                break
+        else:
+            stacks.append([])
+            track, stack = len(stacks) - 1, stacks[-1]
+        stack.append((span.end, span.parent_id if span.category == "agent_step" else span.id))
+        tracks[i] = track
+    return tracks
+
+
+class Trace:
+    """Spans of one request as Chrome trace events, see chrome://tracing or https://ui.perfetto.dev."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.started_at = datetime.now()
+        self.spans: List[Span] = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def open_span(self, name: str, category: str, parent_id: Optional[int], start: Optional[float] = None,
+                  **args: Any) -> Span:
+        with self._lock:
+            return Span(next(self._ids), parent_id, name, category, start or time.perf_counter(), args=args)
+
+    def close_span(self, span: Span, end: Optional[float] = None, **args: Any):
+        span.end = end or time.perf_counter()
+        span.args.update(args)
+        with self._lock:
+            self.spans.append(span)
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        for span, track in zip(spans, assign_tracks(spans)):
+            event = {"name": span.name, "cat": span.category, "ph": "X", "pid": 0, "tid": track,
+                     "ts": (span.start - self.start) * 1e6, "dur": (span.end - span.start) * 1e6}
+            if span.args:
+                event["args"] = span.args
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"name": self.name, "started_at": self.started_at.isoformat()}}
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+# id of the innermost open span, the parent of new ones
+_current_span_id: ContextVar[Optional[int]] = ContextVar("current_span_id", default=None)
+
+
+def get_current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[None]:
+    """Span of the current request, nothing when the request is not traced."""
+    if (trace := _current_trace.get()) is None:
+        yield
+        return
+    opened = trace.open_span(name, category, _current_span_id.get(), **args)
+    token = _current_span_id.set(opened.id)
+    try:
+        yield
+    finally:
+        _current_span_id.reset(token)
+        trace.close_span(opened)
+
+
+def traced(category: str, name: Optional[str] = None) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Decorator making every call of a function or a coroutine function a span."""
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        span_name = name or func.__name__
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with span(span_name, category):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            with span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Spans of chains, agent steps, tools and llm calls of the current request.
+
+    It is attached as a local callback to every traced executor, tool and llm, and runs in the context of the
+    caller (run_inline), where the current trace is. Chains and tools are called in the context their start
+    callback runs in, so their span becomes the current one until they end. A run reported twice, by an inherited
+    and a local handler, is recorded once. A step of an executor lasts from the end of the previous one to the end
+    of its tool.
+    """
+    run_inline = True
+
+    def __init__(self):
+        # run id -> trace and span of the run
+        self._runs: Dict[UUID, Tuple[Trace, Span]] = {}
+        # executor run id -> start and number of its current step, whether anything ran in it
+        self._steps: Dict[UUID, Tuple[float, int, bool]] = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: str, category: str):
+        if (trace := _current_trace.get()) is None:
+            return
+        with self._lock:
+            if run_id in self._runs:
+                return
+            opened = trace.open_span(name, category, _current_span_id.get())
+            self._runs[run_id] = (trace, opened)
+            if (step := self._steps.get(parent_run_id)) is not None:
+                self._steps[parent_run_id] = (step[0], step[1], True)
+        _current_span_id.set(opened.id)
+
+    def _end(self, run_id: UUID, **args: Any) -> Optional[str]:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+            self._steps.pop(run_id, None)
+        if run is None:
+            return None
+        trace, opened = run
+        trace.close_span(opened, **args)
+        _current_span_id.set(opened.parent_id)
+        return opened.name
+
+    def _end_step(self, executor_run_id: Optional[UUID], name: str):
+        end = time.perf_counter()
+        with self._lock:
+            step = self._steps.get(executor_run_id)
+            run = self._runs.get(executor_run_id)
+            if step is None or run is None or not step[2]:
+                return
+            self._steps[executor_run_id] = (end, step[1] + 1, False)
+        trace, executor_span = run
+        trace.close_span(trace.open_span(f"step {step[1]}: {name}", "agent_step", executor_span.id, step[0]), end)
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        serialized = serialized or {}
+        self._start(run_id, parent_run_id, serialized.get("name") or (serialized.get("id") or ["chain"])[-1], "chain")
+        with self._lock:
+            if run_id in self._runs:
+                self._steps.setdefault(run_id, (time.perf_counter(), 1, False))
+
+    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error=repr(error))
+
+    def on_agent_finish(self, finish: AgentFinish, *, run_id: UUID, **kwargs: Any):
+        # nothing is left when the final answer was a tool returning directly
+        self._end_step(run_id, "final answer")
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID,
+                      parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._start(run_id, parent_run_id, serialized.get("name") or "tool", "tool")
+
+    def on_tool_end(self, output: str, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        if (name := self._end(run_id)) is not None:
+            self._end_step(parent_run_id, name)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, parent_run_id: Optional[UUID] = None,
+                      **kwargs: Any):
+        if (name := self._end(run_id, error=repr(error))) is not None:
+            self._end_step(parent_run_id, name)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+                     parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._start(run_id, parent_run_id, "llm", "llm")
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                            parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        model = (kwargs.get("invocation_params") or {}).get("model_name") or "chat_model"
+        self._start(run_id, parent_run_id, model, "llm")
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, **((response.llm_output or {}).get("token_usage") or {}))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error=repr(error))
+
+
+class Tracer:
+    """Traces requests and writes traces of ones slower than the threshold, disabled without a policy."""
+
+    def __init__(self):
+        self.policy: Optional[TracingPolicy] = None
+        self.callback_handler = TracingCallbackHandler()
+        self.written_traces = 0
+
+    def configure(self, policy: Optional[TracingPolicy], base_dir: str = ""):
+        """Relative trace_dir of the policy is resolved against base_dir."""
+        if policy is not None:
+            policy = policy.copy(update={"trace_dir": os.path.join(base_dir, policy.trace_dir)})
+        self.policy = policy
+
+    def attach(self, *components: Any):
+        """Adds the callback handler to local callbacks of langchain executors, tools and llms."""
+        for component in components:
+            callbacks = component.callbacks or []
+            if self.callback_handler not in callbacks:
+                component.callbacks = [*callbacks, self.callback_handler]
+
+    def _write(self, trace: Trace, elapsed: float):
+        os.makedirs(self.policy.trace_dir, exist_ok=True)
+        safe_name = re.sub(r"[^\w.-]", "_", trace.name)
+        file_name = f"{trace.started_at.strftime('%Y%m%d-%H%M%S-%f')}_{safe_name}.json"
+        with open(os.path.join(self.policy.trace_dir, file_name), "w") as f:
+            json.dump(trace.to_json(), f)
+        self.written_traces += 1
+        print(f"Request {trace.name} took {elapsed:.1f}s, trace saved to {file_name}")
+
+    @contextlib.contextmanager
+    def trace(self, name: str) -> Iterator[Optional[Trace]]:
+        """Traces the request, a request inside of a traced one is a part of its trace."""
+        if self.policy is None or _current_trace.get() is not None:
+            yield _current_trace.get()
+            return
+        trace = Trace(name)
+        trace_token, span_token = _current_trace.set(trace), _current_span_id.set(None)
+        try:
+            with span(name, "request"):
+                yield trace
+        finally:
+            _current_trace.reset(trace_token)
+            _current_span_id.reset(span_token)
+            if (elapsed := time.perf_counter() - trace.start) >= self.policy.threshold:
+                self._write(trace, elapsed)
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
@@ -1,7 +1,7 @@
-from typing import Dict
+from typing import Dict, Optional
 
 from langchain import PromptTemplate
-from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.base import BaseChatModel
 from langchain.prompts import HumanMessagePromptTemplate, MessagesPlaceholder, ChatPromptTemplate
 from langchain.schema import SystemMessage
 from langchain.tools import BaseTool
@@ -10,19 +10,36 @@ from yid_langchain_extensions.output_parser.action_parser import ActionParser
 from yid_langchain_extensions.tools.agent_as_tool import AgentAsTool
 from yid_langchain_extensions.tools.utils import FinalAnswerTool, format_tool_names, format_tools
 
+from agents.function_calling import FunctionCallingAgent, FUNCTION_CALLING_INSTRUCTION
+from agents.openai_scheduler import ScheduledChatOpenAI, Priority
+from agents.page_prefetch import PagePrefetcher
 from agents.tools import WebSearchTool, AskPagesTool
+from agents.tracing import get_tracer
 from agents.utils import format_now, get_thought_thought, get_self_criticism_thought
 
 
 class WebResearcherAgent:
-    def __init__(self, prompts: Dict[str, str]):
+    def __init__(self, prompts: Dict[str, str],
+                 smart_llm: Optional[BaseChatModel] = None, fast_llm: Optional[BaseChatModel] = None,
+                 web_search_tool: Optional[WebSearchTool] = None, ask_url_tool: Optional[AskPagesTool] = None,
+                 prefetch_pages: int = 0, use_function_calling: bool = False):
         self.prompts = prompts
-        self.smart_llm = ChatOpenAI(model_name="gpt-4-0613", temperature=0)
-        self.fast_llm = ChatOpenAI(model_name="gpt-3.5-turbo-0613", temperature=0)
+        self.smart_llm = smart_llm or ScheduledChatOpenAI(model_name="gpt-4-0613", temperature=0)
+        self.fast_llm = fast_llm or ScheduledChatOpenAI(
+            model_name="gpt-3.5-turbo-0613", temperature=0, priority=Priority.BACKGROUND)
         final_answer_tool = FinalAnswerTool()
-        web_search_tool = WebSearchTool()
-        ask_url_tool = AskPagesTool(llm=self.smart_llm)
+        web_search_tool = web_search_tool or WebSearchTool()
+        # page QA is a single llm call per question (unless use_tree_summarize), and the user waits for it
+        ask_url_tool = ask_url_tool or AskPagesTool(llm=smart_llm or ScheduledChatOpenAI(
+            model_name="gpt-4-0613", temperature=0))
+        # ask_urls almost always follows web search, so pages of top results may be downloaded in advance
+        self.page_prefetcher = None
+        if prefetch_pages > 0:
+            self.page_prefetcher = PagePrefetcher(ask_url_tool.fetch_page)
+            web_search_tool.prefetcher = ask_url_tool.prefetcher = self.page_prefetcher
+            web_search_tool.prefetch_results = prefetch_pages
         self.tools = [final_answer_tool, web_search_tool, ask_url_tool]
+        get_tracer().attach(self.smart_llm, self.fast_llm, ask_url_tool.llm, *self.tools)
         self.output_parser = ActionParser.from_extra_thoughts(pre_thoughts=[
             get_thought_thought(), get_self_criticism_thought()
         ], after_thoughts=[])
@@ -30,6 +47,7 @@ class WebResearcherAgent:
             self.output_parser.get_format_instructions(), template_format="jinja2").format(
             tool_names=format_tool_names(self.tools)
         )
+        self.use_function_calling = use_function_calling
 
     def as_tool(self) -> BaseTool:
         name: str = "web_search"
@@ -42,22 +60,34 @@ class WebResearcherAgent:
             SystemMessage(content=system_message),
             HumanMessagePromptTemplate.from_template("{{input}}", "jinja2"),
         ]
-        messages.extend([
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-            SystemMessage(content=format_tools(self.tools)),
-            SystemMessage(content=self.format_message),
-        ])
-        prompt = ChatPromptTemplate.from_messages(messages=messages)
-        agent_executor = SimpleAgent.from_llm_and_prompt(
-            llm=self.smart_llm,
-            prompt=prompt,
-            output_parser=self.output_parser,
-            stop_sequences=self.output_parser.stop_sequences,
-        ).get_executor(tools=self.tools, verbose=True)
-        return AgentAsTool(
+        if self.use_function_calling:
+            messages.extend([
+                MessagesPlaceholder(variable_name="agent_scratchpad"),
+                SystemMessage(content=FUNCTION_CALLING_INSTRUCTION.format(final_answer=self.tools[0].name)),
+            ])
+            agent_executor = FunctionCallingAgent.from_llm_and_tools(
+                self.smart_llm, ChatPromptTemplate.from_messages(messages=messages), self.tools[0], self.tools[1:]
+            ).get_executor(tools=self.tools[1:], verbose=True)
+        else:
+            messages.extend([
+                MessagesPlaceholder(variable_name="agent_scratchpad"),
+                SystemMessage(content=format_tools(self.tools)),
+                SystemMessage(content=self.format_message),
+            ])
+            prompt = ChatPromptTemplate.from_messages(messages=messages)
+            agent_executor = SimpleAgent.from_llm_and_prompt(
+                llm=self.smart_llm,
+                prompt=prompt,
+                output_parser=self.output_parser,
+                stop_sequences=self.output_parser.stop_sequences,
+            ).get_executor(tools=self.tools, verbose=True)
+        get_tracer().attach(agent_executor)
+        tool = AgentAsTool(
             name=name,
             description=description,
             return_direct=False,
             executor=agent_executor,
             adapter=lambda *args, **kwargs: ((), {"input": args[0]}),
         )
+        get_tracer().attach(tool)
+        return tool
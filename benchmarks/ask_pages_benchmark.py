@@ -0,0 +1,137 @@
+"""Benchmark of AskPagesTool on saved pages: single llm call over BM25-selected chunks versus TreeSummarize
+over the whole page. Compares llm calls, prompt and completion tokens and latency per question. Example:
+    python -m benchmarks.ask_pages_benchmark --sections 60 --output ask_pages.json
+Real pages can be saved with `curl https://en.wikipedia.org/wiki/Cat > cat.html` and passed with
+`--pages cat.html --questions "How many cats are in the world?"`, otherwise long article-like pages with known
+facts are generated, and for them the share of questions whose fact got into the selected chunks is reported.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+from agents.page_extraction import extract_page_text
+from agents.tools import AskPagesTool
+from benchmarks.fakes import FakeChatModel, use_approximate_tokenizer
+from benchmarks.utils import summarize_latencies, write_results, Stopwatch
+
+SYLLABLES = ["ka", "ro", "del", "mi", "tan", "vor", "lu", "esh", "qua", "ne", "bri", "zo"]
+FILLER_WORDS = [
+    "the", "of", "and", "in", "was", "is", "for", "with", "as", "by", "on", "its", "which", "from", "were", "city",
+    "river", "region", "people", "history", "century", "known", "large", "period", "north", "south", "trade",
+    "culture", "later", "early", "government", "population", "area", "built", "during", "many", "several", "main",
+]
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=str, nargs="*", default=[], help="saved html pages")
+    parser.add_argument("--questions", type=str, nargs="*", default=[], help="questions asked to every saved page")
+    parser.add_argument("--generated_pages", type=int, default=3, help="used when no --pages given")
+    parser.add_argument("--sections", type=int, default=40, help="sections of generated pages")
+    parser.add_argument("--questions_per_page", type=int, default=5)
+    parser.add_argument("--chunk_tokens", type=int, default=256)
+    parser.add_argument("--top_k_chunks", type=int, default=8)
+    parser.add_argument("--max_page_tokens", type=int, default=30000)
+    parser.add_argument("--llm_latency", type=float, default=1.0)
+    parser.add_argument("--llm_tokens_per_second", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="bench_output.json")
+    return parser
+
+
+def _make_name(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(3)).capitalize()
+
+
+def generate_page(rng: random.Random, sections: int) -> Tuple[str, List[Tuple[str, str]]]:
+    """Html of a long article and (question, fact) pairs, every fact is in its own section."""
+    title = _make_name(rng)
+    html = [f"<html><head><title>{title}</title><style>body {{margin: 0}}</style></head><body><h1>{title}</h1>"]
+    facts = []
+    for section in range(sections):
+        html.append(f"<h2>{_make_name(rng)}</h2>")
+        fact_paragraph = rng.randrange(3)
+        for paragraph in range(3):
+            words = [rng.choice(FILLER_WORDS) for _ in range(rng.randint(60, 120))]
+            if paragraph == fact_paragraph:
+                building, founder, year = _make_name(rng), _make_name(rng), rng.randint(1100, 1950)
+                fact = f"The {building} library was founded by {founder} in {year}."
+                words.insert(rng.randrange(len(words)), fact)
+                facts.append((f"Who founded the {building} library and when?", fact))
+            html.append(f"<p>{' '.join(words)}</p>")
+    html.append("</body></html>")
+    return "\n".join(html), facts
+
+
+class SavedPagesTool(AskPagesTool):
+    """AskPagesTool reading pages from disk through the same streaming extraction as downloaded pages."""
+    pages: Dict[str, str]
+
+    def fetch_page(self, url: str, should_stop: Optional[Callable[[], bool]] = None) -> str:
+        with open(self.pages[url], "rb") as f:
+            return extract_page_text(iter(lambda: f.read(16 * 1024), b""), self.max_page_bytes, self.max_page_tokens,
+                                     should_stop=should_stop)
+
+
+async def run_mode(use_tree_summarize: bool, pages: Dict[str, str], questions: List[Tuple[str, str, Optional[str]]],
+                   args: argparse.Namespace) -> Dict[str, Any]:
+    llm = FakeChatModel(latency=args.llm_latency, tokens_per_second=args.llm_tokens_per_second)
+    tool = SavedPagesTool(llm=llm, pages=pages, use_tree_summarize=use_tree_summarize, chunk_tokens=args.chunk_tokens,
+                          top_k_chunks=args.top_k_chunks, max_page_tokens=args.max_page_tokens)
+    latencies, calls, prompt_tokens, completion_tokens, found_facts = [], [], [], [], []
+    for url, question, fact in questions:
+        calls_before, prompt_before, completion_before = llm.calls, llm.prompt_tokens, llm.completion_tokens
+        with Stopwatch() as stopwatch:
+            await tool._arun_single(url, question)
+        latencies.append(stopwatch.elapsed)
+        calls.append(llm.calls - calls_before)
+        prompt_tokens.append(llm.prompt_tokens - prompt_before)
+        completion_tokens.append(llm.completion_tokens - completion_before)
+        if fact is not None:
+            # TreeSummarize reads the whole page
+            fragments = [tool._load_page(url).text] if use_tree_summarize else \
+                tool._select_page_fragments(tool._load_page(url).text, question)
+            found_facts.append(any(fact in " ".join(fragment.split()) for fragment in fragments))
+    return {
+        "latency": summarize_latencies(latencies),
+        "llm_calls_per_question": sum(calls) / len(calls),
+        "prompt_tokens_per_question": sum(prompt_tokens) / len(prompt_tokens),
+        "completion_tokens_per_question": sum(completion_tokens) / len(completion_tokens),
+        "fact_recall": sum(found_facts) / len(found_facts) if found_facts else None,
+    }
+
+
+def main():
+    args = get_parser().parse_args()
+    use_approximate_tokenizer()
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as pages_dir:
+        pages = {f"file://{os.path.abspath(path)}": path for path in args.pages}
+        questions = [(url, question, None) for url in pages for question in args.questions]
+        if not args.pages:
+            for i in range(args.generated_pages):
+                html, facts = generate_page(rng, args.sections)
+                path = os.path.join(pages_dir, f"page_{i}.html")
+                with open(path, "w") as f:
+                    f.write(html)
+                url = f"https://example.com/page_{i}"
+                pages[url] = path
+                questions += [(url, question, fact) for question, fact in rng.sample(facts, args.questions_per_page)]
+        results = {
+            mode: asyncio.run(run_mode(mode == "tree_summarize", pages, questions, args))
+            for mode in ["tree_summarize", "bm25"]
+        }
+    for mode, result in results.items():
+        recall = "" if result["fact_recall"] is None else f", fact recall {result['fact_recall']:.2f}"
+        print(f"{mode:>14}: {result['llm_calls_per_question']:.1f} llm calls, "
+              f"{result['prompt_tokens_per_question']:.0f} prompt and "
+              f"{result['completion_tokens_per_question']:.0f} completion tokens per question, "
+              f"latency p50 {result['latency']['p50']:.2f}s p95 {result['latency']['p95']:.2f}s{recall}")
+    write_results(args.output, "ask_pages", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+from typing import List, Optional, Any, Dict, Callable
+
+import numpy as np
+from langchain.callbacks.manager import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.llms.utils import enforce_stop_tokens
+from langchain.schema import BaseMessage, ChatResult, ChatGeneration, AIMessage, SystemMessage, HumanMessage, \
+    FunctionMessage
+from pydantic import PrivateAttr
+
+from agents.function_calling import format_functions
+from agents.helper_agent import WEB_SEARCH_DISABLED_INSTRUCTION
+from agents.openai_scheduler import TokenBucket
+from agents.tools import WebSearchTool, AskPagesTool
+
+
+def _stable_fraction(text: str, salt: str) -> float:
+    return zlib.crc32(f"{salt}:{text}".encode()) % 1000 / 1000
+
+
+def _approx_num_tokens(text: str) -> int:
+    # tiktoken needs to download its vocabularies, so offline we use the usual ~4 chars per token estimate
+    return max(1, len(text) // 4)
+
+
+def use_approximate_tokenizer():
+    """llama_index counts tokens with tiktoken, this makes it use the offline estimate instead."""
+    from llama_index.utils import globals_helper
+    globals_helper._tokenizer = lambda text: re.findall(r"\S{1,4}", text)
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic stand-in for ChatOpenAI that plays HelperAgent, WebResearcherAgent and MemoryConsolidator roles.
+
+    Latency of every call is `latency + output_tokens / tokens_per_second`. At most max_concurrency async calls run
+    at once, like with a rate limited API, the rest wait in the queue.
+    Decisions (web search, new topic) depend only on the user request, so runs are reproducible.
+    Agents are answered with json in the text, or with a function call if functions are passed.
+    """
+    latency: float = 0.5
+    tokens_per_second: float = 50.0
+    answer_words: int = 40
+    web_search_ratio: float = 0.0
+    new_topic_ratio: float = 0.1
+    # share of researcher runs asking top search results pages after web search
+    ask_urls_ratio: float = 0.0
+    # share of agent steps with broken json (an unescaped quote), in the text or in function arguments
+    malformed_output_ratio: float = 0.0
+    max_concurrency: Optional[int] = None
+    malformed_outputs: int = 0
+    # async calls waiting for a free slot
+    queue_depth: int = 0
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    _slots: Optional[asyncio.Semaphore] = PrivateAttr(default=None)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    @staticmethod
+    def _last_human_message(messages: List[BaseMessage]) -> str:
+        for message in reversed(messages):
+            if isinstance(message, HumanMessage):
+                return message.content
+        return ""
+
+    def _answer(self, request: str) -> str:
+        words = (request.split() or ["ok"]) * self.answer_words
+        return " ".join(words[:self.answer_words])
+
+    def _helper_response(self, request: str, has_observation: bool, web_search: bool = True) -> Dict[str, Any]:
+        if web_search and not has_observation and _stable_fraction(request, "web_search") < self.web_search_ratio:
+            return {
+                "thoughts": "I need fresh information from the internet.",
+                "self_criticism": "Web search is slow, but I can not answer without it.",
+                "action": "web_search",
+                "action_input": f"Find information for: {request}",
+            }
+        return {
+            "thoughts": "I can answer directly.",
+            "self_criticism": "The answer may be too short.",
+            "action": "final_answer",
+            "action_input": self._answer(request),
+            "new_topic_started": _stable_fraction(request, "new_topic") < self.new_topic_ratio,
+            "updated_conversation_summary": f"User asked: {request}",
+            "updated_important_info": "User likes benchmarks.",
+        }
+
+    def _researcher_response(self, request: str, observations: List[str]) -> Dict[str, Any]:
+        if not observations:
+            return {
+                "thoughts": "Let me search first.",
+                "self_criticism": "Snippets may be not enough.",
+                "action": "web_search",
+                "action_input": request,
+            }
+        if len(observations) == 1 and _stable_fraction(request, "ask_urls") < self.ask_urls_ratio:
+            return {
+                "thoughts": "Snippets are not enough, let me read the top results.",
+                "self_criticism": "Reading pages is slow.",
+                "action": "ask_urls",
+                "action_input": json.dumps({
+                    "urls": re.findall(r"https://example\.com/[\w/]+", observations[0])[:2], "questions": [request]
+                }),
+            }
+        return {
+            "thoughts": "Snippets are enough to answer.",
+            "self_criticism": "I did not visit the pages.",
+            "action": "final_answer",
+            "action_input": self._answer(request),
+        }
+
+    @staticmethod
+    def _merge_summaries(request: str) -> str:
+        # summaries are "date:\ntext" blocks, the most detailed one stands for the merge
+        return max((block.split("\n", 1)[-1] for block in request.split("\n\n")), key=len)
+
+    @staticmethod
+    def _trim_important_info(request: str) -> str:
+        # request is "Today is <date time>" and important info, facts marked with a past date are expired
+        today_line, _, important_info = request.partition("\n\n")
+        today = today_line.split()[2]
+        return "\n".join(line for line in important_info.splitlines()
+                         if all(date >= today for date in re.findall(r"\d{4}-\d{2}-\d{2}", line)))
+
+    @staticmethod
+    def _to_function_call(response: Dict[str, Any]) -> Dict[str, str]:
+        # thoughts are not needed with function calling, after-thoughts are arguments of final_answer
+        response = {key: value for key, value in response.items() if key not in ["thoughts", "self_criticism"]}
+        action, action_input = response.pop("action"), response.pop("action_input")
+        if action == "final_answer":
+            arguments = {"answer": action_input, **response}
+        elif action == "ask_urls":
+            arguments = json.loads(action_input)
+        else:
+            arguments = {"input": action_input}
+        return {"name": action, "arguments": json.dumps(arguments)}
+
+    @staticmethod
+    def _break_json(text: str) -> str:
+        # the first string value gets a quote which is not escaped
+        return re.sub(r'(: \[?")', r'\1Quote: "', text, count=1)
+
+    def _is_malformed(self, request: str, messages: List[BaseMessage]) -> bool:
+        # depends on the step, so a regenerated step may succeed
+        if _stable_fraction(f"{request}:{len(messages)}", "malformed") < self.malformed_output_ratio:
+            self.malformed_outputs += 1
+            return True
+        return False
+
+    def _respond(self, messages: List[BaseMessage], stop: Optional[List[str]],
+                 functions: Optional[List[Dict[str, Any]]] = None) -> AIMessage:
+        request = self._last_human_message(messages)
+        system_text = "\n".join(message.content for message in messages if isinstance(message, SystemMessage))
+        role_text = system_text + json.dumps(functions or [])
+        observations = [message.content for message in messages if isinstance(message, FunctionMessage)]
+        if "updated_conversation_summary" in role_text:
+            response = self._helper_response(
+                request, bool(observations), web_search=WEB_SEARCH_DISABLED_INSTRUCTION not in system_text)
+        elif "ask_urls" in role_text:
+            response = self._researcher_response(request, observations)
+        elif "Merge the following conversation summaries" in system_text:
+            return AIMessage(content=self._merge_summaries(request))
+        elif "important info that a conversational bot remembers" in system_text:
+            return AIMessage(content=self._trim_important_info(request))
+        else:
+            return AIMessage(content=self._answer(request))
+        if functions:
+            function_call = self._to_function_call(response)
+            if self._is_malformed(request, messages):
+                function_call["arguments"] = self._break_json(function_call["arguments"])
+            return AIMessage(content="", additional_kwargs={"function_call": function_call})
+        text = json.dumps(response, indent=4)
+        if self._is_malformed(request, messages):
+            text = self._break_json(text)
+        text = "```json\n" + text + "\n```"
+        if stop:
+            text = enforce_stop_tokens(text, stop)
+        return AIMessage(content=text)
+
+    @staticmethod
+    def _message_tokens(message: BaseMessage) -> int:
+        function_call = message.additional_kwargs.get("function_call")
+        return _approx_num_tokens(message.content + (json.dumps(function_call) if function_call else ""))
+
+    def _account(self, messages: List[BaseMessage], message: AIMessage,
+                 functions: Optional[List[Dict[str, Any]]] = None) -> float:
+        self.calls += 1
+        self.prompt_tokens += sum(self._message_tokens(message) for message in messages)
+        if functions:
+            self.prompt_tokens += _approx_num_tokens(format_functions(functions))
+        completion_tokens = self._message_tokens(message)
+        self.completion_tokens += completion_tokens
+        return self.latency + completion_tokens / self.tokens_per_second
+
+    def _generate(
+            self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self._respond(messages, stop, kwargs.get("functions"))
+        time.sleep(self._account(messages, message, kwargs.get("functions")))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(
+            self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self._respond(messages, stop, kwargs.get("functions"))
+        if self.max_concurrency is None:
+            await asyncio.sleep(self._account(messages, message, kwargs.get("functions")))
+            return ChatResult(generations=[ChatGeneration(message=message)])
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        self.queue_depth += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queue_depth -= 1
+        try:
+            await asyncio.sleep(self._account(messages, message, kwargs.get("functions")))
+        finally:
+            self._slots.release()
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings: every word is hashed into one signed bucket.
+
+    Every call takes `latency + latency_per_text * len(texts)` seconds, like a remote embeddings API.
+    """
+
+    def __init__(self, dim: int = 256, latency: float = 0.0, latency_per_text: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+        self.calls = 0
+        self.embedded_texts = 0
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            word_hash = zlib.crc32(word.encode())
+            vector[word_hash % self.dim] += 1.0 if (word_hash >> 16) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        self.embedded_texts += len(texts)
+        time.sleep(self.latency + self.latency_per_text * len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeWebSearchTool(WebSearchTool):
+    latency: float = 0.3
+
+    def _search(self, query: str) -> List[Dict[str, str]]:
+        # blocking, like the real search client
+        time.sleep(self.latency)
+        slug = zlib.crc32(query.encode())
+        return [{
+            "snippet": f"Snippet {i} about {query}",
+            "title": f"Result {i}",
+            "link": f"https://example.com/{slug}/{i}",
+        } for i in range(self.num_results)]
+
+
+class FakeAskPagesTool(AskPagesTool):
+    latency: float = 0.5
+    page_words: int = 2000
+    fetched_pages: int = 0
+
+    def fetch_page(self, url: str, should_stop: Optional[Callable[[], bool]] = None) -> str:
+        self.fetched_pages += 1
+        deadline = time.monotonic() + self.latency
+        # the page "downloads" in pieces, so it can be stopped like the real one
+        while time.monotonic() < deadline:
+            if should_stop is not None and should_stop():
+                return ""
+            time.sleep(min(0.01, max(0.0, deadline - time.monotonic())))
+        words = [f"word{zlib.crc32(f'{url}{i}'.encode()) % 5000}" for i in range(self.page_words)]
+        return " ".join(words)
+
+
+class FakeSpeech:
+    """Replacements for speech.utils functions, with the same signatures and blocking behaviour."""
+
+    def __init__(self, stt_latency: float = 1.0, tts_latency: float = 1.0, conversion_latency: float = 0.1,
+                 transcript: str = "Tell me something interesting"):
+        self.stt_latency = stt_latency
+        self.tts_latency = tts_latency
+        self.conversion_latency = conversion_latency
+        self.transcript = transcript
+
+    def ogg_to_mp3(self, ogg_path: str, mp3_path: str):
+        time.sleep(self.conversion_latency)
+        with open(mp3_path, "wb") as f:
+            f.write(b"\0" * 1024)
+
+    def mp3_to_text(self, mp3_path: str) -> str:
+        time.sleep(self.stt_latency)
+        return self.transcript
+
+    def text_to_mp3_multi_language(self, text: str, mp3_path: str) -> Optional[str]:
+        time.sleep(self.tts_latency)
+        with open(mp3_path, "wb") as f:
+            f.write(b"\0" * 1024)
+        return mp3_path
+
+
+class FakeTelegramFile:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def download_to_drive(self, path: str):
+        await asyncio.sleep(self.latency)
+        with open(path, "wb") as f:
+            f.write(b"\0" * 1024)
+
+
+class FakeTelegramMessage:
+    """Minimal subset of telegram.Message used by TelegramBot handlers."""
+
+    def __init__(self, user_id: int, text: Optional[str] = None, voice: bool = False, latency: float = 0.05):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.text = text
+        self.voice = SimpleNamespace(file_id=f"voice-{user_id}") if voice else None
+        self.latency = latency
+        self.replies = []
+
+    async def reply_text(self, text: str, **kwargs: Any):
+        await asyncio.sleep(self.latency)
+        self.replies.append(text)
+
+    async def reply_voice(self, voice: str, caption: str = "", **kwargs: Any):
+        await asyncio.sleep(self.latency)
+        self.replies.append(caption)
+        assert os.path.exists(voice)
+
+
+def fake_telegram_update(
+        user_id: int, text: Optional[str] = None, voice: bool = False,
+        latency: float = 0.05) -> SimpleNamespace:
+    return SimpleNamespace(message=FakeTelegramMessage(user_id, text=text, voice=voice, latency=latency))
+
+
+def fake_telegram_context(latency: float = 0.05) -> SimpleNamespace:
+    async def get_file(file_id: str) -> FakeTelegramFile:  # noqa
+        await asyncio.sleep(latency)
+        return FakeTelegramFile(latency)
+
+    return SimpleNamespace(bot=SimpleNamespace(getFile=get_file))
+
+
+class FakeOpenAIServer:
+    """Local HTTP server with the subset of OpenAI API used by the bot: chat completions, embeddings and
+    transcriptions. It enforces its own requests per minute limit and answers 429 above it, like the real API.
+    Use `api_base` as openai_api_base of ChatOpenAI or as openai.api_base. Example:
+        with FakeOpenAIServer(requests_per_minute=600) as server:
+            llm = ChatOpenAI(openai_api_base=server.api_base, openai_api_key="fake")
+    """
+
+    def __init__(self, latency: float = 0.0, requests_per_minute: Optional[float] = None, burst_seconds: float = 60.0,
+                 fail_first: int = 0, retry_after: Optional[float] = None, embedding_dim: int = 8):
+        self.latency = latency
+        self.fail_first = fail_first
+        self.retry_after = retry_after
+        self.embedding_dim = embedding_dim
+        self.requests = TokenBucket(requests_per_minute, burst_seconds)
+        self.received = 0
+        self.rejected = 0
+        self.completed = 0
+        self.concurrency = 0
+        self.max_concurrency = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._get_handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _admit(self) -> bool:
+        with self._lock:
+            self.received += 1
+            now = time.monotonic()
+            if self.received <= self.fail_first or self.requests.time_until_available(1, now) > 0:
+                self.rejected += 1
+                return False
+            self.requests.consume(1, now)
+            self.concurrency += 1
+            self.max_concurrency = max(self.max_concurrency, self.concurrency)
+            return True
+
+    def _respond(self, path: str, body: bytes) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        if path.endswith("/audio/transcriptions"):
+            return {"text": "Tell me something interesting"}
+        request = json.loads(body)
+        if path.endswith("/embeddings"):
+            inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+            embedding = [1.0 / self.embedding_dim] * self.embedding_dim
+            return {
+                "object": "list", "model": request["model"],
+                "data": [{"object": "embedding", "index": i, "embedding": embedding} for i in range(len(inputs))],
+                "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+            }
+        prompt = " ".join(message.get("content") or "" for message in request["messages"])
+        answer = f"Fake answer to: {request['messages'][-1].get('content', '')[:50]}"
+        prompt_tokens, completion_tokens = _approx_num_tokens(prompt), _approx_num_tokens(answer)
+        return {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": request["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def _get_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):  # noqa
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not server._admit():
+                    self._send(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                               {"Retry-After": str(server.retry_after)} if server.retry_after is not None else {})
+                    return
+                try:
+                    self._send(200, server._respond(self.path, body))
+                finally:
+                    with server._lock:
+                        server.concurrency -= 1
+                        server.completed += 1
+
+            def _send(self, code: int, response: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+                data = json.dumps(response).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,49 @@
+"""Benchmark of agent executor modes: json in the message text parsed by ActionParser versus function calling.
+Compares prompt and completion tokens and llm calls per request, broken outputs and failed requests. Runs the load
+benchmark with the same arguments in both modes, so the same fake model answers the same requests. Example:
+    python -m benchmarks.function_calling_benchmark --users 10 --malformed_output_ratio 0.05 --output modes.json
+"""
+import argparse
+import asyncio
+from typing import Dict, Any
+
+from benchmarks.load_benchmark import get_parser as get_load_parser, run_benchmark
+from benchmarks.utils import write_results
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = get_load_parser()
+    parser.set_defaults(web_search_ratio=0.3, ask_urls_ratio=0.5, malformed_output_ratio=0.05)
+    return parser
+
+
+def summarize(results: Dict[str, Any]) -> Dict[str, Any]:
+    requests = results["latency"]["count"]
+    return {
+        "prompt_tokens_per_request": results["llm"]["prompt_tokens"] / requests,
+        "completion_tokens_per_request": results["llm"]["completion_tokens"] / requests,
+        "llm_calls_per_request": results["llm"]["calls"] / requests,
+        "malformed_outputs": results["llm"]["malformed_outputs"],
+        "failed_requests": results["errors"],
+        "latency": results["latency"],
+    }
+
+
+def main():
+    args = get_parser().parse_args()
+    results = {}
+    for mode in ["text_json", "function_calling"]:
+        args.use_function_calling = mode == "function_calling"
+        results[mode] = summarize(asyncio.run(run_benchmark(args)))
+    for mode, result in results.items():
+        print(f"{mode:>16}: {result['prompt_tokens_per_request']:.0f} prompt and "
+              f"{result['completion_tokens_per_request']:.0f} completion tokens, "
+              f"{result['llm_calls_per_request']:.2f} llm calls per request, "
+              f"{result['malformed_outputs']} broken outputs, {result['failed_requests']} failed requests, "
+              f"p95 {result['latency']['p95']:.2f}s")
+    args.use_function_calling = None
+    write_results(args.output, "function_calling", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Offline end-to-end load benchmark of HelperAgent and TelegramBot handlers.
+
+All remote services (chat LLM, embeddings, web search, pages, STT, TTS, Telegram) are replaced with local fakes,
+so results depend only on the code under test. Example:
+    python -m benchmarks.load_benchmark --target telegram_voice --users 20 --output bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import shutil
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Dict, Any, Callable, Awaitable, List, Tuple
+from unittest import mock
+
+import yaml
+
+from agents.helper_agent import HelperAgent
+from agents.load_controller import LoadController, LoadControlPolicy
+from agents.tracing import get_tracer, TracingPolicy
+from agents.web_researcher import WebResearcherAgent
+from benchmarks.fakes import FakeChatModel, HashEmbeddings, FakeWebSearchTool, FakeAskPagesTool, FakeSpeech, \
+    fake_telegram_update, fake_telegram_context
+from benchmarks.utils import summarize_latencies, EventLoopMonitor, get_max_rss_mb, write_results, Stopwatch
+from telegram_bot.tg_bot import TelegramBot
+
+TARGETS = ["agent", "telegram_text", "telegram_voice"]
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target", type=str, choices=TARGETS, default="agent")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--requests_per_user", type=int, default=5)
+    parser.add_argument("--think_time", type=float, default=0.0, help="pause between requests of one user, s")
+    parser.add_argument("--prompts_name", type=str, default="friend")
+    parser.add_argument("--llm_latency", type=float, default=0.5)
+    parser.add_argument("--llm_tokens_per_second", type=float, default=50.0)
+    parser.add_argument("--llm_max_concurrency", type=int, default=None,
+                        help="calls of every fake llm running at once, the rest wait in the queue")
+    parser.add_argument("--degraded_llm_speedup", type=float, default=3.0,
+                        help="how much faster the llm answering under load is")
+    parser.add_argument("--web_search_ratio", type=float, default=0.2)
+    parser.add_argument("--ask_urls_ratio", type=float, default=0.0, help="share of web searches followed by ask_urls")
+    parser.add_argument("--prefetch_pages", type=int, default=0, help="top search results pages to prefetch")
+    parser.add_argument("--use_function_calling", action="store_true", help="agents use function calling")
+    parser.add_argument("--malformed_output_ratio", type=float, default=0.0,
+                        help="share of agent steps with broken json")
+    parser.add_argument("--early_agent_start", action="store_true",
+                        help="memory of the user is loaded while a voice message is transcribed")
+    parser.add_argument("--new_topic_ratio", type=float, default=0.2)
+    parser.add_argument("--embedding_latency", type=float, default=0.2)
+    parser.add_argument("--ltm_batch_size", type=int, default=16)
+    parser.add_argument("--ltm_max_delay", type=float, default=1.0)
+    parser.add_argument("--search_latency", type=float, default=0.3)
+    parser.add_argument("--page_latency", type=float, default=0.5)
+    parser.add_argument("--stt_latency", type=float, default=1.0)
+    parser.add_argument("--tts_latency", type=float, default=1.0)
+    parser.add_argument("--telegram_latency", type=float, default=0.05)
+    parser.add_argument("--load_control", action="store_true", help="degrade requests when the agent is saturated")
+    parser.add_argument("--load_max_in_flight", type=int, default=20)
+    parser.add_argument("--load_max_queue_depth", type=int, default=10)
+    parser.add_argument("--load_target_latency", type=float, default=30)
+    parser.add_argument("--load_step_interval", type=float, default=5)
+    parser.add_argument("--load_recover_interval", type=float, default=30)
+    parser.add_argument("--trace_threshold", type=float, default=None,
+                        help="requests slower than this many seconds have their trace written to --trace_dir")
+    parser.add_argument("--trace_dir", type=str, default="traces")
+    parser.add_argument("--trace_memory", action="store_true", help="track python allocations with tracemalloc")
+    parser.add_argument("--verbose", action="store_true", help="do not silence agent executors output")
+    parser.add_argument("--output", type=str, default="bench_output.json")
+    return parser
+
+
+def load_prompts(prompts_name: str) -> Dict[str, str]:
+    with open(Path(__file__).parents[1] / "prompts" / f"{prompts_name}.yaml", "r") as f:
+        return yaml.safe_load(f)
+
+
+def build_agent(save_path: str, args: argparse.Namespace) -> Tuple[HelperAgent, FakeChatModel, HashEmbeddings]:
+    behaviour = dict(
+        web_search_ratio=args.web_search_ratio, new_topic_ratio=args.new_topic_ratio,
+        ask_urls_ratio=args.ask_urls_ratio, malformed_output_ratio=args.malformed_output_ratio,
+        max_concurrency=args.llm_max_concurrency
+    )
+    llm = FakeChatModel(latency=args.llm_latency, tokens_per_second=args.llm_tokens_per_second, **behaviour)
+    # another model, with its own queue
+    degraded_llm = FakeChatModel(latency=args.llm_latency / args.degraded_llm_speedup,
+                                 tokens_per_second=args.llm_tokens_per_second * args.degraded_llm_speedup, **behaviour)
+    load_control = None
+    if args.load_control:
+        load_control = LoadControlPolicy(
+            max_in_flight=args.load_max_in_flight, max_queue_depth=args.load_max_queue_depth,
+            target_latency=args.load_target_latency, step_interval=args.load_step_interval,
+            recover_interval=args.load_recover_interval)
+    embeddings = HashEmbeddings(latency=args.embedding_latency)
+    web_researcher = WebResearcherAgent(
+        load_prompts("web_researcher"), smart_llm=llm, fast_llm=llm,
+        web_search_tool=FakeWebSearchTool(latency=args.search_latency),
+        ask_url_tool=FakeAskPagesTool(llm=llm, latency=args.page_latency),
+        prefetch_pages=args.prefetch_pages, use_function_calling=args.use_function_calling,
+    )
+    agent = HelperAgent(
+        save_path, load_prompts(args.prompts_name), web_researcher,
+        smart_llm=llm, fast_llm=llm, long_term_memory_embeddings=embeddings,
+        long_term_memory_batch_size=args.ltm_batch_size, long_term_memory_max_delay=args.ltm_max_delay,
+        use_function_calling=args.use_function_calling, degraded_llm=degraded_llm,
+        load_controller=LoadController(load_control, queue_depth=lambda: llm.queue_depth + degraded_llm.queue_depth)
+    )
+    return agent, llm, embeddings
+
+
+def get_request_sender(
+        target: str, agent: HelperAgent, args: argparse.Namespace) -> Callable[[int, str], Awaitable[str]]:
+    if target == "agent":
+        return agent.arun
+
+    bot = TelegramBot(token="0:offline", agent=agent, greetings_message="", early_agent_start=args.early_agent_start,
+                      load_controller=agent.load_controller)
+
+    async def send(user_id: int, text: str) -> str:
+        update = fake_telegram_update(
+            user_id, text=text, voice=target == "telegram_voice", latency=args.telegram_latency)
+        context = fake_telegram_context(latency=args.telegram_latency)
+        if target == "telegram_voice":
+            await bot.voice_handler(update, context)  # noqa
+        else:
+            await bot.text_handler(update, context)  # noqa
+        return update.message.replies[-1]
+
+    return send
+
+
+async def run_user(
+        user_id: int, args: argparse.Namespace, send: Callable[[int, str], Awaitable[str]],
+        latencies: List[float], errors: List[str]):
+    for i in range(args.requests_per_user):
+        with Stopwatch() as stopwatch:
+            try:
+                answer = await send(user_id, f"User {user_id} asks question {i} about topic {i % 3}")
+                if answer.startswith("Error in telegram bot"):
+                    errors.append(answer)
+            except Exception as e:
+                errors.append(repr(e))
+        latencies.append(stopwatch.elapsed)
+        await asyncio.sleep(args.think_time)
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    save_path = tempfile.mkdtemp()
+    speech = FakeSpeech(stt_latency=args.stt_latency, tts_latency=args.tts_latency)
+    try:
+        agent, llm, embeddings = build_agent(save_path, args)
+        send = get_request_sender(args.target, agent, args)
+        latencies, errors = [], []
+        monitor = EventLoopMonitor()
+        rss_before = get_max_rss_mb()
+        if args.trace_memory:
+            tracemalloc.start()
+        if args.trace_threshold is not None:
+            get_tracer().configure(TracingPolicy(threshold=args.trace_threshold, trace_dir=args.trace_dir))
+        written_traces = get_tracer().written_traces
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with mock.patch.multiple(
+                "telegram_bot.tg_bot", ogg_to_mp3=speech.ogg_to_mp3, mp3_to_text=speech.mp3_to_text,
+                text_to_mp3_multi_language=speech.text_to_mp3_multi_language), output, Stopwatch() as stopwatch:
+            monitor.start()
+            await asyncio.gather(*[
+                run_user(user_id, args, send, latencies, errors) for user_id in range(args.users)
+            ])
+            await monitor.stop()
+        await agent.long_term_memory_queue.close()
+        results = {
+            "wall_time": stopwatch.elapsed,
+            "throughput": len(latencies) / stopwatch.elapsed,
+            "latency": summarize_latencies(latencies),
+            "errors": len(errors),
+            "first_errors": errors[:5],
+            "event_loop": monitor.summary(),
+            "written_traces": get_tracer().written_traces - written_traces,
+            "memory": {"max_rss_mb": get_max_rss_mb(), "max_rss_growth_mb": get_max_rss_mb() - rss_before},
+            "llm": {"calls": llm.calls, "prompt_tokens": llm.prompt_tokens,
+                    "completion_tokens": llm.completion_tokens, "malformed_outputs": llm.malformed_outputs,
+                    "degraded_calls": agent.degraded_llm.calls},
+            "load_control": agent.load_controller.metrics(),
+            "embeddings": {"calls": embeddings.calls, "texts": embeddings.embedded_texts,
+                           "committed_memories": agent.long_term_memory_queue.committed_memories},
+        }
+        if agent.web_researcher_agent.page_prefetcher is not None:
+            results["page_prefetch"] = agent.web_researcher_agent.page_prefetcher.metrics()
+            agent.web_researcher_agent.page_prefetcher.close()
+        if args.trace_memory:
+            results["memory"]["python_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        return results
+    finally:
+        if args.trace_threshold is not None:
+            get_tracer().configure(None)
+        shutil.rmtree(save_path)
+
+
+def main():
+    args = get_parser().parse_args()
+    results = asyncio.run(run_benchmark(args))
+    write_results(args.output, "load", vars(args), results)
+    latency = results["latency"]
+    print(f"{args.target}: {latency['count']} requests, {results['throughput']:.2f} req/s, "
+          f"p50 {latency['p50']:.2f}s, p95 {latency['p95']:.2f}s, p99 {latency['p99']:.2f}s, "
+          f"event loop blocked {results['event_loop']['blocked_time']:.2f}s, errors {results['errors']}")
+
+
+if __name__ == "__main__":
+    main()
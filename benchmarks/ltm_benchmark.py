@@ -0,0 +1,144 @@
+"""Offline benchmark of long-term memory index types on synthetic memories and hash embeddings.
+
+For every number of memories and index type reports recall@k against exact search, query latency,
+load latency, on-disk and in-RAM size. Example:
+    python -m benchmarks.ltm_benchmark --sizes 10 1000 100000 --output ltm.json
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+from typing import List, Dict, Any, Tuple
+
+import faiss
+import numpy as np
+
+from agents.long_term_memory import LongTermMemory, LongTermMemoryIndexPolicy, INDEX_TYPES
+from benchmarks.fakes import HashEmbeddings
+from benchmarks.utils import summarize_latencies, write_results, Stopwatch
+
+# smaller sets do not have enough points to train the coarse quantizer and 16 centroids per PQ subspace
+IVFPQ_MIN_ENTRIES = 1000
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--index_types", type=str, nargs="+", default=INDEX_TYPES + ["auto"])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--words_per_memory", type=int, default=30)
+    parser.add_argument("--memories_per_topic", type=int, default=100)
+    parser.add_argument("--words_per_topic", type=int, default=40)
+    parser.add_argument("--vocabulary_size", type=int, default=2000, help="words shared by all topics")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="bench_output.json")
+    return parser
+
+
+def generate_memories(n: int, args: argparse.Namespace, rng: random.Random) -> List[str]:
+    # two thirds of words come from the memory topic and the rest from the common vocabulary,
+    # so memories form clusters like real conversation summaries do
+    vocabulary = [f"word{i}" for i in range(args.vocabulary_size)]
+    topics = [[f"topic{topic}word{i}" for i in range(args.words_per_topic)]
+              for topic in range(max(1, n // args.memories_per_topic))]
+    topic_words = args.words_per_memory * 2 // 3
+    return [" ".join(rng.choices(rng.choice(topics), k=topic_words) +
+                     rng.choices(vocabulary, k=args.words_per_memory - topic_words)) for _ in range(n)]
+
+
+def generate_queries(memories: List[str], args: argparse.Namespace, rng: random.Random) -> List[str]:
+    # a query shares half of the words with some memory, like a new message on an old topic
+    queries = []
+    for memory in rng.choices(memories, k=args.queries):
+        words = memory.split()
+        queries.append(" ".join(rng.sample(words, len(words) // 2)))
+    return queries
+
+
+def get_folder_size(folder_path: str) -> int:
+    return sum(os.path.getsize(os.path.join(folder_path, name)) for name in os.listdir(folder_path))
+
+
+def exact_kth_distances(vectors: np.ndarray, query_vectors: np.ndarray, k: int) -> np.ndarray:
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    return index.search(query_vectors, k)[0][:, -1]
+
+
+def get_recall(vectors: np.ndarray, query_vector: np.ndarray, found_ids: List[int], kth_distance: float, k: int
+               ) -> float:
+    # a found memory is a hit if it is not farther than the k-th exact neighbour, so ties do not count as misses
+    distances = ((vectors[found_ids] - query_vector) ** 2).sum(axis=1)
+    return float((distances <= kth_distance + 1e-5).sum()) / k
+
+
+def benchmark_index(
+        index_type: str, memories: List[str], vectors: np.ndarray, queries: List[str], query_vectors: np.ndarray,
+        kth_distances: np.ndarray, embeddings: HashEmbeddings, args: argparse.Namespace) -> Dict[str, Any]:
+    policy = LongTermMemoryIndexPolicy(forced_index_type=None if index_type == "auto" else index_type)
+    folder_path = tempfile.mkdtemp()
+    try:
+        metadatas = [{"id": i} for i in range(len(memories))]
+        with Stopwatch() as build_stopwatch:
+            memory = LongTermMemory.from_vectors(folder_path, vectors, memories, embeddings, policy, metadatas)
+            memory.save()
+        with Stopwatch() as load_stopwatch:
+            memory = LongTermMemory.load(folder_path, embeddings, policy)
+        k = min(args.k, len(memories))
+        recalls, latencies = [], []
+        for query, query_vector, kth_distance in zip(queries, query_vectors, kth_distances):
+            with Stopwatch() as query_stopwatch:
+                documents = memory.similarity_search(query, k=k)
+            latencies.append(query_stopwatch.elapsed)
+            found_ids = [document.metadata["id"] for document in documents]
+            recalls.append(get_recall(vectors, query_vector, found_ids, kth_distance, k))
+        return {
+            "index_type": memory.index_type,
+            "build_time": build_stopwatch.elapsed,
+            "load_time": load_stopwatch.elapsed,
+            f"recall@{k}": sum(recalls) / len(recalls),
+            "query_latency": summarize_latencies(latencies),
+            "disk_bytes": get_folder_size(folder_path),
+            "ram_bytes": memory.size_in_ram(),
+        }
+    finally:
+        shutil.rmtree(folder_path)
+
+
+def run_size(n: int, args: argparse.Namespace) -> Tuple[int, Dict[str, Any]]:
+    rng = random.Random(args.seed)
+    embeddings = HashEmbeddings(dim=args.dim)
+    memories = generate_memories(n, args, rng)
+    queries = generate_queries(memories, args, rng)
+    vectors = np.asarray(embeddings.embed_documents(memories), dtype=np.float32)
+    query_vectors = np.asarray(embeddings.embed_documents(queries), dtype=np.float32)
+    kth_distances = exact_kth_distances(vectors, query_vectors, min(args.k, n))
+    results = {}
+    for index_type in args.index_types:
+        if index_type == "ivfpq" and n < IVFPQ_MIN_ENTRIES:
+            continue
+        results[index_type] = benchmark_index(
+            index_type, memories, vectors, queries, query_vectors, kth_distances, embeddings, args)
+    return n, results
+
+
+def main():
+    args = get_parser().parse_args()
+    results = {}
+    for n in args.sizes:
+        n, size_results = run_size(n, args)
+        results[str(n)] = size_results
+        for index_type, result in size_results.items():
+            print(f"{n:>7} memories, {index_type:>5} ({result['index_type']}): "
+                  f"recall@{min(args.k, n)} {result[f'recall@{min(args.k, n)}']:.3f}, "
+                  f"query p50 {result['query_latency']['p50'] * 1000:.2f}ms, "
+                  f"load {result['load_time'] * 1000:.1f}ms, "
+                  f"disk {result['disk_bytes'] / 2 ** 20:.2f}MB, ram {result['ram_bytes'] / 2 ** 20:.2f}MB")
+    write_results(args.output, "ltm", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark of long-term memory writes: one embeddings call per memory while user waits (as before the ingestion
+queue) versus HelperAgent.long_term_memory_queue with batched embeddings calls. Example:
+    python -m benchmarks.ltm_ingestion_benchmark --users 50 --batch_sizes 1 8 32 --output ltm_ingestion.json
+"""
+import argparse
+import asyncio
+import random
+import shutil
+import tempfile
+from datetime import datetime
+from typing import Dict, Any, List
+
+import numpy as np
+
+from benchmarks import load_benchmark
+from benchmarks.utils import summarize_latencies, write_results, Stopwatch, EventLoopMonitor
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--memories_per_user", type=int, default=5)
+    parser.add_argument("--mean_interval", type=float, default=0.5, help="mean pause between memories of one user")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--max_delay", type=float, default=0.5)
+    parser.add_argument("--embedding_latency", type=float, default=0.2, help="fixed cost of one embeddings call")
+    parser.add_argument("--embedding_latency_per_text", type=float, default=0.005)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="bench_output.json")
+    return parser
+
+
+def build_agent(save_path: str, args: argparse.Namespace, batch_size: int):
+    agent_args = load_benchmark.get_parser().parse_args([
+        "--embedding_latency", str(args.embedding_latency),
+        "--ltm_batch_size", str(batch_size), "--ltm_max_delay", str(args.max_delay),
+    ])
+    agent, _, embeddings = load_benchmark.build_agent(save_path, agent_args)
+    embeddings.latency_per_text = args.embedding_latency_per_text
+    return agent, embeddings
+
+
+async def run_user(user_id: int, write, args: argparse.Namespace, rng: random.Random, latencies: List[float]):
+    for i in range(args.memories_per_user):
+        await asyncio.sleep(rng.expovariate(1 / args.mean_interval))
+        with Stopwatch() as stopwatch:
+            await write(user_id, f"User {user_id} talked about topic {i}")
+        latencies.append(stopwatch.elapsed)
+
+
+async def run_mode(mode: str, batch_size: int, args: argparse.Namespace) -> Dict[str, Any]:
+    save_path = tempfile.mkdtemp()
+    try:
+        agent, embeddings = build_agent(save_path, args, batch_size)
+
+        async def write_direct(user_id: int, memory: str):
+            vectors = np.asarray(embeddings.embed_documents([memory]), dtype=np.float32)
+            agent._add_to_long_term_memory(user_id, vectors, [memory], [{"date": datetime.now().isoformat()}])
+
+        async def write_queued(user_id: int, memory: str):
+            await agent.long_term_memory_queue.put(user_id, memory, {"date": datetime.now().isoformat()})
+
+        rng = random.Random(args.seed)
+        latencies = []
+        monitor = EventLoopMonitor()
+        with Stopwatch() as stopwatch:
+            monitor.start()
+            await asyncio.gather(*[
+                run_user(user_id, write_direct if mode == "direct" else write_queued, args, rng, latencies)
+                for user_id in range(args.users)
+            ])
+            await agent.long_term_memory_queue.close()
+            await monitor.stop()
+        memories = args.users * args.memories_per_user
+        return {
+            "wall_time": stopwatch.elapsed,
+            "throughput": memories / stopwatch.elapsed,
+            "user_visible_latency": summarize_latencies(latencies),
+            "embedding_calls": embeddings.calls,
+            "embedding_calls_per_memory": embeddings.calls / memories,
+            "event_loop": monitor.summary(),
+        }
+    finally:
+        shutil.rmtree(save_path)
+
+
+def main():
+    args = get_parser().parse_args()
+    results = {"direct": asyncio.run(run_mode("direct", 1, args))}
+    for batch_size in args.batch_sizes:
+        results[f"queued_{batch_size}"] = asyncio.run(run_mode("queued", batch_size, args))
+    for mode, result in results.items():
+        print(f"{mode:>10}: {result['throughput']:.1f} memories/s, {result['embedding_calls']} embedding calls, "
+              f"user waits p95 {result['user_visible_latency']['p95'] * 1000:.1f}ms, "
+              f"event loop blocked {result['event_loop']['blocked_time']:.2f}s")
+    write_results(args.output, "ltm_ingestion", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Benchmark of long-term memory load path: memory-mapped versus reading everything into process memory.
+
+Several worker processes load the same user memory at once, like bot workers serving one user.
+Cold runs evict the memory files from the OS page cache first. Example:
+    python -m benchmarks.ltm_load_benchmark --sizes 1000 100000 --workers 4 --output ltm_load.json
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+from typing import Dict, Any, List
+
+import numpy as np
+
+from agents.long_term_memory import LongTermMemory, LongTermMemoryIndexPolicy, INDEX_TYPES
+from benchmarks.fakes import HashEmbeddings
+from benchmarks.ltm_benchmark import generate_memories, generate_queries
+from benchmarks.utils import Stopwatch, summarize_latencies, write_results
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--index_types", type=str, nargs="+", default=INDEX_TYPES)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--words_per_memory", type=int, default=30)
+    parser.add_argument("--memories_per_topic", type=int, default=100)
+    parser.add_argument("--words_per_topic", type=int, default=40)
+    parser.add_argument("--vocabulary_size", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="bench_output.json")
+    return parser
+
+
+def get_rss_mb() -> Dict[str, float]:
+    # RssAnon is private to the process, RssFile are file pages that processes share through the OS cache
+    rss = {}
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith(("RssAnon", "RssFile")):
+                name, value = line.split(":")
+                rss[name.lower()] = int(value.split()[0]) / 1024
+    return rss
+
+
+def evict_from_page_cache(folder_path: str):
+    for name in os.listdir(folder_path):
+        fd = os.open(os.path.join(folder_path, name), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def measure_worker(folder_path: str, dim: int, use_mmap: bool, queries: List[str],
+                   barrier: multiprocessing.Barrier, results: multiprocessing.Queue):
+    embeddings = HashEmbeddings(dim=dim)
+    rss_before = get_rss_mb()
+    with Stopwatch() as load_stopwatch:
+        memory = LongTermMemory.load(folder_path, embeddings, LongTermMemoryIndexPolicy(), use_mmap=use_mmap)
+    latencies = []
+    for query in queries:
+        with Stopwatch() as query_stopwatch:
+            memory.similarity_search(query, k=1)
+        latencies.append(query_stopwatch.elapsed)
+    rss_after = get_rss_mb()
+    # all workers hold their memory at the same time, like bot workers serving the same user
+    barrier.wait()
+    results.put({
+        "load_time": load_stopwatch.elapsed,
+        "first_query_time": latencies[0],
+        "query_latency": summarize_latencies(latencies),
+        "rss_anon_growth_mb": rss_after["rssanon"] - rss_before["rssanon"],
+        "rss_file_growth_mb": rss_after["rssfile"] - rss_before["rssfile"],
+    })
+
+
+def run_workers(folder_path: str, use_mmap: bool, queries: List[str], args: argparse.Namespace
+                ) -> List[Dict[str, Any]]:
+    context = multiprocessing.get_context("spawn")
+    barrier, results = context.Barrier(args.workers), context.Queue()
+    processes = [
+        context.Process(target=measure_worker, args=(folder_path, args.dim, use_mmap, queries, barrier, results))
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    worker_results = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return worker_results
+
+
+def summarize_workers(worker_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "load_time": summarize_latencies([result["load_time"] for result in worker_results]),
+        "first_query_time": summarize_latencies([result["first_query_time"] for result in worker_results]),
+        "query_p50": float(np.median([result["query_latency"]["p50"] for result in worker_results])),
+        "private_rss_mb_per_worker": float(np.mean([result["rss_anon_growth_mb"] for result in worker_results])),
+        "private_rss_mb_total": float(np.sum([result["rss_anon_growth_mb"] for result in worker_results])),
+        "shared_rss_mb_per_worker": float(np.mean([result["rss_file_growth_mb"] for result in worker_results])),
+    }
+
+
+def run_index(n: int, index_type: str, args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    embeddings = HashEmbeddings(dim=args.dim)
+    memories = generate_memories(n, args, rng)
+    queries = generate_queries(memories, args, rng)
+    vectors = np.asarray(embeddings.embed_documents(memories), dtype=np.float32)
+    folder_path = tempfile.mkdtemp()
+    try:
+        policy = LongTermMemoryIndexPolicy(forced_index_type=index_type)
+        LongTermMemory.from_vectors(folder_path, vectors, memories, embeddings, policy).save()
+        results = {}
+        for use_mmap in [True, False]:
+            evict_from_page_cache(folder_path)
+            cold = summarize_workers(run_workers(folder_path, use_mmap, queries, args))
+            warm = summarize_workers(run_workers(folder_path, use_mmap, queries, args))
+            results["mmap" if use_mmap else "eager"] = {"cold": cold, "warm": warm}
+        return results
+    finally:
+        shutil.rmtree(folder_path)
+
+
+def main():
+    args = get_parser().parse_args()
+    results = {}
+    for n in args.sizes:
+        for index_type in args.index_types:
+            if index_type == "ivfpq" and n < 1000:
+                continue
+            results[f"{n}/{index_type}"] = run_index(n, index_type, args)
+            for mode, mode_results in results[f"{n}/{index_type}"].items():
+                print(f"{n:>7} memories, {index_type:>5}, {mode:>5}: "
+                      f"cold load p50 {mode_results['cold']['load_time']['p50'] * 1000:.1f}ms, "
+                      f"warm load p50 {mode_results['warm']['load_time']['p50'] * 1000:.1f}ms, "
+                      f"cold first query {mode_results['cold']['first_query_time']['p50'] * 1000:.1f}ms, "
+                      f"private RSS per worker {mode_results['warm']['private_rss_mb_per_worker']:.1f}MB")
+    write_results(args.output, "ltm_load", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark of OpenAI calls under bursts against a local fake API server with its own rate limit:
+plain ChatOpenAI with tenacity retries versus ScheduledChatOpenAI going through OpenAIScheduler. Example:
+    python -m benchmarks.openai_scheduler_benchmark --interactive 40 --background 120 --output scheduler.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+from typing import Dict, Any, List
+
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import HumanMessage
+
+from agents.openai_scheduler import OpenAIScheduler, ModelLimits, Priority, ScheduledChatOpenAI
+from benchmarks.fakes import FakeOpenAIServer
+from benchmarks.utils import summarize_latencies, write_results, Stopwatch
+
+MODEL_NAME = "gpt-4-0613"
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interactive", type=int, default=40, help="number of interactive requests")
+    parser.add_argument("--background", type=int, default=120, help="number of background requests")
+    parser.add_argument("--duration", type=float, default=5.0, help="requests arrive uniformly during it, s")
+    parser.add_argument("--requests_per_minute", type=float, default=1200)
+    parser.add_argument("--burst_seconds", type=float, default=1.0)
+    parser.add_argument("--api_latency", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="bench_output.json")
+    return parser
+
+
+async def send(llm: ChatOpenAI, delay: float, latencies: List[float], errors: List[str]):
+    await asyncio.sleep(delay)
+    with Stopwatch() as stopwatch:
+        try:
+            await llm.apredict_messages([HumanMessage(content="How are you?")])
+        except Exception as e:
+            errors.append(repr(e))
+    latencies.append(stopwatch.elapsed)
+
+
+async def run_mode(mode: str, args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    limits = ModelLimits(requests_per_minute=args.requests_per_minute, burst_seconds=args.burst_seconds)
+    scheduler = OpenAIScheduler({MODEL_NAME: limits})
+    with FakeOpenAIServer(latency=args.api_latency, requests_per_minute=args.requests_per_minute,
+                          burst_seconds=args.burst_seconds) as server:
+        llm_kwargs = {"model_name": MODEL_NAME, "openai_api_base": server.api_base, "openai_api_key": "fake"}
+        if mode == "scheduled":
+            interactive_llm = ScheduledChatOpenAI(**llm_kwargs, scheduler=scheduler)
+            background_llm = ScheduledChatOpenAI(**llm_kwargs, scheduler=scheduler, priority=Priority.BACKGROUND)
+        else:
+            interactive_llm = background_llm = ChatOpenAI(**llm_kwargs)
+        interactive_latencies, background_latencies, errors = [], [], []
+        tasks = [send(interactive_llm, rng.uniform(0, args.duration), interactive_latencies, errors)
+                 for _ in range(args.interactive)]
+        tasks += [send(background_llm, rng.uniform(0, args.duration), background_latencies, errors)
+                  for _ in range(args.background)]
+        # tenacity logs every retry
+        with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()), \
+                Stopwatch() as stopwatch:
+            await asyncio.gather(*tasks)
+        return {
+            "wall_time": stopwatch.elapsed,
+            "interactive_latency": summarize_latencies(interactive_latencies),
+            "background_latency": summarize_latencies(background_latencies),
+            "errors": len(errors),
+            "server_requests": server.received,
+            "server_429": server.rejected,
+            "scheduler": scheduler.metrics().get(MODEL_NAME, {}),
+        }
+
+
+def main():
+    args = get_parser().parse_args()
+    results = {mode: asyncio.run(run_mode(mode, args)) for mode in ["unscheduled", "scheduled"]}
+    for mode, result in results.items():
+        print(f"{mode:>11}: interactive p50 {result['interactive_latency']['p50']:.2f}s "
+              f"p95 {result['interactive_latency']['p95']:.2f}s, "
+              f"background p95 {result['background_latency']['p95']:.2f}s, "
+              f"{result['server_429']} responses 429, {result['errors']} errors, wall time {result['wall_time']:.1f}s")
+    write_results(args.output, "openai_scheduler", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
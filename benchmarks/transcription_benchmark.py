@@ -0,0 +1,133 @@
+"""Benchmark of voice message transcription: the whole audio in one speech-to-text request versus chunks split on
+pauses and transcribed concurrently. Compares latency, number and size of requests for 1-10 minute clips. Example:
+    python -m benchmarks.transcription_benchmark --minutes 1 2 5 10 --max_concurrency 4 --output transcription.json
+Clips are generated speech-like audio: every word is a tone of its own frequency, words are separated by short gaps
+and sentences by pauses. The stub speech-to-text recognises words by frequency, and its latency grows with
+duration of the audio. Chunks are wav, mp3 needs ffmpeg.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import List, Tuple, Dict, Any
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.silence import detect_nonsilent
+
+from benchmarks.utils import write_results, Stopwatch
+from speech.transcription import ChunkedTranscriber, ChunkedTranscriptionPolicy
+
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliett"]
+FRAME_RATE = 16000
+
+
+def get_word_frequency(word: str) -> int:
+    return 300 + 150 * WORDS.index(word)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", type=float, nargs="+", default=[1, 2, 5, 10])
+    parser.add_argument("--max_chunk_seconds", type=float, default=60)
+    parser.add_argument("--max_concurrency", type=int, default=4)
+    parser.add_argument("--stt_latency", type=float, default=1.0, help="latency of a request, s")
+    parser.add_argument("--stt_seconds_per_audio_second", type=float, default=0.05,
+                        help="latency added by every second of audio")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="bench_output.json")
+    return parser
+
+
+def generate_speech(rng: random.Random, seconds: float) -> Tuple[AudioSegment, List[str]]:
+    """16kHz mono audio of sentences of word tones, and its words."""
+    parts, words, duration = [], [], 0
+    while duration < seconds * FRAME_RATE:
+        for _ in range(rng.randint(4, 12)):
+            word = rng.choice(WORDS)
+            t = np.arange(int(rng.uniform(0.25, 0.6) * FRAME_RATE)) / FRAME_RATE
+            parts.append(0.3 * np.sin(2 * np.pi * get_word_frequency(word) * t))
+            parts.append(np.zeros(int(rng.uniform(0.06, 0.15) * FRAME_RATE)))
+            words.append(word)
+        parts.append(np.zeros(int(rng.uniform(0.5, 1.2) * FRAME_RATE)))
+        duration = sum(len(part) for part in parts)
+    samples = (np.concatenate(parts) * 32767).astype(np.int16)
+    return AudioSegment(samples.tobytes(), frame_rate=FRAME_RATE, sample_width=2, channels=1), words
+
+
+class StubSpeechToText:
+    """Speech-to-text of generated audio with the signature of mp3_to_text. Counts concurrent requests."""
+
+    def __init__(self, latency: float = 1.0, seconds_per_audio_second: float = 0.05):
+        self.latency = latency
+        self.seconds_per_audio_second = seconds_per_audio_second
+        self.calls = 0
+        self.max_active = 0
+        self.max_request_bytes = 0
+        self._active = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def recognise(audio: AudioSegment) -> List[str]:
+        words = []
+        for start, end in detect_nonsilent(audio, min_silence_len=40, silence_thresh=-50, seek_step=5):
+            samples = np.array(audio[start:end].get_array_of_samples())
+            frequency = np.count_nonzero(np.diff(np.signbit(samples))) / 2 / ((end - start) / 1000)
+            words.append(min(WORDS, key=lambda word: abs(get_word_frequency(word) - frequency)))
+        return words
+
+    def __call__(self, mp3_path: str) -> str:
+        with self._lock:
+            self.calls += 1
+            self._active += 1
+            self.max_active = max(self.max_active, self._active)
+            self.max_request_bytes = max(self.max_request_bytes, os.path.getsize(mp3_path))
+        try:
+            audio = AudioSegment.from_file(mp3_path)
+            time.sleep(self.latency + self.seconds_per_audio_second * audio.duration_seconds)
+            return " ".join(self.recognise(audio))
+        finally:
+            with self._lock:
+                self._active -= 1
+
+
+async def run_clip(audio_path: str, words: List[str], chunked: bool, args: argparse.Namespace) -> Dict[str, Any]:
+    stt = StubSpeechToText(args.stt_latency, args.stt_seconds_per_audio_second)
+    with Stopwatch() as stopwatch:
+        if chunked:
+            policy = ChunkedTranscriptionPolicy(
+                max_chunk_seconds=args.max_chunk_seconds, max_concurrency=args.max_concurrency, chunk_format="wav")
+            transcript = await ChunkedTranscriber(stt, policy).atranscribe(audio_path)
+        else:
+            transcript = await asyncio.to_thread(stt, audio_path)
+    return {
+        "latency": stopwatch.elapsed,
+        "requests": stt.calls,
+        "max_request_mb": stt.max_request_bytes / 2 ** 20,
+        "word_accuracy": sum(a == b for a, b in zip(transcript.split(), words)) / len(words),
+    }
+
+
+def main():
+    args = get_parser().parse_args()
+    rng = random.Random(args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as clips_dir:
+        for minutes in args.minutes:
+            audio, words = generate_speech(rng, minutes * 60)
+            audio_path = os.path.join(clips_dir, f"clip_{minutes}.wav")
+            audio.export(audio_path, format="wav")
+            results[minutes] = {
+                mode: asyncio.run(run_clip(audio_path, words, mode == "chunked", args)) for mode in ["whole", "chunked"]
+            }
+            for mode, result in results[minutes].items():
+                print(f"{minutes:>4} min {mode:>8}: {result['latency']:.2f}s, {result['requests']} requests "
+                      f"of at most {result['max_request_mb']:.1f}MB, word accuracy {result['word_accuracy']:.2f}")
+    write_results(args.output, "transcription", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,39 @@
+from typing import Dict, Optional, List
+
 import yaml
 from pydantic import BaseModel
 
+from agents.load_controller import LoadControlPolicy
+from agents.memory_consolidation import ConsolidationBudget
+from agents.openai_scheduler import ModelLimits
+from agents.tracing import TracingPolicy
+from speech.transcription import ChunkedTranscriptionPolicy
+
 
 class Config(BaseModel):
     telegram_token_name: str
     save_dir_name: str
     prompts_name: str
+    # per-model OpenAI rate limits of the account, overriding openai_scheduler.DEFAULT_MODEL_LIMITS
+    openai_limits: Dict[str, ModelLimits] = {}
+    # seconds between background consolidations of memory of active users (it rewrites and removes memories by
+    # LLM), None to disable
+    memory_consolidation_interval: Optional[float] = None
+    memory_consolidation_budget: ConsolidationBudget = ConsolidationBudget()
+    # pages of this many top web search results are downloaded before the researcher asks them, 0 to disable
+    prefetch_pages: int = 0
+    # agents use the function calling interface of the model instead of json in the message text
+    use_function_calling: bool = False
+    # voice messages are split on pauses and transcribed by chunks concurrently, None to transcribe them whole
+    chunked_transcription: Optional[ChunkedTranscriptionPolicy] = None
+    # memory of the user is loaded while the voice message is transcribed
+    early_agent_start: bool = False
+    # traces of requests slower than the threshold are written as Chrome trace json, None to disable
+    tracing: Optional[TracingPolicy] = None
+    # telegram ids of users allowed to run admin commands, like /profile
+    admin_user_ids: List[int] = []
+    # requests are degraded step by step when the agent is saturated, None to always serve them fully
+    load_control: Optional[LoadControlPolicy] = None
 
     @classmethod
     def load(cls, config_path: str):
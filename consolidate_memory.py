@@ -0,0 +1,59 @@
+"""Offline consolidation of memory of all users (or given ones) of a bot config, prints a report per user.
+Run it when the bot is stopped: memory locks of the bot are not shared with other processes. Example:
+    python consolidate_memory.py --config_name friend --max_llm_calls 200 --report report.json
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+
+import openai
+import yaml
+from dotenv import load_dotenv
+
+from agents.helper_agent import HelperAgent
+from agents.memory_consolidation import MemoryConsolidator
+from agents.openai_scheduler import get_openai_scheduler
+from agents.web_researcher import WebResearcherAgent
+from configs.config import Config
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config_name", type=str)
+parser.add_argument("--user_ids", type=int, nargs="*", default=None, help="all users with saved memory by default")
+parser.add_argument("--max_llm_calls", type=int, default=None)
+parser.add_argument("--max_io_mb", type=float, default=None)
+parser.add_argument("--report", type=str, default=None, help="path to save json report")
+args = parser.parse_args()
+
+load_dotenv()
+openai.api_key = os.environ["OPENAI_API_KEY"]
+configs_path = str(Path(__file__).parent / "configs")
+prompts_dir = str(Path(__file__).parent / "prompts")
+config = Config.load(os.path.join(configs_path, args.config_name + ".yaml"))
+get_openai_scheduler().set_limits(config.openai_limits)
+with open(os.path.join(prompts_dir, config.prompts_name + ".yaml"), 'r') as f:
+    agent_prompts = yaml.safe_load(f)
+with open(os.path.join(prompts_dir, "web_researcher.yaml"), 'r') as f:
+    web_researcher_prompts = yaml.safe_load(f)
+with open(os.path.join(prompts_dir, "memory_consolidation.yaml"), 'r') as f:
+    memory_consolidation_prompts = yaml.safe_load(f)
+agent = HelperAgent(
+    os.path.join(os.environ["SAVE_PATH"], config.save_dir_name),
+    agent_prompts,
+    WebResearcherAgent(web_researcher_prompts)
+)
+budget = config.memory_consolidation_budget
+if args.max_llm_calls is not None:
+    budget.max_llm_calls = args.max_llm_calls
+if args.max_io_mb is not None:
+    budget.max_io_bytes = int(args.max_io_mb * 1024 ** 2)
+consolidator = MemoryConsolidator(agent, memory_consolidation_prompts, budget=budget)
+reports = consolidator.run(args.user_ids)
+for report in reports:
+    print(report.format())
+print(f"Total: {sum(report.ltm_bytes_before - report.ltm_bytes_after for report in reports) / 1024:.1f}KB "
+      f"and {sum(report.prompt_tokens_saved_per_turn for report in reports)} prompt tokens per turn saved, "
+      f"{consolidator.llm_calls} LLM calls")
+if args.report is not None:
+    with open(args.report, "w") as f:
+        json.dump([report.to_dict() for report in reports], f, indent=2)
@@ -7,8 +7,13 @@ import yaml
 from dotenv import load_dotenv
 
 from agents.helper_agent import HelperAgent
+from agents.load_controller import LoadController
+from agents.memory_consolidation import MemoryConsolidator
+from agents.openai_scheduler import get_openai_scheduler
+from agents.tracing import get_tracer
 from agents.web_researcher import WebResearcherAgent
 from configs.config import Config
+from speech.transcription import ChunkedTranscriber
 from telegram_bot.tg_bot import TelegramBot
 
 parser = argparse.ArgumentParser()
@@ -20,17 +25,37 @@ openai.api_key = os.environ["OPENAI_API_KEY"]
 configs_path = str(Path(__file__).parent / "configs")
 prompts_dir = str(Path(__file__).parent / "prompts")
 config = Config.load(os.path.join(configs_path, args.config_name + ".yaml"))
+get_openai_scheduler().set_limits(config.openai_limits)
+get_tracer().configure(config.tracing, os.environ["SAVE_PATH"])
 agent_prompts_path = os.path.join(prompts_dir, config.prompts_name + ".yaml")
 with open(agent_prompts_path, 'r') as f:
     agent_prompts = yaml.safe_load(f)
 web_researcher_prompts_path = os.path.join(prompts_dir, "web_researcher.yaml")
 with open(web_researcher_prompts_path, 'r') as f:
     web_researcher_prompts = yaml.safe_load(f)
-web_researcher_agent = WebResearcherAgent(web_researcher_prompts)
+web_researcher_agent = WebResearcherAgent(
+    web_researcher_prompts, prefetch_pages=config.prefetch_pages, use_function_calling=config.use_function_calling)
 agent = HelperAgent(
     os.path.join(os.environ["SAVE_PATH"], config.save_dir_name),
     agent_prompts,
-    web_researcher_agent
+    web_researcher_agent,
+    use_function_calling=config.use_function_calling,
+    load_controller=LoadController(config.load_control)
 )
+transcriber = None
+if config.chunked_transcription is not None:
+    transcriber = ChunkedTranscriber(policy=config.chunked_transcription)
+memory_consolidator = None
+if config.memory_consolidation_interval is not None:
+    with open(os.path.join(prompts_dir, "memory_consolidation.yaml"), 'r') as f:
+        memory_consolidation_prompts = yaml.safe_load(f)
+    memory_consolidator = MemoryConsolidator(
+        agent, memory_consolidation_prompts, budget=config.memory_consolidation_budget)
 TelegramBot(token=os.environ[config.telegram_token_name], agent=agent,
-            greetings_message=agent_prompts["telegram_greetings"]).run_polling()
+            greetings_message=agent_prompts["telegram_greetings"],
+            memory_consolidator=memory_consolidator,
+            memory_consolidation_interval=config.memory_consolidation_interval or 0,
+            transcriber=transcriber,
+            early_agent_start=config.early_agent_start,
+            admin_user_ids=config.admin_user_ids,
+            load_controller=agent.load_controller).run_polling()
@@ -0,0 +1,76 @@
+"""Front process of the sharded deployment: receives Telegram updates, does speech-to-text and text-to-speech,
+and sends turns of every user to the shard worker owning the user. Example:
+    python -m sharding.front --config_name friend --workers http://10.0.0.2:8001 http://10.0.0.3:8001
+Workers are rebalanced without restart through the admin API:
+    curl -X POST localhost:8100/rebalance -d '{"workers": ["http://10.0.0.2:8001", "http://10.0.0.4:8001"]}'
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+from pathlib import Path
+from typing import List
+
+import openai
+import yaml
+from aiohttp import web
+from dotenv import load_dotenv
+
+from agents.openai_scheduler import get_openai_scheduler
+from agents.tracing import get_tracer
+from configs.config import Config
+from sharding.router import ShardRouter
+from speech.transcription import ChunkedTranscriber
+from telegram_bot.tg_bot import TelegramBot
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_name", type=str)
+    parser.add_argument("--workers", type=str, nargs="+", help="base urls of shard workers")
+    parser.add_argument("--admin_host", type=str, default="127.0.0.1")
+    parser.add_argument("--admin_port", type=int, default=8100)
+    return parser
+
+
+async def serve(bot: TelegramBot, router: ShardRouter, admin_host: str, admin_port: int):
+    runner = web.AppRunner(router.get_admin_app())
+    await runner.setup()
+    await web.TCPSite(runner, admin_host, admin_port).start()
+    try:
+        async with bot.application:
+            await bot.application.start()
+            await bot.application.updater.start_polling()
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await bot.application.updater.stop()
+                await bot.application.stop()
+    finally:
+        await runner.cleanup()
+        await router.close()
+
+
+def run_front(config_name: str, worker_urls: List[str], admin_host: str, admin_port: int):
+    load_dotenv()
+    # speech-to-text is done by the front
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+    config = Config.load(os.path.join(str(Path(__file__).parents[1] / "configs"), config_name + ".yaml"))
+    get_openai_scheduler().set_limits(config.openai_limits)
+    get_tracer().configure(config.tracing, os.environ["SAVE_PATH"])
+    with open(os.path.join(str(Path(__file__).parents[1] / "prompts"), config.prompts_name + ".yaml"), 'r') as f:
+        agent_prompts = yaml.safe_load(f)
+    transcriber = None
+    if config.chunked_transcription is not None:
+        transcriber = ChunkedTranscriber(policy=config.chunked_transcription)
+    router = ShardRouter(worker_urls, token=os.environ.get("SHARD_TOKEN"))
+    bot = TelegramBot(token=os.environ[config.telegram_token_name], agent=router,  # noqa
+                      greetings_message=agent_prompts["telegram_greetings"],
+                      transcriber=transcriber, admin_user_ids=config.admin_user_ids)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve(bot, router, admin_host, admin_port))
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    run_front(args.config_name, args.workers, args.admin_host, args.admin_port)
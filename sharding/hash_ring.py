@@ -0,0 +1,33 @@
+import bisect
+import hashlib
+from typing import List, Iterable, Dict
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class ConsistentHashRing:
+    """Maps user ids to worker nodes. Every node owns `virtual_nodes` points on the ring, so users are spread
+    evenly, and adding or removing a node moves only the users of its share of the ring."""
+
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int = 128):
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            raise ValueError("Ring needs at least one node")
+        self.virtual_nodes = virtual_nodes
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def get_node(self, user_id: int) -> str:
+        i = bisect.bisect(self._hashes, _hash(str(user_id))) % len(self._hashes)
+        return self._owners[i]
+
+    def get_moves(self, placement: Dict[int, str]) -> Dict[int, str]:
+        """Users from the placement {user_id: node} that this ring assigns to other nodes, with their new nodes."""
+        return {user_id: self.get_node(user_id) for user_id, node in placement.items()
+                if self.get_node(user_id) != node}
+
+    def with_nodes(self, nodes: List[str]) -> "ConsistentHashRing":
+        return ConsistentHashRing(nodes, self.virtual_nodes)
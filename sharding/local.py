@@ -0,0 +1,60 @@
+"""Sharded deployment on one machine: starts shard workers as separate processes and the front in this one.
+Users of worker i are saved to SAVE_PATH/<save_dir_name>/shard_i. Example:
+    python -m sharding.local --config_name friend_dev --workers 4
+"""
+import argparse
+import multiprocessing
+import time
+import urllib.error
+import urllib.request
+from typing import List
+
+from sharding.front import run_front
+from sharding.worker import run_worker
+
+
+def wait_until_ready(urls: List[str], timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                urllib.request.urlopen(f"{url}/health", timeout=1)
+                break
+            except urllib.error.HTTPError:
+                # 401 without SHARD_TOKEN, but the worker is up
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Shard worker {url} did not start in {timeout}s")
+                time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_name", type=str)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--base_port", type=int, default=8001)
+    parser.add_argument("--admin_port", type=int, default=8100)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    processes, urls = [], []
+    for i in range(args.workers):
+        port = args.base_port + i
+        processes.append(context.Process(
+            target=run_worker, args=(args.config_name, "127.0.0.1", port, f"shard_{i}"), daemon=True))
+        urls.append(f"http://127.0.0.1:{port}")
+    for process in processes:
+        process.start()
+    try:
+        wait_until_ready(urls)
+        run_front(args.config_name, urls, "127.0.0.1", args.admin_port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
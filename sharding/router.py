@@ -0,0 +1,150 @@
+import asyncio
+from collections import defaultdict
+from typing import List, Optional, Dict, Any
+
+import aiohttp
+from aiohttp import web
+
+from sharding.hash_ring import ConsistentHashRing
+from sharding.worker import TOKEN_HEADER
+
+
+class ShardRouter:
+    """Agent of the front process: has the HelperAgent interface used by TelegramBot, but sends every turn to the
+    shard worker owning the user by consistent hashing of user id.
+
+    Turns of one user are sent one by one. Rebalance to a new set of workers moves users whose owner changed:
+    routing is paused while saved users are listed, then every moved user is exported from its old worker,
+    imported to the new one and removed from the old one, while its turns wait.
+    """
+
+    def __init__(self, worker_urls: List[str], token: Optional[str] = None, virtual_nodes: int = 128,
+                 request_timeout: float = 600):
+        self.ring = ConsistentHashRing(worker_urls, virtual_nodes)
+        self.token = token
+        self.request_timeout = request_timeout
+        self.moved_users = 0
+        # users whose handoff is not finished yet are served by their old worker
+        self._pending_moves: Dict[int, str] = {}
+        self._in_flight: Dict[int, str] = {}
+        self._user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._routing_allowed = asyncio.Event()
+        self._routing_allowed.set()
+        self._rebalance_lock = asyncio.Lock()
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def get_worker(self, user_id: int) -> str:
+        return self._pending_moves.get(user_id) or self.ring.get_node(user_id)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            headers = {TOKEN_HEADER: self.token} if self.token is not None else {}
+            self._session = aiohttp.ClientSession(
+                headers=headers, timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _request(self, method: str, url: str, **kwargs: Any) -> Any:
+        async with self._get_session().request(method, url, **kwargs) as response:
+            response.raise_for_status()
+            if response.content_type == "application/json":
+                return await response.json()
+            return await response.read()
+
+    async def _call_owner(self, user_id: int, method: str, path: str, **kwargs: Any) -> Any:
+        async with self._user_locks[user_id]:
+            await self._routing_allowed.wait()
+            worker_url = self.get_worker(user_id)
+            self._in_flight[user_id] = worker_url
+            try:
+                return await self._request(method, f"{worker_url}/users/{user_id}/{path}", **kwargs)
+            finally:
+                del self._in_flight[user_id]
+
+    async def arun(self, user_id: int, request: str) -> str:
+        try:
+            response = await self._call_owner(user_id, "POST", "message", json={"text": request})
+            return response["answer"]
+        except Exception as e:
+            return f"Error in telegram bot: {e}. Report it to developer."
+
+    async def aforget(self, user_id: int):
+        await self._call_owner(user_id, "POST", "forget")
+
+    async def aprepare(self, user_id: int):
+        # worker loads memory when the turn comes
+        pass
+
+    async def after_message(self, user_id: int):
+        # worker does it after every turn
+        pass
+
+    async def _get_placement(self, worker_urls: List[str]) -> Dict[int, List[str]]:
+        placement = defaultdict(list)
+        responses = await asyncio.gather(*[self._request("GET", f"{url}/users") for url in worker_urls])
+        for url, response in zip(worker_urls, responses):
+            for user_id in response["users"]:
+                placement[user_id].append(url)
+        # a new user may be created by a turn that is still running
+        for user_id, url in self._in_flight.items():
+            if url not in placement[user_id]:
+                placement[user_id].append(url)
+        return placement
+
+    async def _hand_off(self, user_id: int, source_url: str, target_url: str):
+        async with self._user_locks[user_id]:
+            data = await self._request("GET", f"{source_url}/users/{user_id}/export")
+            await self._request("POST", f"{target_url}/users/{user_id}/import", data=data)
+            self._pending_moves.pop(user_id, None)
+            await self._request("DELETE", f"{source_url}/users/{user_id}")
+            self.moved_users += 1
+
+    async def rebalance(self, worker_urls: List[str]) -> Dict[str, int]:
+        """Switches to the new set of workers (they all have to be running) and hands moved users off."""
+        async with self._rebalance_lock:
+            new_ring = self.ring.with_nodes(worker_urls)
+            self._routing_allowed.clear()
+            try:
+                placement = await self._get_placement(sorted(set(self.ring.nodes) | set(new_ring.nodes)))
+            finally:
+                self._routing_allowed.set()
+            moves, stale_copies = {}, []
+            for user_id, urls in placement.items():
+                owner = new_ring.get_node(user_id)
+                if owner in urls:
+                    # left by an interrupted handoff, the copy on the owner is the most recent one
+                    stale_copies.extend((user_id, url) for url in urls if url != owner)
+                else:
+                    moves[user_id] = urls[0]
+            self._pending_moves = dict(moves)
+            self.ring = new_ring
+            for user_id, url in stale_copies:
+                async with self._user_locks[user_id]:
+                    await self._request("DELETE", f"{url}/users/{user_id}")
+            for user_id, source_url in moves.items():
+                await self._hand_off(user_id, source_url, new_ring.get_node(user_id))
+            return {"moved_users": len(moves), "removed_stale_copies": len(stale_copies)}
+
+    async def status(self) -> Dict[str, Any]:
+        workers = {}
+        for url in self.ring.nodes:
+            try:
+                workers[url] = await self._request("GET", f"{url}/health")
+            except Exception as e:
+                workers[url] = {"error": repr(e)}
+        return {"workers": workers, "pending_moves": len(self._pending_moves), "moved_users": self.moved_users}
+
+    def get_admin_app(self) -> web.Application:
+        """Admin API of the front: GET /status, POST /rebalance {"workers": [urls]}."""
+        async def status(request: web.Request) -> web.Response:  # noqa
+            return web.json_response(await self.status())
+
+        async def rebalance(request: web.Request) -> web.Response:
+            return web.json_response(await self.rebalance((await request.json())["workers"]))
+
+        app = web.Application()
+        app.add_routes([web.get("/status", status), web.post("/rebalance", rebalance)])
+        return app
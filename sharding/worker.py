@@ -0,0 +1,168 @@
+"""Shard worker: HelperAgent of a part of users behind HTTP API, used by ShardRouter of the front process.
+Every worker owns its own save path. Example:
+    python -m sharding.worker --config_name friend --port 8001 --save_dir_name shard_0
+"""
+import argparse
+import asyncio
+import hmac
+import ipaddress
+import os
+from pathlib import Path
+from typing import Optional
+
+import openai
+import yaml
+from aiohttp import web
+from dotenv import load_dotenv
+
+from agents.helper_agent import HelperAgent
+from agents.load_controller import LoadController
+from agents.memory_consolidation import MemoryConsolidator
+from agents.openai_scheduler import get_openai_scheduler
+from agents.tracing import get_tracer
+from agents.web_researcher import WebResearcherAgent
+from configs.config import Config
+
+TOKEN_HEADER = "X-Shard-Token"
+
+
+class ShardWorker:
+    """HTTP API of one shard:
+    - POST /users/{user_id}/message {"text": ...} -> {"answer": ...}
+    - POST /users/{user_id}/forget
+    - GET /users -> {"users": [...]}, users which state is saved by this worker
+    - GET /users/{user_id}/export -> archive of user state, POST /users/{user_id}/import, DELETE /users/{user_id}
+      to hand users off between workers
+    - GET /health
+    If token is set, every request has to send it in X-Shard-Token header. Without token the worker listens only
+    on loopback hosts.
+    """
+
+    def __init__(self, agent: HelperAgent, token: Optional[str] = None,
+                 memory_consolidator: Optional[MemoryConsolidator] = None,
+                 memory_consolidation_interval: float = 3600):
+        self.agent = agent
+        self.token = token
+        self.memory_consolidator = memory_consolidator
+        self.memory_consolidation_interval = memory_consolidation_interval
+        self.handled_messages = 0
+        self.app = web.Application(middlewares=[self._check_token], client_max_size=1024 ** 3)
+        self.app.add_routes([
+            web.get("/health", self.health),
+            web.get("/users", self.users),
+            web.post("/users/{user_id}/message", self.message),
+            web.post("/users/{user_id}/forget", self.forget),
+            web.get("/users/{user_id}/export", self.export_user),
+            web.post("/users/{user_id}/import", self.import_user),
+            web.delete("/users/{user_id}", self.remove_user),
+        ])
+        self.app.cleanup_ctx.append(self._background_tasks)
+
+    async def _background_tasks(self, app: web.Application):  # noqa
+        task = None
+        if self.memory_consolidator is not None:
+            task = asyncio.create_task(
+                self.memory_consolidator.arun_periodically(self.memory_consolidation_interval))
+        yield
+        if task is not None:
+            task.cancel()
+        await self.agent.long_term_memory_queue.close()
+
+    @web.middleware
+    async def _check_token(self, request: web.Request, handler):
+        if self.token is not None and \
+                not hmac.compare_digest(request.headers.get(TOKEN_HEADER, "").encode(), self.token.encode()):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    async def health(self, request: web.Request) -> web.Response:  # noqa
+        return web.json_response({
+            "users": len(self.agent.get_user_ids()),
+            "handled_messages": self.handled_messages,
+            "ltm_queue_depth": self.agent.long_term_memory_queue.queue_depth,
+            "load": self.agent.load_controller.metrics(),
+        })
+
+    async def users(self, request: web.Request) -> web.Response:  # noqa
+        return web.json_response({"users": self.agent.get_user_ids()})
+
+    async def message(self, request: web.Request) -> web.Response:
+        user_id = int(request.match_info["user_id"])
+        text = (await request.json())["text"]
+        answer = await self.agent.arun(user_id, text)
+        await self.agent.after_message(user_id)
+        self.handled_messages += 1
+        return web.json_response({"answer": answer})
+
+    async def forget(self, request: web.Request) -> web.Response:
+        await self.agent.aforget(int(request.match_info["user_id"]))
+        return web.json_response({})
+
+    async def export_user(self, request: web.Request) -> web.Response:
+        data = await self.agent.export_user(int(request.match_info["user_id"]))
+        return web.Response(body=data, content_type="application/gzip")
+
+    async def import_user(self, request: web.Request) -> web.Response:
+        await self.agent.import_user(int(request.match_info["user_id"]), await request.read())
+        return web.json_response({})
+
+    async def remove_user(self, request: web.Request) -> web.Response:
+        self.agent.remove_user(int(request.match_info["user_id"]))
+        return web.json_response({})
+
+    def run(self, host: str, port: int):
+        if self.token is None and not _is_loopback(host):
+            raise ValueError(f"Shard worker without SHARD_TOKEN would accept requests from anyone on {host}")
+        web.run_app(self.app, host=host, port=port, print=None)
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def run_worker(config_name: str, host: str, port: int, save_dir_name: Optional[str] = None):
+    load_dotenv()
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+    configs_path = str(Path(__file__).parents[1] / "configs")
+    prompts_dir = str(Path(__file__).parents[1] / "prompts")
+    config = Config.load(os.path.join(configs_path, config_name + ".yaml"))
+    get_openai_scheduler().set_limits(config.openai_limits)
+    get_tracer().configure(config.tracing, os.environ["SAVE_PATH"])
+    with open(os.path.join(prompts_dir, config.prompts_name + ".yaml"), 'r') as f:
+        agent_prompts = yaml.safe_load(f)
+    with open(os.path.join(prompts_dir, "web_researcher.yaml"), 'r') as f:
+        web_researcher_prompts = yaml.safe_load(f)
+    agent = HelperAgent(
+        os.path.join(os.environ["SAVE_PATH"], config.save_dir_name, save_dir_name or f"shard_{port}"),
+        agent_prompts,
+        WebResearcherAgent(web_researcher_prompts, prefetch_pages=config.prefetch_pages,
+                           use_function_calling=config.use_function_calling),
+        use_function_calling=config.use_function_calling,
+        load_controller=LoadController(config.load_control)
+    )
+    memory_consolidator = None
+    if config.memory_consolidation_interval is not None:
+        with open(os.path.join(prompts_dir, "memory_consolidation.yaml"), 'r') as f:
+            memory_consolidation_prompts = yaml.safe_load(f)
+        memory_consolidator = MemoryConsolidator(
+            agent, memory_consolidation_prompts, budget=config.memory_consolidation_budget)
+    print(f"Shard worker {save_dir_name or port} is listening on {host}:{port}")
+    ShardWorker(agent, token=os.environ.get("SHARD_TOKEN"), memory_consolidator=memory_consolidator,
+                memory_consolidation_interval=config.memory_consolidation_interval or 0).run(host, port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config_name", type=str)
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="other than loopback hosts require SHARD_TOKEN")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--save_dir_name", type=str, default=None,
+                        help="subdirectory of the config save dir with users of this worker, shard_{port} by default")
+    args = parser.parse_args()
+    run_worker(args.config_name, args.host, args.port, args.save_dir_name)
@@ -0,0 +1,86 @@
+import asyncio
+import bisect
+import tempfile
+from typing import Callable, List, Tuple, Optional
+
+from pydantic import BaseModel
+from pydub import AudioSegment
+from pydub.silence import detect_silence
+
+from agents.tracing import span
+from speech.utils import mp3_to_text
+
+
+class ChunkedTranscriptionPolicy(BaseModel):
+    # chunks are cut in the middle of pauses and are not longer than this, a chunk is cut without a pause
+    # only when there is no pause in it
+    max_chunk_seconds: float = 60
+    min_silence_ms: int = 400
+    # pause is quieter than the average loudness of the audio by this many dB
+    silence_thresh_db: float = 16
+    # concurrent speech-to-text requests of one audio, all of them also go through the whisper-1 rate limit
+    max_concurrency: int = 4
+    chunk_format: str = "mp3"
+
+
+def split_on_pauses(audio: AudioSegment, max_chunk_ms: int, min_silence_ms: int,
+                    silence_thresh_db: float) -> List[Tuple[int, int]]:
+    """Bounds in milliseconds of consecutive chunks covering the whole audio, cut at the latest pause fitting
+    into max_chunk_ms."""
+    if len(audio) <= max_chunk_ms:
+        return [(0, len(audio))]
+    silences = detect_silence(audio, min_silence_len=min_silence_ms, silence_thresh=audio.dBFS - silence_thresh_db,
+                              seek_step=10)
+    cut_points = [(start + end) // 2 for start, end in silences]
+    bounds = []
+    start = 0
+    while len(audio) - start > max_chunk_ms:
+        end = start + max_chunk_ms
+        latest = bisect.bisect_right(cut_points, end) - 1
+        cut = cut_points[latest] if latest >= 0 and cut_points[latest] > start else end
+        bounds.append((start, cut))
+        start = cut
+    bounds.append((start, len(audio)))
+    return bounds
+
+
+class ChunkedTranscriber:
+    """Transcribes long audio as chunks split on pauses, concurrently, and joins the transcripts in order.
+
+    Latency of a long voice message is the latency of its longest chunk instead of the whole audio,
+    and every request stays below the size limit of the speech-to-text API.
+    """
+
+    def __init__(self, transcribe: Callable[[str], str] = mp3_to_text,
+                 policy: Optional[ChunkedTranscriptionPolicy] = None):
+        self.transcribe = transcribe
+        self.policy = policy or ChunkedTranscriptionPolicy()
+
+    def split(self, audio: AudioSegment) -> List[AudioSegment]:
+        bounds = split_on_pauses(audio, int(self.policy.max_chunk_seconds * 1000), self.policy.min_silence_ms,
+                                 self.policy.silence_thresh_db)
+        chunks = [audio[start:end] for start, end in bounds]
+        # chunks of nothing but a long pause are not sent, speech-to-text makes up words for silence
+        silence_thresh = audio.dBFS - self.policy.silence_thresh_db
+        return [chunk for chunk in chunks if len(chunks) == 1 or chunk.dBFS > silence_thresh]
+
+    def _transcribe_chunk(self, chunk: AudioSegment) -> str:
+        with tempfile.NamedTemporaryFile(suffix=f".{self.policy.chunk_format}") as chunk_file:
+            with span("export chunk", "audio", seconds=chunk.duration_seconds):
+                chunk.export(chunk_file.name, format=self.policy.chunk_format)
+            with span("speech to text", "audio"):
+                return self.transcribe(chunk_file.name)
+
+    async def atranscribe(self, audio_path: str) -> str:
+        with span("decode voice", "audio"):
+            audio = await asyncio.to_thread(AudioSegment.from_file, audio_path)
+        with span("split on pauses", "audio"):
+            chunks = await asyncio.to_thread(self.split, audio)
+        semaphore = asyncio.Semaphore(self.policy.max_concurrency)
+
+        async def transcribe_chunk(chunk: AudioSegment) -> str:
+            async with semaphore:
+                return await asyncio.to_thread(self._transcribe_chunk, chunk)
+
+        transcripts = await asyncio.gather(*(transcribe_chunk(chunk) for chunk in chunks))
+        return " ".join(transcript.strip() for transcript in transcripts if transcript.strip())
@@ -7,6 +7,7 @@ from gtts import gTTS
 from pydub import AudioSegment
 from speechkit import Session, SpeechSynthesis
 
+from agents.openai_scheduler import get_openai_scheduler, Priority
 from speech.language_detector import TTSLanguage, LanguageDetector
 
 
@@ -16,9 +17,12 @@ def ogg_to_mp3(ogg_path, mp3_path):
 
 
 def mp3_to_text(mp3_path: str) -> str:
-    with open(mp3_path, "rb") as audio_file:
-        transcript = openai.Audio.transcribe(model="whisper-1", file=audio_file)
-        return transcript["text"]
+    def transcribe():
+        with open(mp3_path, "rb") as audio_file:
+            return openai.Audio.transcribe(model="whisper-1", file=audio_file)
+
+    transcript = get_openai_scheduler().run_sync("whisper-1", 0, Priority.INTERACTIVE, transcribe)
+    return transcript["text"]
 
 
 def text_to_mp3(text: str, mp3_path: str, language: TTSLanguage):
@@ -1,52 +1,144 @@
+import asyncio
 import tempfile
+from typing import Optional, List
 
 from telegram import Update
-from telegram.ext import ApplicationBuilder, MessageHandler, CallbackContext, filters, CommandHandler
+from telegram.ext import ApplicationBuilder, MessageHandler, CallbackContext, filters, CommandHandler, Application
 
 from agents.helper_agent import HelperAgent
+from agents.load_controller import LoadController, LoadLevel
+from agents.memory_consolidation import MemoryConsolidator
+from agents.profiler import SamplingProfiler
+from agents.tracing import get_tracer, span
+from speech.transcription import ChunkedTranscriber
 from speech.utils import ogg_to_mp3, mp3_to_text, text_to_mp3_multi_language
 
 
 class TelegramBot:
-    def __init__(self, token: str, agent: HelperAgent, greetings_message: str):
-        self.application = ApplicationBuilder().token(token=token).build()
+    def __init__(self, token: str, agent: HelperAgent, greetings_message: str,
+                 memory_consolidator: Optional[MemoryConsolidator] = None,
+                 memory_consolidation_interval: float = 3600,
+                 transcriber: Optional[ChunkedTranscriber] = None, early_agent_start: bool = False,
+                 admin_user_ids: Optional[List[int]] = None, default_profile_seconds: float = 30,
+                 load_controller: Optional[LoadController] = None):
+        self.application = ApplicationBuilder().token(token=token).post_init(self._post_init).post_shutdown(
+            self._post_shutdown).build()
         self.application.add_handler(CommandHandler("start", self.command_handler))
         self.application.add_handler(CommandHandler("forget", self.command_handler))
+        self.application.add_handler(CommandHandler("profile", self.command_handler))
         self.application.add_handler(MessageHandler(filters.VOICE, self.voice_handler))
         self.application.add_handler(MessageHandler(filters.TEXT, self.text_handler))
         self.agent = agent
         self.greetings_message = greetings_message
+        self.memory_consolidator = memory_consolidator
+        self.memory_consolidation_interval = memory_consolidation_interval
+        self._memory_consolidation_task: Optional[asyncio.Task] = None
+        # long voice messages are transcribed by chunks when set
+        self.transcriber = transcriber
+        # memory of the user is loaded while the voice message is transcribed
+        self.early_agent_start = early_agent_start
+        # users allowed to run admin commands
+        self.admin_user_ids = set(admin_user_ids or [])
+        self.profiler = SamplingProfiler()
+        self.default_profile_seconds = default_profile_seconds
+        self._profile_task: Optional[asyncio.Task] = None
+        # voice messages are answered with text under load
+        self.load_controller = load_controller
 
     def run_polling(self):
         self.application.run_polling()
 
+    async def _post_init(self, application: Application):  # noqa
+        if self.memory_consolidator is not None:
+            self._memory_consolidation_task = asyncio.create_task(
+                self.memory_consolidator.arun_periodically(self.memory_consolidation_interval))
+
+    async def _post_shutdown(self, application: Application):  # noqa
+        if self._memory_consolidation_task is not None:
+            self._memory_consolidation_task.cancel()
+        # memories still queued are committed, the sharded front has no memory of its own
+        if isinstance(self.agent, HelperAgent):
+            await self.agent.long_term_memory_queue.close()
+
     @staticmethod
     async def _load_voice_mp3(update: Update, context: CallbackContext, mp3_path: str):
-        voice_file = await context.bot.getFile(update.message.voice.file_id)
         with tempfile.NamedTemporaryFile(suffix=".ogg") as ogg_file:
-            await voice_file.download_to_drive(ogg_file.name)
-            ogg_to_mp3(ogg_file.name, mp3_path)
+            with span("download voice", "io"):
+                voice_file = await context.bot.getFile(update.message.voice.file_id)
+                await voice_file.download_to_drive(ogg_file.name)
+            with span("ogg_to_mp3", "audio"):
+                await asyncio.to_thread(ogg_to_mp3, ogg_file.name, mp3_path)
+
+    async def _transcribe_voice(self, update: Update, context: CallbackContext, mp3_path: str) -> str:
+        if self.transcriber is None:
+            await self._load_voice_mp3(update, context, mp3_path)
+            with span("speech to text", "audio"):
+                return await asyncio.to_thread(mp3_to_text, mp3_path)
+        with tempfile.NamedTemporaryFile(suffix=".ogg") as ogg_file:
+            with span("download voice", "io"):
+                voice_file = await context.bot.getFile(update.message.voice.file_id)
+                await voice_file.download_to_drive(ogg_file.name)
+            return await self.transcriber.atranscribe(ogg_file.name)
 
     async def voice_handler(self, update: Update, context: CallbackContext) -> None:
-        with tempfile.NamedTemporaryFile(suffix=".mp3") as mp3_file:
-            await self._load_voice_mp3(update, context, mp3_file.name)
-            transcript = mp3_to_text(mp3_file.name)
-            answer = await self.agent.arun(update.message.from_user.id, transcript)
-            if text_to_mp3_multi_language(answer, mp3_file.name) is None:
-                await update.message.reply_text(answer)
+        user_id = update.message.from_user.id
+        with get_tracer().trace(f"voice {user_id}"), tempfile.NamedTemporaryFile(suffix=".mp3") as mp3_file:
+            if self.early_agent_start:
+                await self.agent.aprepare(user_id)
+            transcript = await self._transcribe_voice(update, context, mp3_file.name)
+            answer = await self.agent.arun(user_id, transcript)
+            if self.load_controller is not None and self.load_controller.level >= LoadLevel.TEXT_ONLY:
+                voice_path = None
             else:
-                await update.message.reply_voice(voice=mp3_file.name, caption=answer)
-            await self.agent.after_message(update.message.from_user.id)
+                with span("text to speech", "audio"):
+                    voice_path = await asyncio.to_thread(text_to_mp3_multi_language, answer, mp3_file.name)
+            with span("reply", "telegram"):
+                if voice_path is None:
+                    await update.message.reply_text(answer)
+                else:
+                    await update.message.reply_voice(voice=mp3_file.name, caption=answer)
+            await self.agent.after_message(user_id)
 
     async def text_handler(self, update: Update, context: CallbackContext) -> None:  # noqa
-        answer = await self.agent.arun(update.message.from_user.id, update.message.text)
-        await update.message.reply_text(answer, parse_mode='Markdown')
-        await self.agent.after_message(update.message.from_user.id)
+        user_id = update.message.from_user.id
+        with get_tracer().trace(f"text {user_id}"):
+            answer = await self.agent.arun(user_id, update.message.text)
+            with span("reply", "telegram"):
+                await update.message.reply_text(answer, parse_mode='Markdown')
+            await self.agent.after_message(user_id)
+
+    async def _profile_window(self, update: Update, seconds: float):
+        await asyncio.sleep(seconds)
+        await self._reply_profile(update)
+
+    async def _reply_profile(self, update: Update):
+        summary = self.profiler.stop()
+        # telegram limit of a message is 4096 characters
+        await update.message.reply_text(summary[:4000])
+
+    async def _toggle_profiler(self, update: Update):
+        """`/profile [seconds]` samples stacks of the bot for the window and replies with the summary,
+        `/profile` while sampling stops it earlier."""
+        if self.profiler.running:
+            self._profile_task.cancel()
+            await self._reply_profile(update)
+            return
+        arguments = update.message.text.split()[1:]
+        try:
+            seconds = float(arguments[0]) if arguments else self.default_profile_seconds
+        except ValueError:
+            await update.message.reply_text("Usage: /profile [seconds]")
+            return
+        self.profiler.start()
+        self._profile_task = asyncio.create_task(self._profile_window(update, seconds))
+        await update.message.reply_text(f"Profiling for {seconds:g}s, send /profile to stop earlier.")
 
     async def command_handler(self, update: Update, context: CallbackContext) -> None:  # noqa
         if update.message.text == "/forget":
-            self.agent.forget(update.message.from_user.id)
+            await self.agent.aforget(update.message.from_user.id)
             await update.message.reply_text("Chat history has been forgotten.")
+        elif update.message.text.split()[0] == "/profile" and update.message.from_user.id in self.admin_user_ids:
+            await self._toggle_profiler(update)
         elif update.message.text == "/start":
             await update.message.reply_text(
                 self.greetings_message, disable_web_page_preview=True, parse_mode="Markdown")
@@ -88,12 +88,9 @@ class TestLila(IsolatedAsyncioTestCase):
         web_researcher = WebResearcherAgent(web_researcher_prompts)
         lila = HelperAgent(self.save_path, agent_prompts, web_researcher)
         test_user_id = 0
-        short_term_memory = lila._load_short_term_memory(user_id=test_user_id)
-        conversation_summary = lila._load_conversation_summary(user_id=test_user_id)
-        memory_about_user = lila._load_memory_about_user(user_id=test_user_id)
-        long_term_memory = lila._load_long_term_memory(user_id=test_user_id)
-        agent = lila._initialise_agent(
-            test_user_id, short_term_memory, conversation_summary, memory_about_user, long_term_memory)
+        short_term_memory, conversation_summary, memory_about_user, relevant_ltm = \
+            await lila._aload_context(user_id=test_user_id)
+        agent = lila._initialise_agent(short_term_memory, conversation_summary, memory_about_user, relevant_ltm)
         self.assertIsNotNone(agent)
 
     def tearDown(self) -> None:
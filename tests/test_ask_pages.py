@@ -0,0 +1,92 @@
+import json
+import random
+import time
+from unittest import TestCase, IsolatedAsyncioTestCase
+
+from agents.page_extraction import extract_page_text, split_into_chunks, select_relevant_chunks, BM25
+from agents.page_prefetch import PagePrefetcher
+from benchmarks.ask_pages_benchmark import generate_page
+from benchmarks.fakes import FakeChatModel, FakeAskPagesTool, FakeWebSearchTool
+
+
+class TestPageExtraction(TestCase):
+    def test_extraction_stops_at_caps(self):
+        read_chunks = []
+
+        def content():
+            for i in range(1000):
+                read_chunks.append(i)
+                yield f"<p>Paragraph {i} <a href='https://example.com/{i}'>link</a></p>".encode() * 100
+
+        text = extract_page_text(content(), max_bytes=10 ** 9, max_tokens=1000)
+        self.assertLessEqual(len(text), 4000)
+        self.assertLess(len(read_chunks), 10)
+        self.assertTrue(text.startswith("Paragraph 0 link"))
+        self.assertNotIn("https://", text)
+
+        read_chunks.clear()
+        text = extract_page_text(content(), max_bytes=100, max_tokens=1000, is_html=False)
+        self.assertEqual(len(text), 100)
+        self.assertEqual(len(read_chunks), 1)
+
+    def test_bm25_finds_facts(self):
+        html, facts = generate_page(random.Random(0), sections=30)
+        chunks = split_into_chunks(extract_page_text([html.encode()], 10 ** 9, 10 ** 6), chunk_tokens=256)
+        self.assertTrue(all(len(chunk) <= 256 * 4 for chunk in chunks))
+        self.assertGreater(len(chunks), 30)
+        for question, fact in facts:
+            selected = select_relevant_chunks(chunks, question, top_k=4)
+            self.assertEqual(len(selected), 4)
+            self.assertTrue(any(fact in " ".join(chunk.split()) for chunk in selected), question)
+        self.assertFalse(BM25(chunks).get_scores("nothing matches").any())
+
+
+class TestAskPagesTool(IsolatedAsyncioTestCase):
+    async def test_single_llm_call(self):
+        llm = FakeChatModel(latency=0, tokens_per_second=10 ** 6)
+        tool = FakeAskPagesTool(llm=llm, latency=0, page_words=20000, chunk_tokens=256, top_k_chunks=4)
+        answer = await tool._arun('{"urls": ["https://example.com/1", "https://example.com/2"], '
+                                  '"questions": ["What is word42?"]}')
+        self.assertEqual(answer.count("Answer: "), 2)
+        self.assertEqual(llm.calls, 2)
+        # both prompts are 4 chunks, far less than 20000 words of the pages
+        self.assertLess(llm.prompt_tokens, 2 * (4 * 256 + 100))
+
+
+class TestPagePrefetcher(TestCase):
+    def setUp(self) -> None:
+        self.llm = FakeChatModel(latency=0, tokens_per_second=10 ** 6)
+        self.ask_tool = FakeAskPagesTool(llm=self.llm, latency=0.2)
+
+    def test_search_results_are_prefetched(self):
+        prefetcher = PagePrefetcher(self.ask_tool.fetch_page)
+        self.ask_tool.prefetcher = prefetcher
+        search_tool = FakeWebSearchTool(latency=0, prefetcher=prefetcher, prefetch_results=2)
+        results = eval(search_tool.run("cats"))
+        time.sleep(0.3)
+        start = time.monotonic()
+        answer = self.ask_tool.run(json.dumps({"urls": [results[0]["link"]], "questions": ["How many cats?"]}))
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertIn("Answer: ", answer)
+        # a page which was not prefetched is fetched by the tool itself
+        self.ask_tool.run(json.dumps({"urls": [results[3]["link"]], "questions": ["How many cats?"]}))
+        self.assertEqual(self.ask_tool.fetched_pages, 3)
+        self.assertEqual(prefetcher.metrics()["hits"], 1)
+        self.assertEqual(prefetcher.metrics()["misses"], 1)
+        prefetcher.close()
+
+    def test_bounded_and_cancelled(self):
+        prefetcher = PagePrefetcher(self.ask_tool.fetch_page, max_concurrency=1, max_pages=3, ttl=0.5)
+        prefetcher.prefetch([f"https://example.com/{i}" for i in range(5)])
+        metrics = prefetcher.metrics()
+        # the two oldest are dropped: the running one is stopped, the queued one is not started
+        self.assertEqual((metrics["cached"], metrics["unused"], metrics["cancelled"]), (3, 2, 2))
+        self.assertIsNone(prefetcher.get("https://example.com/0"))
+        self.assertIsNotNone(prefetcher.get("https://example.com/4"))
+        time.sleep(0.6)
+        # unused prefetches expire
+        self.assertIsNone(prefetcher.get("https://example.com/3"))
+        self.assertEqual(prefetcher.metrics()["cached"], 0)
+        self.assertEqual(prefetcher.metrics()["unused"], 4)
+        prefetcher.close()
+        self.assertEqual(self.ask_tool.fetched_pages, 4)
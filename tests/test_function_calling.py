@@ -0,0 +1,78 @@
+import asyncio
+import json
+import tempfile
+from typing import List, Tuple
+from unittest import TestCase, IsolatedAsyncioTestCase
+
+from langchain.prompts import ChatPromptTemplate
+from langchain.schema import AIMessage, AgentFinish, OutputParserException
+from yid_langchain_extensions.tools.utils import FinalAnswerTool
+
+from agents.function_calling import FunctionCallingAgent, FunctionCallAction, format_functions
+from agents.tools import AskPagesTool
+from agents.utils import get_end_detection_thought, get_important_info_thought
+from benchmarks.fakes import FakeChatModel
+from tests.utils import build_fake_agent, fake_llm
+
+
+class TestFunctionCallingAgent(TestCase):
+    def setUp(self) -> None:
+        llm = FakeChatModel(latency=0)
+        self.agent = FunctionCallingAgent.from_llm_and_tools(
+            llm, ChatPromptTemplate.from_messages([]), FinalAnswerTool(), [AskPagesTool(llm=llm)],
+            [get_end_detection_thought(), get_important_info_thought("")])
+
+    @staticmethod
+    def _call(name: str, arguments: str) -> AIMessage:
+        return AIMessage(content="", additional_kwargs={"function_call": {"name": name, "arguments": arguments}})
+
+    def test_functions(self):
+        final_answer, ask_urls = self.agent.functions
+        self.assertEqual(final_answer["parameters"]["required"], ["answer", "new_topic_started"])
+        self.assertEqual(final_answer["parameters"]["properties"]["new_topic_started"]["type"], "boolean")
+        self.assertEqual(ask_urls["parameters"]["required"], ["urls", "questions"])
+        rendered = format_functions(self.agent.functions)
+        self.assertIn("type final_answer = (_: {", rendered)
+        self.assertIn("updated_important_info?: string,", rendered)
+        self.assertIn("urls: string[],", rendered)
+
+    def test_parse(self):
+        finish = self.agent._parse(self._call(
+            "final_answer", '{"answer": "Hi!", "new_topic_started": true, "updated_important_info": "Likes\ncats"}'))
+        self.assertIsInstance(finish, AgentFinish)
+        self.assertEqual(finish.return_values, {
+            "output": "Hi!", "raw_output": "Hi!", "new_topic_started": True, "updated_important_info": "Likes\ncats"})
+        action = self.agent._parse(self._call("ask_urls", '{"urls": ["https://a.com"], "questions": ["Why?"]}'))
+        self.assertIsInstance(action, FunctionCallAction)
+        self.assertEqual(json.loads(action.tool_input), {"urls": ["https://a.com"], "questions": ["Why?"]})
+        self.assertEqual(self.agent._parse(self._call("web_search", '{"input": "cats"}')).tool_input, "cats")
+        self.assertEqual(self.agent._parse(AIMessage(content="plain")).return_values["output"], "plain")
+        with self.assertRaises(OutputParserException) as context:
+            self.agent._parse(self._call("final_answer", '{"answer": "Quote: "Hi!"}'))
+        self.assertTrue(context.exception.send_to_llm)
+
+
+class TestFunctionCallingMode(IsolatedAsyncioTestCase):
+    @staticmethod
+    async def _run_requests(use_function_calling: bool) -> Tuple[List[str], FakeChatModel]:
+        llm = fake_llm(web_search_ratio=0.5, ask_urls_ratio=0.5, malformed_output_ratio=0.2)
+        with tempfile.TemporaryDirectory() as save_path:
+            agent = build_fake_agent(save_path, llm, use_function_calling=use_function_calling)
+
+            async def run_user(user_id: int) -> List[str]:
+                return [await agent.arun(user_id, f"User {user_id} asks question {i} about topic {i % 3}")
+                        for i in range(5)]
+
+            answers = sum(await asyncio.gather(*[run_user(user_id) for user_id in range(4)]), [])
+            await agent.long_term_memory_queue.close()
+        return [answer for answer in answers if answer.startswith("Error in telegram bot")], llm
+
+    async def test_broken_outputs(self):
+        text_json_errors, text_json_llm = await self._run_requests(use_function_calling=False)
+        function_calling_errors, function_calling_llm = await self._run_requests(use_function_calling=True)
+        # a broken step fails the request in text mode, but is regenerated with function calling
+        self.assertGreater(len(text_json_errors), 0)
+        self.assertEqual(function_calling_errors, [])
+        self.assertGreater(function_calling_llm.malformed_outputs, 0)
+        self.assertLess(function_calling_llm.prompt_tokens / function_calling_llm.calls,
+                        text_json_llm.prompt_tokens / text_json_llm.calls)
@@ -0,0 +1,28 @@
+from unittest import TestCase, IsolatedAsyncioTestCase
+
+from benchmarks.load_benchmark import get_parser, run_benchmark, TARGETS
+from benchmarks.utils import percentile
+
+
+class TestPercentile(TestCase):
+    def test_percentile(self):
+        values = [float(i) for i in range(101)]
+        self.assertEqual(percentile(values, 50), 50.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertEqual(percentile([], 95), 0.0)
+
+
+class TestLoadBenchmark(IsolatedAsyncioTestCase):
+    async def test_offline_run(self):
+        for target in TARGETS:
+            args = get_parser().parse_args([
+                "--target", target, "--users", "3", "--requests_per_user", "2",
+                "--llm_latency", "0", "--llm_tokens_per_second", "100000", "--embedding_latency", "0",
+                "--search_latency", "0", "--stt_latency", "0", "--tts_latency", "0", "--telegram_latency", "0",
+                "--web_search_ratio", "0.5", "--new_topic_ratio", "0.5", "--ask_urls_ratio", "0.5",
+                "--page_latency", "0", "--prefetch_pages", "2", "--early_agent_start",
+            ])
+            results = await run_benchmark(args)
+            self.assertEqual(results["errors"], 0, results["first_errors"])
+            self.assertEqual(results["latency"]["count"], 6)
+            self.assertGreater(results["llm"]["calls"], 0)
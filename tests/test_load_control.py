@@ -0,0 +1,116 @@
+import os
+import tempfile
+import time
+from unittest import TestCase, IsolatedAsyncioTestCase, mock
+
+from agents.load_controller import LoadController, LoadControlPolicy, LoadLevel
+from benchmarks.fakes import FakeSpeech, fake_telegram_update, fake_telegram_context
+from benchmarks.load_benchmark import get_parser, run_benchmark
+from telegram_bot.tg_bot import TelegramBot
+from tests.utils import build_fake_agent, fake_llm
+
+SPIKE_ARGS = [
+    "--target", "agent", "--users", "12", "--requests_per_user", "5", "--llm_latency", "0.05",
+    "--llm_tokens_per_second", "5000", "--llm_max_concurrency", "1", "--embedding_latency", "0",
+    "--search_latency", "0.05", "--page_latency", "0", "--web_search_ratio", "0.5",
+]
+
+
+class TestLoadController(TestCase):
+    def test_hysteresis(self):
+        queue_depth = 0
+        controller = LoadController(
+            LoadControlPolicy(max_in_flight=100, max_queue_depth=10, step_interval=5, recover_pressure=0.5,
+                              recover_interval=30),
+            queue_depth=lambda: queue_depth)
+        queue_depth = 10
+        self.assertEqual(controller.update(now=0), LoadLevel.NO_LTM)
+        # one step per step_interval
+        self.assertEqual(controller.update(now=1), LoadLevel.NO_LTM)
+        self.assertEqual(controller.update(now=5), LoadLevel.NO_WEB_SEARCH)
+        # a spike goes up right away
+        queue_depth = 40
+        self.assertEqual(controller.update(now=6), LoadLevel.TEXT_ONLY)
+        self.assertEqual(controller.update(now=100), LoadLevel.TEXT_ONLY)
+
+        # pressure between recover_pressure and 1 keeps the level
+        queue_depth = 7
+        self.assertEqual(controller.update(now=200), LoadLevel.TEXT_ONLY)
+        queue_depth = 2
+        self.assertEqual(controller.update(now=210), LoadLevel.TEXT_ONLY)
+        self.assertEqual(controller.update(now=239), LoadLevel.TEXT_ONLY)
+        self.assertEqual(controller.update(now=240), LoadLevel.FAST_LLM)
+        self.assertEqual(controller.update(now=260), LoadLevel.FAST_LLM)
+        self.assertEqual(controller.update(now=270), LoadLevel.NO_WEB_SEARCH)
+        metrics = controller.metrics()
+        self.assertEqual((metrics["level"], metrics["level_name"]), (2, "no_web_search"))
+        self.assertEqual(metrics["level_changes"], 5)
+
+    def test_recovery_after_idle(self):
+        queue_depth = 40
+        controller = LoadController(LoadControlPolicy(max_queue_depth=10, recover_interval=30),
+                                    queue_depth=lambda: queue_depth)
+        self.assertEqual(controller.update(now=0), LoadLevel.TEXT_ONLY)
+        queue_depth = 0
+        controller.start_run(now=1)
+        controller.end_run(0.5, now=1.5)
+        self.assertEqual(controller.level, LoadLevel.TEXT_ONLY)
+        # nothing ran for an hour, the next request is served in full
+        self.assertEqual(controller.start_run(now=3600), LoadLevel.FULL)
+
+    def test_latency(self):
+        controller = LoadController(LoadControlPolicy(target_latency=10, latency_window=60), queue_depth=lambda: 0)
+        now = time.monotonic()
+        controller.start_run()
+        controller.end_run(12, now=now + 100)
+        self.assertEqual(controller.level, LoadLevel.NO_LTM)
+        # runs started at the previous level are not counted
+        controller.start_run()
+        controller.end_run(12, now=now + 110)
+        self.assertEqual(controller.level, LoadLevel.NO_LTM)
+        self.assertEqual(controller.metrics()["runs_at_level"], {"full": 1, "no_ltm": 1})
+
+    def test_without_policy(self):
+        controller = LoadController(queue_depth=lambda: 1000)
+        with controller.track() as level:
+            self.assertEqual(level, LoadLevel.FULL)
+            self.assertEqual(controller.in_flight, 1)
+        self.assertEqual(controller.metrics()["level_name"], "full")
+
+
+class TestDegradation(IsolatedAsyncioTestCase):
+    async def test_degraded_agent(self):
+        with tempfile.TemporaryDirectory() as save_path:
+            llm = fake_llm(web_search_ratio=1)
+            agent = build_fake_agent(save_path, llm, degraded_llm=fake_llm(web_search_ratio=1))
+            agent.load_controller._level = LoadLevel.NO_WEB_SEARCH
+            executor = agent._initialise_agent(*(await agent._aload_context(0)), agent.load_controller.level)
+            self.assertEqual([tool.name for tool in executor.tools], ["final_answer"])
+
+            agent.load_controller._level = LoadLevel.TEXT_ONLY
+            bot = TelegramBot(token="0:offline", agent=agent, greetings_message="",  # noqa
+                              load_controller=agent.load_controller)
+            speech = FakeSpeech(stt_latency=0, tts_latency=0, conversion_latency=0)
+            text_to_speech = mock.Mock(wraps=speech.text_to_mp3_multi_language)
+            update = fake_telegram_update(1, voice=True, latency=0)
+            with mock.patch.multiple(
+                    "telegram_bot.tg_bot", ogg_to_mp3=speech.ogg_to_mp3, mp3_to_text=speech.mp3_to_text,
+                    text_to_mp3_multi_language=text_to_speech):
+                await bot.voice_handler(update, fake_telegram_context(0))  # noqa
+            # the request would need web search, but is answered by the degraded llm in text
+            text_to_speech.assert_not_called()
+            self.assertEqual((llm.calls, agent.degraded_llm.calls), (0, 1))
+            self.assertFalse(update.message.replies[-1].startswith("Error in telegram bot"))
+            self.assertFalse(os.path.exists(os.path.join(save_path, "1", "ltm")))
+            await agent.long_term_memory_queue.close()
+
+    async def test_spike(self):
+        baseline = await run_benchmark(get_parser().parse_args(SPIKE_ARGS))
+        controlled = await run_benchmark(get_parser().parse_args(SPIKE_ARGS + [
+            "--load_control", "--load_max_in_flight", "3", "--load_max_queue_depth", "4",
+            "--load_target_latency", "0.5", "--load_step_interval", "0.1", "--load_recover_interval", "60"]))
+        self.assertEqual(controlled["errors"], 0, controlled["first_errors"])
+        self.assertEqual(baseline["load_control"]["level_changes"], 0)
+        self.assertGreater(controlled["load_control"]["level"], LoadLevel.FULL)
+        self.assertGreater(controlled["llm"]["degraded_calls"], 0)
+        self.assertLess(controlled["latency"]["p95"], baseline["latency"]["p95"] / 2)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+from langchain import FAISS
+
+from agents.long_term_memory import LongTermMemory, LongTermMemoryIndexPolicy
+from benchmarks.fakes import HashEmbeddings
+from tests.utils import build_fake_agent
+
+
+def get_test_memories(n: int):
+    return [f"conversation {i} about topic{i} and subject{i}" for i in range(n)]
+
+
+class TestLongTermMemory(TestCase):
+    def setUp(self) -> None:
+        self.save_path = tempfile.mkdtemp()
+        self.ltm_path = os.path.join(self.save_path, "ltm")
+        self.embeddings = HashEmbeddings(dim=1024)
+        self.policy = LongTermMemoryIndexPolicy(hnsw_min_entries=20, ivfpq_min_entries=2000)
+
+    def test_save_load(self):
+        memories = get_test_memories(5)
+        memory = LongTermMemory.from_texts(
+            self.ltm_path, memories, self.embeddings, self.policy, metadatas=[{"id": i} for i in range(5)])
+        memory.save()
+        self.assertTrue(LongTermMemory.exists(self.ltm_path))
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        self.assertEqual(memory.index_type, "flat")
+        document = memory.similarity_search("topic3 subject3", k=1)[0]
+        self.assertEqual(document.page_content, memories[3])
+        self.assertEqual(document.metadata, {"id": 3})
+
+    def test_index_type_grows(self):
+        memories = get_test_memories(2100)
+        memory = LongTermMemory.from_texts(self.ltm_path, memories[:10], self.embeddings, self.policy)
+        memory.save()
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        memory.add_texts(memories[10:30])
+        self.assertEqual(memory.index_type, "hnsw")
+        memory.save()
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        memory.add_texts(memories[30:])
+        self.assertEqual(memory.index_type, "ivfpq")
+        self.assertEqual(len(memory), 2100)
+        for i in [0, 15, 1500]:
+            self.assertEqual(memory.similarity_search(f"topic{i} subject{i}", k=1)[0].page_content, memories[i])
+
+    def test_legacy_migration(self):
+        memories = get_test_memories(3)
+        FAISS.from_texts(memories, self.embeddings, metadatas=[{"date": "2023-07-01"}] * 3).save_local(self.ltm_path)
+        self.assertTrue(LongTermMemory.exists(self.ltm_path))
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        self.assertFalse(os.path.exists(os.path.join(self.ltm_path, "index.pkl")))
+        document = memory.similarity_search("topic1 subject1", k=1)[0]
+        self.assertEqual(document.page_content, memories[1])
+        self.assertEqual(document.metadata, {"date": "2023-07-01"})
+
+    def test_failed_legacy_migration(self):
+        FAISS.from_texts(get_test_memories(3), self.embeddings).save_local(self.ltm_path)
+        with mock.patch.object(LongTermMemory, "save", side_effect=OSError("No space left on device")):
+            with self.assertRaises(OSError):
+                LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        self.assertTrue(LongTermMemory.exists(self.ltm_path))
+        self.assertEqual(len(LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)), 3)
+
+    def test_docstore_append(self):
+        memories = get_test_memories(4)
+        memory = LongTermMemory.from_texts(self.ltm_path, memories[:2], self.embeddings, self.policy)
+        memory.save()
+        old_reader = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        memory.add_texts(memories[2:])
+        memory.save()
+        self.assertEqual([document.page_content for document in old_reader.docstore], memories[:2])
+        new_reader = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy, use_mmap=False)
+        self.assertEqual([document.page_content for document in new_reader.docstore], memories)
+        self.assertEqual(new_reader.similarity_search("topic3 subject3", k=1)[0].page_content, memories[3])
+
+    def test_save_cut_off(self):
+        memories = get_test_memories(30)
+        LongTermMemory.from_texts(self.ltm_path, memories[:25], self.embeddings, self.policy).save()
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        memory.add_texts(memories[25:])
+        # vectors, index and docstore are saved, meta.json is not
+        with mock.patch("agents.long_term_memory.json.dump", side_effect=OSError("No space left on device")):
+            with self.assertRaises(OSError):
+                memory.save()
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        self.assertEqual(memory.index_type, "hnsw")
+        self.assertEqual(len(memory), 25)
+        self.assertEqual(len(memory._load_vectors()), 25)
+        self.assertNotIn(memories[27], [document.page_content for document in memory.similarity_search(
+            "topic27 subject27", k=5)])
+
+    def test_folder_replaced_after_load(self):
+        memories = get_test_memories(6)
+        LongTermMemory.from_texts(self.ltm_path, memories[:3], self.embeddings, self.policy).save()
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        # like consolidation swapping the folder between load and search
+        shutil.rmtree(self.ltm_path)
+        LongTermMemory.from_texts(self.ltm_path, memories[3:][::-1], self.embeddings, self.policy).save()
+        self.assertEqual(memory.similarity_search("topic1 subject1", k=1)[0].page_content, memories[1])
+
+    def test_empty(self):
+        memory = LongTermMemory.from_vectors(
+            self.ltm_path, np.zeros((0, self.embeddings.dim), dtype=np.float32), [], self.embeddings, self.policy)
+        memory.save()
+        memory = LongTermMemory.load(self.ltm_path, self.embeddings, self.policy)
+        self.assertEqual(memory.similarity_search("anything", k=1), [])
+        agent = build_fake_agent(os.path.join(self.save_path, "users"))
+        self.assertIsNone(agent._get_relevant_ltm(0, agent._load_short_term_memory(0), memory))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.save_path)
@@ -0,0 +1,171 @@
+import asyncio
+import shutil
+import tempfile
+from collections import defaultdict
+from unittest import IsolatedAsyncioTestCase, mock
+
+from agents.helper_agent import HelperAgent
+from agents.ltm_ingestion import LongTermMemoryIngestionQueue
+from benchmarks.fakes import HashEmbeddings
+from benchmarks.utils import EventLoopMonitor
+from telegram_bot.tg_bot import TelegramBot
+from tests.utils import build_fake_agent, fake_llm
+
+
+class TestLongTermMemoryIngestionQueue(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.embeddings = HashEmbeddings()
+        self.committed = defaultdict(list)
+
+    def commit(self, user_id, vectors, texts, metadatas, is_discarded):
+        self.assertEqual(len(vectors), len(texts))
+        if is_discarded():
+            return False
+        self.committed[user_id].extend(texts)
+        return True
+
+    async def test_batching(self):
+        queue = LongTermMemoryIngestionQueue(self.embeddings, self.commit, batch_size=10, max_delay=0.2)
+        for user_id in range(3):
+            for i in range(2):
+                await queue.put(user_id, f"memory {i} of {user_id}", {})
+        self.assertEqual(queue.queue_depth, 6)
+        await queue.wait_for_user(1)
+        self.assertEqual(self.committed[1], ["memory 0 of 1", "memory 1 of 1"])
+        self.assertEqual(self.embeddings.calls, 1)
+        self.assertEqual(queue.queue_depth, 0)
+        await queue.close()
+
+    async def test_batch_size(self):
+        queue = LongTermMemoryIngestionQueue(self.embeddings, self.commit, batch_size=2, max_delay=10)
+        for i in range(4):
+            await queue.put(0, f"memory {i}", {})
+        await queue.flush()
+        self.assertEqual(len(self.committed[0]), 4)
+        self.assertEqual(self.embeddings.calls, 2)
+        await queue.close()
+
+    async def test_wait_sends_batch_right_away(self):
+        queue = LongTermMemoryIngestionQueue(self.embeddings, self.commit, batch_size=10, max_delay=60)
+        await queue.put(0, "memory", {})
+        await asyncio.wait_for(queue.wait_for_user(0), 5)
+        self.assertEqual(self.committed[0], ["memory"])
+        await queue.close()
+
+    async def test_discard_user(self):
+        queue = LongTermMemoryIngestionQueue(self.embeddings, self.commit, batch_size=10, max_delay=0.1)
+        await queue.put(0, "forgotten", {})
+        await queue.put(1, "kept", {})
+        queue.discard_user(0)
+        await queue.put(0, "new", {})
+        await queue.flush()
+        self.assertEqual(self.committed[0], ["new"])
+        self.assertEqual(self.committed[1], ["kept"])
+        await queue.close()
+
+    async def test_retry(self):
+        failures = [OSError("No space left on device")]
+
+        def flaky_commit(*args):
+            if failures:
+                raise failures.pop()
+            return self.commit(*args)
+
+        queue = LongTermMemoryIngestionQueue(
+            self.embeddings, flaky_commit, batch_size=10, max_delay=0.01, max_attempts=2, retry_delay=0.01)
+        committed_callbacks = []
+        await queue.put(0, "memory", {}, on_commit=lambda: committed_callbacks.append(0))
+        await queue.wait_for_user(0)
+        self.assertEqual(self.committed[0], ["memory"])
+        self.assertEqual(committed_callbacks, [0])
+        self.assertEqual(self.embeddings.calls, 2)
+
+        # callback is not called when all attempts failed
+        failures.extend([OSError("No space left on device")] * 2)
+        await queue.put(0, "lost memory", {}, on_commit=lambda: committed_callbacks.append(1))
+        await queue.wait_for_user(0)
+        self.assertEqual(self.committed[0], ["memory"])
+        self.assertEqual(committed_callbacks, [0])
+        await queue.close()
+
+
+class TestHelperAgentReadYourWrites(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.save_path = tempfile.mkdtemp()
+
+    def build_agent(self, **overrides) -> HelperAgent:
+        # every turn starts a new topic, so the summary of the previous one is written to long-term memory
+        return build_fake_agent(self.save_path, fake_llm(new_topic_ratio=1), **overrides)
+
+    async def test_new_topic_is_searchable_next_turn(self):
+        agent = self.build_agent(long_term_memory_max_delay=5)
+        await agent.arun(0, "first question about cats")
+        await agent.arun(0, "second question about dogs")
+        # summary of the first topic is queued and max_delay is not reached, so the next turn has to wait for it
+        self.assertEqual(agent.long_term_memory_queue.queue_depth, 1)
+        await agent.long_term_memory_queue.wait_for_user(0)
+        long_term_memory = agent._load_long_term_memory(0)
+        self.assertEqual(len(long_term_memory), 1)
+        self.assertIn("first question about cats", long_term_memory.docstore[0].page_content)
+        await agent.long_term_memory_queue.close()
+
+    async def test_forget_right_before_commit(self):
+        agent = self.build_agent(long_term_memory_max_delay=5)
+        embeddings = agent.long_term_memory_embeddings
+        await agent.arun(0, "first question about cats")
+        await agent.arun(0, "second question about dogs")
+        queue = agent.long_term_memory_queue
+        commit = queue.commit
+
+        def forget_and_commit(*args):
+            # forget comes after the queue checked for discarded memories, before the commit takes the lock
+            agent.forget(0)
+            return commit(*args)
+
+        with mock.patch.object(queue, "commit", side_effect=forget_and_commit):
+            await queue.flush()
+        self.assertEqual(embeddings.calls, 1)
+        self.assertEqual(queue.committed_memories, 0)
+        self.assertIsNone(agent._load_long_term_memory(0))
+        await queue.close()
+
+    async def test_summary_kept_when_commit_failed(self):
+        agent = self.build_agent()
+        agent.long_term_memory_queue.retry_delay = 0.01
+        await agent.arun(0, "first question about cats")
+        with mock.patch.object(agent.long_term_memory_queue, "commit", side_effect=OSError("No space left on device")):
+            await agent.arun(0, "second question about dogs")
+            await agent.long_term_memory_queue.flush()
+        # the new topic is not started, so the summary stays until the next new topic
+        self.assertIn("first question about cats", agent._load_conversation_summary(0))
+        self.assertEqual(len(agent._load_short_term_memory(0).chat_memory.messages), 4)
+        await agent.long_term_memory_queue.close()
+
+    async def test_bot_shutdown_commits_queued_memories(self):
+        agent = self.build_agent(long_term_memory_max_delay=60)
+        bot = TelegramBot(token="0:offline", agent=agent, greetings_message="")  # noqa
+        await agent.arun(0, "first question about cats")
+        await agent.arun(0, "second question about dogs")
+        await bot._post_shutdown(bot.application)
+        self.assertEqual(agent.long_term_memory_queue.committed_memories, 1)
+
+    async def test_search_does_not_block_event_loop(self):
+        agent = self.build_agent()
+        embeddings = agent.long_term_memory_embeddings
+        await agent.arun(0, "first question about cats")
+        await agent.arun(0, "second question about dogs")
+        await agent.long_term_memory_queue.flush()
+        # e.g. embeddings request waiting for the rate limit
+        embeddings.latency = 0.3
+        monitor = EventLoopMonitor()
+        monitor.start()
+        await asyncio.sleep(monitor.interval * 2)
+        relevant_ltm = (await agent._aload_context(0))[3]
+        await asyncio.sleep(monitor.interval * 2)
+        await monitor.stop()
+        self.assertIn("first question about cats", relevant_ltm)
+        self.assertLess(monitor.summary()["max_lag"], 0.1)
+        await agent.long_term_memory_queue.close()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.save_path)
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import TestCase, mock
+
+import numpy as np
+import yaml
+
+from agents.memory_consolidation import MemoryConsolidator, ConsolidationBudget, ConsolidationReport
+from tests.utils import build_fake_agent, fake_llm
+
+GREETING = "User greeted me and said hello"
+CAT_FOOD = "User talked about cats and their favourite cat food"
+CAT_TOYS = "User talked about cats and their favourite cat toys"
+WEATHER = "User asked about the weather in Paris tomorrow"
+
+
+class TestMemoryConsolidation(TestCase):
+    def setUp(self) -> None:
+        self.save_path = tempfile.mkdtemp()
+        self.llm = fake_llm()
+        self.agent = build_fake_agent(self.save_path, self.llm)
+        self.embeddings = self.agent.long_term_memory_embeddings
+        with open(Path(__file__).parents[1] / "prompts" / "memory_consolidation.yaml", "r") as f:
+            self.prompts = yaml.safe_load(f)
+        self.add_memories(0, [GREETING, CAT_FOOD, GREETING, WEATHER, GREETING, CAT_TOYS])
+
+    def add_memories(self, user_id: int, memories):
+        start = datetime(2023, 7, 1)
+        vectors = np.asarray(self.embeddings.embed_documents(memories), dtype=np.float32)
+        metadatas = [{"date": (start + timedelta(days=i)).isoformat()} for i in range(len(memories))]
+        self.agent._add_to_long_term_memory(user_id, vectors, memories, metadatas)
+
+    def get_consolidator(self, **budget) -> MemoryConsolidator:
+        budget = ConsolidationBudget(io_bytes_per_second=None, **budget)
+        return MemoryConsolidator(self.agent, self.prompts, budget=budget)
+
+    def test_long_term_memory(self):
+        report = self.get_consolidator().run()[0]
+        self.assertIsNone(report.skipped)
+        self.assertEqual(report.memories_before, 6)
+        self.assertEqual(report.memories_after, 3)
+        self.assertEqual(report.duplicates_removed, 2)
+        self.assertEqual(report.memories_merged, 2)
+        self.assertEqual(report.llm_calls, 1)
+        self.assertLess(report.ltm_bytes_after, report.ltm_bytes_before)
+        memory = self.agent._load_long_term_memory(0)
+        documents = list(memory.docstore)
+        # memories are ordered by the latest of consolidated ones and get its date
+        self.assertEqual([document.page_content for document in documents], [WEATHER, GREETING, CAT_FOOD])
+        self.assertEqual(documents[1].metadata["date"][:10], "2023-07-05")
+        self.assertEqual(documents[2].metadata, {"date": "2023-07-06T00:00:00", "merged_from": 2})
+        self.assertEqual(memory.similarity_search(WEATHER, k=1)[0].page_content, WEATHER)
+        self.assertEqual(self.get_consolidator().run()[0].memories_after, 3)
+
+    def test_important_info(self):
+        with open(self.agent._get_memory_about_user_path(0), "w") as f:
+            f.write("User name is Bob.\nUser plans a trip on 2020-01-01.\nUser has an exam on 2999-01-01.")
+        report = self.get_consolidator().run([0])[0]
+        self.assertEqual(self.agent._load_memory_about_user(0), "User name is Bob.\nUser has an exam on 2999-01-01.")
+        self.assertGreater(report.prompt_tokens_saved_per_turn, 0)
+
+    def test_important_info_rewritten(self):
+        important_info = "User name is Bob.\nUser plans a trip on 2020-01-01.\nUser likes cats."
+        with open(self.agent._get_memory_about_user_path(0), "w") as f:
+            f.write(important_info)
+        consolidator = self.get_consolidator()
+        with mock.patch.object(consolidator, "_call_llm", return_value="User is Bob."):
+            report = consolidator.run([0])[0]
+        self.assertEqual(report.skipped, "LLM rewrote important info")
+        self.assertEqual(self.agent._load_memory_about_user(0), important_info)
+
+        consolidator.run([0])
+        with open(self.agent._get_memory_about_user_path(0) + ".bak") as f:
+            self.assertEqual(f.read(), important_info)
+        self.agent.forget(0)
+        self.assertFalse(os.path.exists(self.agent._get_memory_about_user_path(0) + ".bak"))
+
+    def test_budget(self):
+        with open(self.agent._get_memory_about_user_path(0), "w") as f:
+            f.write("User plans a trip on 2020-01-01.")
+        report = self.get_consolidator(max_llm_calls=0).run()[0]
+        # duplicates are removed without API calls, related memories are kept as they are
+        self.assertEqual(report.memories_after, 4)
+        self.assertEqual(report.llm_calls, 0)
+        self.assertEqual(report.skipped, "out of API budget")
+        self.assertEqual(self.agent._load_memory_about_user(0), "User plans a trip on 2020-01-01.")
+        report = self.get_consolidator(max_io_bytes=0).run()[0]
+        self.assertEqual(report.skipped, "out of I/O budget")
+        self.assertEqual(len(self.agent._load_long_term_memory(0)), 4)
+
+    def test_concurrent_changes(self):
+        consolidator = self.get_consolidator()
+        memory = self.agent._load_long_term_memory(0)
+        snapshot = len(memory), memory.docstore[len(memory) - 1]
+        vectors, texts, metadatas = consolidator._consolidate_memories(memory, ConsolidationReport(user_id=0))
+        # memory committed while consolidation was running is carried over
+        self.add_memories(0, ["User asked how to cook pasta"])
+        self.assertEqual(consolidator._swap_long_term_memory(0, *snapshot, vectors, texts, metadatas), 4)
+        self.assertEqual(self.agent._load_long_term_memory(0).docstore[3].page_content, "User asked how to cook pasta")
+        self.assertFalse(os.path.exists(self.agent._get_user_ltm_path(0) + ".old"))
+        # user asked to forget while consolidation was running
+        memory = self.agent._load_long_term_memory(0)
+        snapshot = len(memory), memory.docstore[len(memory) - 1]
+        self.agent.forget(0)
+        self.assertIsNone(consolidator._swap_long_term_memory(0, *snapshot, vectors, texts, metadatas))
+        self.assertIsNone(self.agent._load_long_term_memory(0))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.save_path)
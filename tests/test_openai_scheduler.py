@@ -0,0 +1,95 @@
+import asyncio
+import time
+from unittest import IsolatedAsyncioTestCase
+
+import openai
+from langchain.schema import HumanMessage
+
+from agents.openai_scheduler import OpenAIScheduler, ModelLimits, Priority, ScheduledChatOpenAI
+from benchmarks.fakes import FakeOpenAIServer, FakeWebSearchTool
+from benchmarks.utils import EventLoopMonitor
+
+
+class TestOpenAIScheduler(IsolatedAsyncioTestCase):
+    async def test_interactive_before_background(self):
+        # 100 tokens per second, the first request empties the bucket
+        scheduler = OpenAIScheduler({"model": ModelLimits(tokens_per_minute=6000)})
+        await scheduler.acquire("model", 6000, Priority.BACKGROUND)
+        order = []
+
+        async def request(name: str, priority: Priority):
+            await scheduler.acquire("model", 50, priority)
+            order.append(name)
+
+        tasks = [asyncio.create_task(request(f"background {i}", Priority.BACKGROUND)) for i in range(2)]
+        await asyncio.sleep(0.1)
+        tasks.append(asyncio.create_task(request("interactive", Priority.INTERACTIVE)))
+        await asyncio.sleep(0.1)
+        metrics = scheduler.metrics()["model"]
+        self.assertEqual(metrics["queue_depth"], {"interactive": 1, "background": 2})
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["interactive", "background 0", "background 1"])
+        self.assertEqual(scheduler.metrics()["model"]["queue_depth"], {"interactive": 0, "background": 0})
+
+    async def test_cancelled_waiter_leaves_queue(self):
+        scheduler = OpenAIScheduler({"model": ModelLimits(requests_per_minute=60)})
+        for _ in range(60):
+            await scheduler.acquire("model", 0)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(scheduler.acquire("model", 0), 0.1)
+        self.assertEqual(scheduler.metrics()["model"]["queue_depth"]["interactive"], 0)
+
+    async def test_retry_after_rate_limit(self):
+        with FakeOpenAIServer(fail_first=2) as server:
+            scheduler = OpenAIScheduler(backoff_base=0.05)
+            llm = ScheduledChatOpenAI(
+                model_name="gpt-4-0613", openai_api_base=server.api_base, openai_api_key="fake", scheduler=scheduler)
+            answer = await llm.apredict_messages([HumanMessage(content="hello")])
+            self.assertEqual(answer.content, "Fake answer to: hello")
+            answer = await asyncio.to_thread(llm.predict_messages, [HumanMessage(content="hello again")])
+            self.assertEqual(answer.content, "Fake answer to: hello again")
+            self.assertEqual(server.received, 4)
+            metrics = scheduler.metrics()["gpt-4-0613"]
+            self.assertEqual(metrics["rate_limited"], 2)
+            self.assertEqual(metrics["granted"], 4)
+
+    async def test_sync_call_on_event_loop(self):
+        scheduler = OpenAIScheduler()
+        # it would wait for the rate limit blocking every other request
+        with self.assertRaises(RuntimeError):
+            scheduler.run_sync("model", 0, Priority.INTERACTIVE, lambda: None)
+        self.assertIsNone(await asyncio.to_thread(scheduler.run_sync, "model", 0, Priority.INTERACTIVE, lambda: None))
+
+    async def test_rate_limit_pauses_model(self):
+        with FakeOpenAIServer(fail_first=1, retry_after=0.5) as server:
+            scheduler = OpenAIScheduler(backoff_base=0.01, max_retries=2)
+            llm = ScheduledChatOpenAI(
+                model_name="gpt-4-0613", openai_api_base=server.api_base, openai_api_key="fake", scheduler=scheduler)
+            start = time.monotonic()
+            await asyncio.gather(*[llm.apredict_messages([HumanMessage(content=str(i))]) for i in range(3)])
+            # the first 429 pauses every call to the model for Retry-After seconds
+            self.assertGreaterEqual(time.monotonic() - start, 0.5)
+            self.assertEqual(server.rejected, 1)
+            self.assertEqual(server.completed, 3)
+
+    async def test_gives_up_after_max_retries(self):
+        with FakeOpenAIServer(fail_first=10) as server:
+            scheduler = OpenAIScheduler(backoff_base=0.01, max_retries=3)
+            llm = ScheduledChatOpenAI(
+                model_name="gpt-4-0613", openai_api_base=server.api_base, openai_api_key="fake", scheduler=scheduler)
+            with self.assertRaises(openai.error.RateLimitError):
+                await llm.apredict_messages([HumanMessage(content="hello")])
+            self.assertEqual(server.received, 3)
+
+
+class TestWebSearchTool(IsolatedAsyncioTestCase):
+    async def test_search_does_not_block_event_loop(self):
+        tool = FakeWebSearchTool(latency=0.3)
+        monitor = EventLoopMonitor()
+        monitor.start()
+        await asyncio.sleep(monitor.interval * 2)
+        results = await tool.arun("cats")
+        await asyncio.sleep(monitor.interval * 2)
+        await monitor.stop()
+        self.assertIn("Snippet 0 about cats", results)
+        self.assertLess(monitor.summary()["max_lag"], 0.1)
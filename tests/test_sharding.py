@@ -0,0 +1,91 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from collections import Counter
+from unittest import TestCase, IsolatedAsyncioTestCase
+
+from aiohttp.test_utils import TestServer
+
+from sharding.hash_ring import ConsistentHashRing
+from sharding.router import ShardRouter
+from sharding.worker import ShardWorker
+from tests.utils import build_fake_agent, fake_llm
+
+
+class TestConsistentHashRing(TestCase):
+    def test_balance_and_moves(self):
+        users = range(10000)
+        ring = ConsistentHashRing(["a", "b", "c", "d"])
+        counts = Counter(ring.get_node(user_id) for user_id in users)
+        self.assertEqual(set(counts), {"a", "b", "c", "d"})
+        self.assertTrue(all(1500 < count < 3500 for count in counts.values()), counts)
+        placement = {user_id: ring.get_node(user_id) for user_id in users}
+        moves = ring.with_nodes(["a", "b", "c", "d", "e"]).get_moves(placement)
+        # only the share of the new node moves, and only to the new node
+        self.assertTrue(1000 < len(moves) < 3000, len(moves))
+        self.assertEqual(set(moves.values()), {"e"})
+        self.assertEqual(ConsistentHashRing(["d", "c", "b", "a"]).get_node(42), ring.get_node(42))
+
+
+class TestSharding(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.save_path = tempfile.mkdtemp()
+        self.agents, self.servers = {}, {}
+        for i in range(3):
+            agent = build_fake_agent(os.path.join(self.save_path, f"shard_{i}"), fake_llm(new_topic_ratio=0))
+            server = TestServer(ShardWorker(agent, token="secret").app)
+            await server.start_server()
+            url = str(server.make_url("")).rstrip("/")
+            self.agents[url], self.servers[url] = agent, server
+        self.urls = sorted(self.agents)
+
+    def get_owners(self, user_id: int):
+        return [url for url, agent in self.agents.items() if user_id in agent.get_user_ids()]
+
+    async def test_routing_and_rebalance(self):
+        router = ShardRouter(self.urls[:2], token="secret")
+        users = range(20)
+        answers = await asyncio.gather(*[router.arun(user_id, f"hello from {user_id}") for user_id in users])
+        self.assertTrue(all(not answer.startswith("Error") for answer in answers), answers)
+        for user_id in users:
+            self.assertEqual(self.get_owners(user_id), [router.ring.get_node(user_id)])
+        self.assertEqual(self.get_owners(100), [])
+
+        # the third worker joins while users keep talking
+        turns = asyncio.gather(*[router.arun(user_id, "second message") for user_id in users])
+        result = await router.rebalance(self.urls)
+        self.assertTrue(all(not answer.startswith("Error") for answer in await turns))
+        self.assertGreater(result["moved_users"], 0)
+        for user_id in users:
+            owner = router.ring.get_node(user_id)
+            self.assertEqual(self.get_owners(user_id), [owner])
+            # conversation moved together with the user
+            memory = self.agents[owner]._load_short_term_memory(user_id)
+            self.assertEqual(len(memory.chat_memory.messages), 4)
+
+        # back to two workers
+        await router.rebalance(self.urls[:2])
+        self.assertEqual(self.agents[self.urls[2]].get_user_ids(), [])
+        await router.aforget(0)
+        memory = self.agents[router.get_worker(0)]._load_short_term_memory(0)
+        self.assertEqual(len(memory.chat_memory.messages), 0)
+        status = await router.status()
+        self.assertEqual(sum(worker["users"] for worker in status["workers"].values()), 20)
+        await router.close()
+
+    async def test_token(self):
+        router = ShardRouter(self.urls, token="wrong")
+        self.assertIn("401", await router.arun(0, "hello"))
+        await router.close()
+
+    async def test_public_host_requires_token(self):
+        worker = ShardWorker(self.agents[self.urls[0]])
+        with self.assertRaises(ValueError):
+            worker.run("0.0.0.0", 8001)
+
+    async def asyncTearDown(self) -> None:
+        for url, server in self.servers.items():
+            await server.close()
+            await self.agents[url].long_term_memory_queue.close()
+        shutil.rmtree(self.save_path)
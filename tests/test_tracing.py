@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, IsolatedAsyncioTestCase, mock
+
+from agents.profiler import SamplingProfiler
+from agents.tracing import get_tracer, TracingPolicy, Span, assign_tracks, span
+from benchmarks.fakes import FakeSpeech, fake_telegram_update, fake_telegram_context
+from telegram_bot.tg_bot import TelegramBot
+from tests.utils import build_fake_agent, fake_llm
+
+
+def busy_loop(seconds: float):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        sum(range(1000))
+
+
+class TestAssignTracks(TestCase):
+    def test_assign_tracks(self):
+        spans = [
+            Span(0, None, "request", "request", 0, 10),
+            Span(1, 0, "tool", "tool", 1, 9),
+            # pages loaded in parallel are not drawn inside of each other
+            Span(2, 1, "page", "io", 2, 6),
+            Span(3, 1, "page", "io", 2.5, 5),
+            Span(4, 0, "step 1: tool", "agent_step", 0.5, 9.5),
+        ]
+        self.assertEqual(assign_tracks(spans), [0, 0, 0, 1, 0])
+
+
+class TestTracing(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.save_path = tempfile.mkdtemp()
+        self.trace_dir = os.path.join(self.save_path, "traces")
+
+    def tearDown(self) -> None:
+        get_tracer().configure(None)
+
+    async def _send_voice(self, bot: TelegramBot):
+        speech = FakeSpeech(stt_latency=0.05, tts_latency=0.05, conversion_latency=0.01)
+        with mock.patch.multiple(
+                "telegram_bot.tg_bot", ogg_to_mp3=speech.ogg_to_mp3, mp3_to_text=speech.mp3_to_text,
+                text_to_mp3_multi_language=speech.text_to_mp3_multi_language):
+            await bot.voice_handler(fake_telegram_update(1, voice=True, latency=0), fake_telegram_context(0))  # noqa
+
+    async def test_slow_request_trace(self):
+        agent = build_fake_agent(os.path.join(self.save_path, "users"),
+                                 fake_llm(latency=0.01, web_search_ratio=1, ask_urls_ratio=1), page_latency=0.05)
+        bot = TelegramBot(token="0:offline", agent=agent, greetings_message="")  # noqa
+        get_tracer().configure(TracingPolicy(threshold=0, trace_dir=self.trace_dir))
+        await self._send_voice(bot)
+        trace_files = os.listdir(self.trace_dir)
+        self.assertEqual(len(trace_files), 1)
+        with open(os.path.join(self.trace_dir, trace_files[0])) as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual({event["cat"] for event in events},
+                         {"request", "io", "audio", "ltm", "chain", "agent_step", "tool", "llm", "telegram"})
+        names = {event["name"] for event in events}
+        self.assertTrue({"voice 1", "speech to text", "web_search", "ask_urls", "load page",
+                         "step 1: web_search", "_load_short_term_memory"} <= names, names)
+        # spans of a track are nested
+        for track in {event["tid"] for event in events}:
+            open_ends = []
+            for event in sorted((e for e in events if e["tid"] == track), key=lambda e: (e["ts"], -e["dur"])):
+                while open_ends and open_ends[-1] <= event["ts"]:
+                    open_ends.pop()
+                self.assertTrue(not open_ends or event["ts"] + event["dur"] <= open_ends[-1] + 1e-3, event)
+                open_ends.append(event["ts"] + event["dur"])
+
+        # requests faster than the threshold are not written
+        get_tracer().configure(TracingPolicy(threshold=60, trace_dir=self.trace_dir))
+        await self._send_voice(bot)
+        self.assertEqual(len(os.listdir(self.trace_dir)), 1)
+        await agent.long_term_memory_queue.close()
+
+    async def test_not_traced(self):
+        with get_tracer().trace("request") as trace, span("io", "io"):
+            self.assertIsNone(trace)
+
+
+class TestProfiler(IsolatedAsyncioTestCase):
+    async def test_profiler(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        thread = threading.Thread(target=busy_loop, args=(0.3,))
+        thread.start()
+        thread.join()
+        summary = profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertGreater(profiler.samples, 20)
+        self.assertIn("busy_loop (test_tracing.py:", summary)
+
+    async def test_profile_command(self):
+        bot = TelegramBot(token="0:offline", agent=None, greetings_message="", admin_user_ids=[1])  # noqa
+        update = fake_telegram_update(2, text="/profile 0.1", latency=0)
+        await bot.command_handler(update, fake_telegram_context(0))  # noqa
+        self.assertEqual(update.message.replies, ["Unknown command."])
+
+        update = fake_telegram_update(1, text="/profile 0.2", latency=0)
+        await bot.command_handler(update, fake_telegram_context(0))  # noqa
+        self.assertTrue(bot.profiler.running)
+        await asyncio.sleep(0.4)
+        self.assertFalse(bot.profiler.running)
+        self.assertTrue(update.message.replies[-1].startswith("Profile of 0.2s"), update.message.replies)
+
+        # the second command stops profiling before the end of the window
+        await bot.command_handler(fake_telegram_update(1, text="/profile", latency=0), fake_telegram_context(0))  # noqa
+        update = fake_telegram_update(1, text="/profile", latency=0)
+        await bot.command_handler(update, fake_telegram_context(0))  # noqa
+        self.assertFalse(bot.profiler.running)
+        self.assertTrue(update.message.replies[-1].startswith("Profile of"))
@@ -0,0 +1,84 @@
+import asyncio
+import gc
+import os
+import random
+import tempfile
+from unittest import TestCase, IsolatedAsyncioTestCase, mock
+
+import numpy as np
+from pydub import AudioSegment
+
+from benchmarks.transcription_benchmark import generate_speech, StubSpeechToText, FRAME_RATE
+from speech.transcription import split_on_pauses, ChunkedTranscriber, ChunkedTranscriptionPolicy
+from tests.utils import build_fake_agent
+
+
+class TestSplitOnPauses(TestCase):
+    def test_cut_at_pauses(self):
+        audio, _ = generate_speech(random.Random(0), seconds=60)
+        # sentences of generated speech are shorter than 10s
+        bounds = split_on_pauses(audio, max_chunk_ms=10000, min_silence_ms=400, silence_thresh_db=16)
+        self.assertEqual(bounds[0][0], 0)
+        self.assertEqual(bounds[-1][1], len(audio))
+        for (_, end), (start, _) in zip(bounds, bounds[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(audio[end - 100:end + 100].rms, 0)
+        self.assertTrue(all(0 < end - start <= 10000 for start, end in bounds))
+
+    def test_cut_without_pauses(self):
+        t = np.arange(12 * FRAME_RATE) / FRAME_RATE
+        samples = (0.3 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+        audio = AudioSegment(samples.tobytes(), frame_rate=FRAME_RATE, sample_width=2, channels=1)
+        bounds = split_on_pauses(audio, max_chunk_ms=5000, min_silence_ms=400, silence_thresh_db=16)
+        self.assertEqual(bounds, [(0, 5000), (5000, 10000), (10000, 12000)])
+        self.assertEqual(split_on_pauses(audio[:3000], 5000, 400, 16), [(0, 3000)])
+
+
+class TestChunkedTranscriber(IsolatedAsyncioTestCase):
+    async def test_transcribe(self):
+        audio, words = generate_speech(random.Random(1), seconds=60)
+        stt = StubSpeechToText(latency=0.1, seconds_per_audio_second=0.01)
+        transcriber = ChunkedTranscriber(stt, ChunkedTranscriptionPolicy(
+            max_chunk_seconds=10, max_concurrency=3, chunk_format="wav"))
+        with tempfile.TemporaryDirectory() as audio_dir:
+            audio_path = os.path.join(audio_dir, "voice.wav")
+            audio.export(audio_path, format="wav")
+            transcript = await transcriber.atranscribe(audio_path)
+        # transcripts of chunks are joined in order
+        self.assertEqual(transcript, " ".join(words))
+        self.assertGreater(stt.calls, 6)
+        self.assertEqual(stt.max_active, 3)
+
+    async def test_early_agent_start(self):
+        with tempfile.TemporaryDirectory() as save_path:
+            agent = build_fake_agent(save_path)
+            with mock.patch.object(agent, "_aload_context", wraps=agent._aload_context) as load_context:
+                await agent.aprepare(0)
+                answer = await agent.arun(0, "Hi")
+                self.assertFalse(answer.startswith("Error in telegram bot"), answer)
+                load_context.assert_called_once_with(0)
+                # memory prepared long ago is loaded again
+                agent.prepared_context_ttl = 0
+                await agent.aprepare(0)
+                await agent.arun(0, "Hi")
+                self.assertEqual(load_context.call_count, 3)
+            await agent.long_term_memory_queue.close()
+
+    async def test_failed_early_agent_start(self):
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+
+        async def load_context(user_id: int):
+            raise OSError(f"Too many open files of user {user_id}")
+
+        with tempfile.TemporaryDirectory() as save_path:
+            agent = build_fake_agent(save_path)
+            with mock.patch.object(agent, "_aload_context", load_context):
+                await agent.aprepare(0)
+                await asyncio.sleep(0)
+                # the request never came, e.g. the voice message could not be transcribed, and the next one started
+                await agent.aprepare(0)
+                await asyncio.sleep(0)
+            gc.collect()
+            self.assertEqual([error["message"] for error in errors], [])
+            await agent.long_term_memory_queue.close()
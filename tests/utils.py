@@ -0,0 +1,30 @@
+from pathlib import Path
+from typing import Dict, Optional
+
+import yaml
+
+from agents.helper_agent import HelperAgent
+from agents.web_researcher import WebResearcherAgent
+from benchmarks.fakes import FakeChatModel, HashEmbeddings, FakeWebSearchTool, FakeAskPagesTool
+
+
+def load_prompts(prompts_name: str) -> Dict[str, str]:
+    with open(Path(__file__).parents[1] / "prompts" / f"{prompts_name}.yaml", "r") as f:
+        return yaml.safe_load(f)
+
+
+def fake_llm(**behaviour) -> FakeChatModel:
+    """FakeChatModel answering right away, behaviour overrides its fields."""
+    return FakeChatModel(**{"latency": 0, "tokens_per_second": 10 ** 6, **behaviour})
+
+
+def build_fake_agent(save_path: str, llm: Optional[FakeChatModel] = None, page_latency: float = 0,
+                     use_function_calling: bool = False, **overrides) -> HelperAgent:
+    """HelperAgent with local fakes of all remote services, overrides are arguments of HelperAgent."""
+    llm = llm or fake_llm()
+    web_researcher = WebResearcherAgent(
+        load_prompts("web_researcher"), smart_llm=llm, fast_llm=llm, web_search_tool=FakeWebSearchTool(latency=0),
+        ask_url_tool=FakeAskPagesTool(llm=llm, latency=page_latency), use_function_calling=use_function_calling)
+    return HelperAgent(save_path, load_prompts("friend"), web_researcher, **{
+        "smart_llm": llm, "fast_llm": llm, "degraded_llm": llm, "long_term_memory_embeddings": HashEmbeddings(),
+        "use_function_calling": use_function_calling, **overrides})